@@ -12,6 +12,10 @@ import utils.other.hume as hume
 from models.conversation import ConversationPhoto, PostProcessingStatus, PostProcessingModel, ConversationStatus
 from models.transcript_segment import TranscriptSegment
 from ._client import db
+from .redis_db import invalidate_listen_session_descriptor
+
+# Conversation fields the listen session descriptor depends on
+_listen_session_fields = {'status', 'deleted', 'discarded', 'created_at', 'started_at'}
 
 
 # *****************************
@@ -27,6 +31,7 @@ def upsert_conversation(uid: str, conversation_data: dict):
     user_ref = db.collection('users').document(uid)
     conversation_ref = user_ref.collection('memories').document(conversation_data['id'])
     conversation_ref.set(conversation_data)
+    invalidate_listen_session_descriptor(uid)
 
 
 def get_conversation(uid, conversation_id):
@@ -64,6 +69,8 @@ def update_conversation(uid: str, conversation_id: str, memoy_data: dict):
     user_ref = db.collection('users').document(uid)
     conversation_ref = user_ref.collection('memories').document(conversation_id)
     conversation_ref.update(memoy_data)
+    if _listen_session_fields.intersection(memoy_data):
+        invalidate_listen_session_descriptor(uid)
 
 
 def update_conversation_title(uid: str, conversation_id: str, title: str):
@@ -76,6 +83,7 @@ def delete_conversation(uid, conversation_id):
     user_ref = db.collection('users').document(uid)
     conversation_ref = user_ref.collection('memories').document(conversation_id)
     conversation_ref.update({'deleted': True})
+    invalidate_listen_session_descriptor(uid)
 
 
 def filter_conversations_by_date(uid, start_date, end_date):
@@ -135,12 +143,14 @@ def update_conversation_status(uid: str, conversation_id: str, status: str):
     user_ref = db.collection('users').document(uid)
     conversation_ref = user_ref.collection('memories').document(conversation_id)
     conversation_ref.update({'status': status})
+    invalidate_listen_session_descriptor(uid)
 
 
 def set_conversation_as_discarded(uid: str, conversation_id: str):
     user_ref = db.collection('users').document(uid)
     conversation_ref = user_ref.collection('memories').document(conversation_id)
     conversation_ref.update({'discarded': True})
+    invalidate_listen_session_descriptor(uid)
 
 
 # *********************************
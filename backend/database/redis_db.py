@@ -1,7 +1,7 @@
 import base64
 import json
 import os
-from typing import List, Union
+from typing import List, Optional, Union
 
 import redis
 
@@ -65,8 +65,27 @@ def get_app_cache_by_id(app_id: str) -> dict | None:
     return app
 
 
-def delete_app_cache_by_id(app_id: str):
-    r.delete(f'apps:{app_id}')
+def delete_app_cache_by_id(app_id: str, audio_bytes_changed: bool = False):
+    """`audio_bytes_changed` when the app started or stopped being triggered on audio bytes, or was deleted as one."""
+    pipe = r.pipeline()
+    pipe.delete(f'apps:{app_id}')
+    # every app update goes through here
+    pipe.publish(apps_changed_channel, json.dumps({'app_id': app_id}))
+    if audio_bytes_changed:
+        # the listen session descriptors of its users say whether an audio bytes app is enabled
+        pipe.incr(listen_session_apps_version_key)
+    pipe.execute()
+
+
+# Pub/sub, the pusher sessions keep a snapshot of the user's apps, see utils/apps_snapshot.py.
+# Messages are {"uid": uid} when the user enables or disables an app, {"app_id": app_id} when an app changes.
+apps_changed_channel = 'apps:changed'
+
+
+def apps_changed_pubsub():
+    pubsub = r.pubsub(ignore_subscribe_messages=True)
+    pubsub.subscribe(apps_changed_channel)
+    return pubsub
 
 
 # ******************************************************
@@ -210,11 +229,19 @@ def get_user_paid_app(app_id: str, uid: str) -> str:
 
 
 def enable_app(uid: str, app_id: str):
-    r.sadd(f'users:{uid}:enabled_plugins', app_id)
+    pipe = r.pipeline()
+    pipe.sadd(f'users:{uid}:enabled_plugins', app_id)
+    pipe.publish(apps_changed_channel, json.dumps({'uid': uid}))
+    pipe.execute()
+    invalidate_listen_session_descriptor(uid)
 
 
 def disable_app(uid: str, app_id: str):
-    r.srem(f'users:{uid}:enabled_plugins', app_id)
+    pipe = r.pipeline()
+    pipe.srem(f'users:{uid}:enabled_plugins', app_id)
+    pipe.publish(apps_changed_channel, json.dumps({'uid': uid}))
+    pipe.execute()
+    invalidate_listen_session_descriptor(uid)
 
 
 def get_enabled_plugins(uid: str):
@@ -290,6 +317,22 @@ def remove_user_soniox_speech_profile(uid: str):
     r.delete(f'users:{uid}:has_soniox_speech_profile')
 
 
+def cache_speech_profile(uid: str, generation: str, duration: float, ttl: int = 60 * 60 * 24 * 7):
+    # empty generation caches that the user has no profile
+    r.set(f'users:{uid}:speech_profile', json.dumps({'generation': generation, 'duration': duration}), ex=ttl)
+
+
+def get_cached_speech_profile(uid: str) -> dict | None:
+    data = r.get(f'users:{uid}:speech_profile')
+    if not data:
+        return None
+    return json.loads(data)
+
+
+def remove_cached_speech_profile(uid: str):
+    r.delete(f'users:{uid}:speech_profile')
+
+
 def cache_user_name(uid: str, name: str, ttl: int = 60 * 60 * 24 * 7):
     r.set(f'users:{uid}:name', name)
     r.expire(f'users:{uid}:name', ttl)
@@ -401,16 +444,468 @@ def get_in_progress_conversation_id(uid: str) -> str:
     return conversation_id.decode()
 
 
+# Hot copy of the in progress conversation, firestore only gets it on checkpoints
+def set_in_progress_conversation_segments(
+        uid: str, conversation_id: str, segments: List[dict], finished_at: str, ttl: int = 60 * 60 * 6,
+        finalize_at: float = None,
+):
+    key = f'users:{uid}:in_progress_memory:{conversation_id}:segments'
+    pipe = r.pipeline()
+    pipe.delete(key)
+    if segments:
+        pipe.rpush(key, *[json.dumps(segment, default=str) for segment in segments])
+    pipe.expire(key, ttl)
+    pipe.set(f'users:{uid}:in_progress_memory:{conversation_id}:finished_at', finished_at, ex=ttl)
+    pipe.set(f'users:{uid}:in_progress_memory_last_tick', json.dumps({'id': conversation_id, 'finished_at': finished_at}), ex=ttl)
+    if finalize_at is not None:
+        pipe.zadd(_conversation_finalize_key, {f'{uid}:{conversation_id}': finalize_at})
+    pipe.execute()
+
+
+def append_in_progress_conversation_segments(
+        uid: str, conversation_id: str, segments: List[dict], finished_at: str, replace_last: dict = None,
+        ttl: int = 60 * 60 * 6, in_progress_ttl: int = 150, finalize_at: float = None,
+):
+    key = f'users:{uid}:in_progress_memory:{conversation_id}:segments'
+    pipe = r.pipeline()
+    if replace_last is not None:
+        pipe.lset(key, -1, json.dumps(replace_last, default=str))
+    if segments:
+        pipe.rpush(key, *[json.dumps(segment, default=str) for segment in segments])
+    pipe.expire(key, ttl)
+    pipe.set(f'users:{uid}:in_progress_memory:{conversation_id}:finished_at', finished_at, ex=ttl)
+    pipe.set(f'users:{uid}:in_progress_memory_last_tick', json.dumps({'id': conversation_id, 'finished_at': finished_at}), ex=ttl)
+    pipe.set(f'users:{uid}:in_progress_memory_id', conversation_id, ex=in_progress_ttl)
+    if finalize_at is not None:
+        pipe.zadd(_conversation_finalize_key, {f'{uid}:{conversation_id}': finalize_at})
+    pipe.execute()
+
+
+def get_in_progress_conversation_segments(uid: str, conversation_id: str):
+    pipe = r.pipeline()
+    pipe.lrange(f'users:{uid}:in_progress_memory:{conversation_id}:segments', 0, -1)
+    pipe.get(f'users:{uid}:in_progress_memory:{conversation_id}:finished_at')
+    segments, finished_at = pipe.execute()
+    if not finished_at:
+        return None
+    return [json.loads(segment) for segment in segments], finished_at.decode()
+
+
+def remove_in_progress_conversation_segments(uid: str, conversation_id: str):
+    r.delete(
+        f'users:{uid}:in_progress_memory:{conversation_id}:segments',
+        f'users:{uid}:in_progress_memory:{conversation_id}:finished_at',
+    )
+
+
+# Delayed finalization of in progress conversations, `uid:conversation_id` scored by its deadline
+# (unix seconds). A claim moves a due job to the processing set, scored by its lease expiry, in one
+# script, so only one backend wins it and a deadline moved by a newer segment is not claimed.
+_conversation_finalize_key = 'conversations:finalize'
+_conversation_finalize_processing_key = 'conversations:finalize:processing'
+
+_claim_conversation_finalize = r.register_script("""
+local score = redis.call('ZSCORE', KEYS[1], ARGV[1])
+if not score then
+    if redis.call('ZSCORE', KEYS[2], ARGV[1]) then
+        return 0
+    end
+    return -1
+end
+if tonumber(score) > tonumber(ARGV[4]) then
+    return 2
+end
+redis.call('ZREM', KEYS[1], ARGV[1])
+redis.call('ZADD', KEYS[2], ARGV[3], ARGV[1])
+return 1
+""")
+
+_requeue_conversation_finalizes = r.register_script("""
+local expired = redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', ARGV[1], 'LIMIT', 0, ARGV[2])
+for _, member in ipairs(expired) do
+    redis.call('ZREM', KEYS[2], member)
+    redis.call('ZADD', KEYS[1], 'NX', ARGV[1], member)
+end
+return #expired
+""")
+
+
+def schedule_conversation_finalize(uid: str, conversation_id: str, finalize_at: float):
+    r.zadd(_conversation_finalize_key, {f'{uid}:{conversation_id}': finalize_at})
+
+
+def cancel_conversation_finalize(uid: str, conversation_id: str):
+    r.zrem(_conversation_finalize_key, f'{uid}:{conversation_id}')
+
+
+def get_due_conversation_finalizes(now: float, limit: int = 100) -> List[tuple]:
+    members = r.zrangebyscore(_conversation_finalize_key, '-inf', now, start=0, num=limit)
+    return [tuple(member.decode().split(':', 1)) for member in members]
+
+
+def claim_conversation_finalize(
+        uid: str, conversation_id: str, now: float, lease_seconds: int, due_at: float = None,
+) -> int:
+    """1 claimed, 2 not due by `due_at` (now by default), 0 claimed by someone else, -1 not scheduled."""
+    return int(_claim_conversation_finalize(
+        keys=[_conversation_finalize_key, _conversation_finalize_processing_key],
+        args=[f'{uid}:{conversation_id}', now, now + lease_seconds, now if due_at is None else due_at],
+    ))
+
+
+def get_conversation_finalize_at(uid: str, conversation_id: str) -> Optional[float]:
+    return r.zscore(_conversation_finalize_key, f'{uid}:{conversation_id}')
+
+
+def complete_conversation_finalize(uid: str, conversation_id: str):
+    r.zrem(_conversation_finalize_processing_key, f'{uid}:{conversation_id}')
+
+
+def requeue_expired_conversation_finalizes(now: float, limit: int = 100) -> int:
+    """Claims whose worker died before completing them are due again."""
+    return int(_requeue_conversation_finalizes(
+        keys=[_conversation_finalize_key, _conversation_finalize_processing_key], args=[now, limit],
+    ))
+
+
+# Webhook and app deliveries, a stream read by a consumer group. A failed delivery is acked and its
+# fields parked in `deliveries:retry:<member>`, `deliveries:retry` scores the member by when it's due,
+# a script moves it back to the stream. Given up deliveries go to the capped `deliveries:dead` stream.
+_deliveries_key = 'deliveries'
+_deliveries_group = 'delivery-workers'
+_deliveries_retry_key = 'deliveries:retry'
+_deliveries_dead_key = 'deliveries:dead'
+
+_add_delivery = r.register_script("""
+if KEYS[2] and not redis.call('SET', KEYS[2], '1', 'NX', 'EX', ARGV[1]) then
+    return 0
+end
+redis.call('XADD', KEYS[1], 'MAXLEN', '~', ARGV[2], '*', unpack(ARGV, 3))
+return 1
+""")
+
+_requeue_due_deliveries = r.register_script("""
+local due = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, ARGV[2])
+for _, member in ipairs(due) do
+    redis.call('ZREM', KEYS[1], member)
+    local key = KEYS[1] .. ':' .. member
+    local fields = redis.call('HGETALL', key)
+    if #fields > 0 then
+        redis.call('XADD', KEYS[2], 'MAXLEN', '~', ARGV[3], '*', unpack(fields))
+    end
+    redis.call('DEL', key)
+end
+return #due
+""")
+
+_retry_dead_delivery = r.register_script("""
+local entries = redis.call('XRANGE', KEYS[1], ARGV[1], ARGV[1])
+if #entries == 0 then
+    return 0
+end
+local fields = {}
+local dead = entries[1][2]
+for i = 1, #dead, 2 do
+    local name, value = dead[i], dead[i + 1]
+    if name == 'attempt' then
+        value = '0'
+    end
+    if name ~= 'error' and name ~= 'failed_at' then
+        table.insert(fields, name)
+        table.insert(fields, value)
+    end
+end
+redis.call('XADD', KEYS[2], 'MAXLEN', '~', ARGV[2], '*', unpack(fields))
+redis.call('XDEL', KEYS[1], ARGV[1])
+return 1
+""")
+
+
+def create_deliveries_group():
+    try:
+        r.xgroup_create(_deliveries_key, _deliveries_group, id='0', mkstream=True)
+    except redis.ResponseError as e:
+        if 'BUSYGROUP' not in str(e):
+            raise
+
+
+def add_delivery(fields: dict, idempotency_key: str = None, idempotency_ttl: int = 60 * 60 * 24,
+                 maxlen: int = 100000) -> bool:
+    """False if a delivery with the same idempotency key was already queued within the ttl."""
+    keys = [_deliveries_key]
+    if idempotency_key:
+        keys.append(f'deliveries:keys:{idempotency_key}')
+    args = [idempotency_ttl, maxlen]
+    for name, value in fields.items():
+        args.extend((name, value))
+    return _add_delivery(keys=keys, args=args) == 1
+
+
+def read_deliveries(consumer: str, count: int, block_ms: int) -> List[tuple]:
+    """New deliveries for this consumer, (entry id, fields) with the field names decoded."""
+    streams = r.xreadgroup(_deliveries_group, consumer, {_deliveries_key: '>'}, count=count, block=block_ms)
+    if not streams:
+        return []
+    return [(entry_id.decode(), {k.decode(): v for k, v in fields.items()}) for entry_id, fields in streams[0][1]]
+
+
+def claim_stale_deliveries(consumer: str, min_idle_ms: int, count: int = 100) -> List[tuple]:
+    """Deliveries read by a consumer that died before acking them."""
+    result = r.xautoclaim(_deliveries_key, _deliveries_group, consumer, min_idle_ms, start_id='0-0', count=count)
+    return [
+        (entry_id.decode(), {k.decode(): v for k, v in fields.items()})
+        for entry_id, fields in result[1] if fields
+    ]
+
+
+def delete_idle_delivery_consumers(min_idle_ms: int) -> int:
+    """Consumers of previous deployments, once nothing is pending on them."""
+    deleted = 0
+    for consumer in r.xinfo_consumers(_deliveries_key, _deliveries_group):
+        if consumer['pending'] == 0 and consumer['idle'] > min_idle_ms:
+            r.xgroup_delconsumer(_deliveries_key, _deliveries_group, consumer['name'])
+            deleted += 1
+    return deleted
+
+
+def complete_delivery(entry_id: str):
+    pipe = r.pipeline()
+    pipe.xack(_deliveries_key, _deliveries_group, entry_id)
+    pipe.xdel(_deliveries_key, entry_id)
+    pipe.execute()
+
+
+def retry_delivery(entry_id: str, member: str, fields: dict, due_at: float, ttl: int = 60 * 60 * 24):
+    key = f'{_deliveries_retry_key}:{member}'
+    pipe = r.pipeline()
+    pipe.hset(key, mapping=fields)
+    pipe.expire(key, ttl)
+    pipe.zadd(_deliveries_retry_key, {member: due_at})
+    pipe.xack(_deliveries_key, _deliveries_group, entry_id)
+    pipe.xdel(_deliveries_key, entry_id)
+    pipe.execute()
+
+
+def requeue_due_deliveries(now: float, limit: int = 100, maxlen: int = 100000) -> int:
+    return int(_requeue_due_deliveries(keys=[_deliveries_retry_key, _deliveries_key], args=[now, limit, maxlen]))
+
+
+def dead_letter_delivery(entry_id: str, fields: dict, maxlen: int = 10000):
+    pipe = r.pipeline()
+    pipe.xadd(_deliveries_dead_key, fields, maxlen=maxlen, approximate=True)
+    pipe.xack(_deliveries_key, _deliveries_group, entry_id)
+    pipe.xdel(_deliveries_key, entry_id)
+    pipe.execute()
+
+
+def get_dead_deliveries(count: int = 100, before: str = None) -> List[tuple]:
+    """Newest first, `before` is the last entry id of the previous page."""
+    entries = r.xrevrange(_deliveries_dead_key, max=f'({before}' if before else '+', min='-', count=count)
+    return [(entry_id.decode(), {k.decode(): v for k, v in fields.items()}) for entry_id, fields in entries]
+
+
+def count_deliveries() -> dict:
+    pipe = r.pipeline()
+    pipe.xlen(_deliveries_key)
+    pipe.zcard(_deliveries_retry_key)
+    pipe.xlen(_deliveries_dead_key)
+    queued, retrying, dead = pipe.execute()
+    return {'queued': queued, 'retrying': retrying, 'dead': dead}
+
+
+def retry_dead_delivery(entry_id: str, maxlen: int = 100000) -> bool:
+    """Queues a dead delivery again from its first attempt, False if it's not in the dead stream."""
+    return _retry_dead_delivery(keys=[_deliveries_dead_key, _deliveries_key], args=[entry_id, maxlen]) == 1
+
+
+# Circuit breakers of the third party hosts, one per `<host>/<target>`. `circuit:<host>/<target>` holds the
+# state while it isn't closed, `circuit:<host>/<target>:window` the outcome counts of the rolling window as
+# `<bucket>:t|e|s` fields (total, errors, slow), `circuit_host:<host>:window` the same for all the host's
+# targets, only shown to app owners. Every process records its outcomes through one script, which also moves
+# the state.
+_record_circuit_outcomes = r.register_script("""
+local now = tonumber(ARGV[1])
+local total, errors, slow = tonumber(ARGV[2]), tonumber(ARGV[3]), tonumber(ARGV[4])
+local bucket_seconds, buckets = tonumber(ARGV[5]), tonumber(ARGV[6])
+local min_requests, error_rate, slow_rate = tonumber(ARGV[7]), tonumber(ARGV[8]), tonumber(ARGV[9])
+local open_seconds, max_open_seconds, probes = tonumber(ARGV[10]), tonumber(ARGV[11]), tonumber(ARGV[12])
+local bucket = math.floor(now / bucket_seconds)
+
+-- adds the outcomes to a window, returns its sums
+local function add(window)
+    redis.call('HINCRBY', window, bucket .. ':t', total)
+    redis.call('HINCRBY', window, bucket .. ':e', errors)
+    redis.call('HINCRBY', window, bucket .. ':s', slow)
+    redis.call('EXPIRE', window, bucket_seconds * (buckets + 1))
+
+    local counts = redis.call('HGETALL', window)
+    local sums = {t = 0, e = 0, s = 0}
+    for i = 1, #counts, 2 do
+        local field_bucket, kind = string.match(counts[i], '^(%d+):(%a)$')
+        if tonumber(field_bucket) <= bucket - buckets then
+            redis.call('HDEL', window, counts[i])
+        else
+            sums[kind] = sums[kind] + tonumber(counts[i + 1])
+        end
+    end
+    return sums
+end
+
+local function open(trips)
+    local until_at = now + math.min(open_seconds * 2 ^ (trips - 1), max_open_seconds)
+    redis.call('HSET', KEYS[1], 'state', 'open', 'until', until_at, 'trips', trips, 'opened_at', now,
+        'probe_ok', 0, 'probe_failed', 0)
+    redis.call('EXPIRE', KEYS[1], 60 * 60 * 24)
+    redis.call('DEL', KEYS[2])
+    return {'open', tostring(until_at)}
+end
+
+add(KEYS[3])
+
+local state = redis.call('HGET', KEYS[1], 'state')
+local trips = tonumber(redis.call('HGET', KEYS[1], 'trips') or '0')
+if state == 'open' then
+    local until_at = tonumber(redis.call('HGET', KEYS[1], 'until'))
+    if now < until_at then
+        return {'open', tostring(until_at)}
+    end
+    state = 'half_open'
+    redis.call('HSET', KEYS[1], 'state', 'half_open')
+end
+
+if state == 'half_open' then
+    if errors + slow > 0 then
+        return open(trips + 1)
+    end
+    if redis.call('HINCRBY', KEYS[1], 'probe_ok', total) >= probes then
+        -- the trips are kept for a day, a flapping host opens for longer each time
+        redis.call('HSET', KEYS[1], 'state', 'closed')
+        return {'closed', '0'}
+    end
+    return {'half_open', '0'}
+end
+
+local sums = add(KEYS[2])
+if sums.t >= min_requests and (sums.e / sums.t >= error_rate or sums.s / sums.t >= slow_rate) then
+    return open(trips + 1)
+end
+return {'closed', '0'}
+""")
+
+
+def record_circuit_outcomes(outcomes: dict, now: float, bucket_seconds: int, buckets: int, min_requests: int,
+                            error_rate: float, slow_rate: float, open_seconds: float, max_open_seconds: float,
+                            probes: int) -> dict:
+    """
+    `outcomes` `<host>/<target>` -> (total, errors, slow) since the last call, returns
+    `<host>/<target>` -> (state, open until).
+    """
+    keys = list(outcomes)
+    pipe = r.pipeline(transaction=False)
+    for key in keys:
+        total, errors, slow = outcomes[key]
+        host = key.split('/', 1)[0]
+        _record_circuit_outcomes(
+            keys=[f'circuit:{key}', f'circuit:{key}:window', f'circuit_host:{host}:window'],
+            args=[now, total, errors, slow, bucket_seconds, buckets, min_requests, error_rate, slow_rate,
+                  open_seconds, max_open_seconds, probes],
+            client=pipe,
+        )
+    return {key: (state.decode(), float(until_at)) for key, (state, until_at) in zip(keys, pipe.execute())}
+
+
+def get_circuit_states(keys: List[str]) -> dict:
+    """`<host>/<target>` -> (state, open until) of the breakers that aren't closed."""
+    pipe = r.pipeline(transaction=False)
+    for key in keys:
+        pipe.hmget(f'circuit:{key}', 'state', 'until')
+    states = {}
+    for key, (state, until_at) in zip(keys, pipe.execute()):
+        if state and state != b'closed':
+            states[key] = (state.decode(), float(until_at))
+    return states
+
+
+def get_circuit(key: str, host: str) -> tuple:
+    """The state hash of a breaker and the window counts of its host, for its status."""
+    pipe = r.pipeline(transaction=False)
+    pipe.hgetall(f'circuit:{key}')
+    pipe.hgetall(f'circuit_host:{host}:window')
+    state, window = pipe.execute()
+    return (
+        {k.decode(): v.decode() for k, v in state.items()},
+        {k.decode(): int(v) for k, v in window.items()},
+    )
+
+
+# Listen session descriptor, everything /v3/listen needs at connect time in one round trip.
+# Invalidated by the writes that change it, the version guards against caching a descriptor
+# that was built while an invalidation happened. An app whose audio bytes trigger changed bumps
+# the apps version instead, it invalidates the descriptors of every user at once.
+listen_session_apps_version_key = 'apps:listen_session:version'
+
+
+def get_listen_session_descriptor(uid: str):
+    """The descriptor or None, its version to cache a rebuilt one with, and the in progress last tick."""
+    pipe = r.pipeline()
+    pipe.get(f'users:{uid}:listen_session')
+    pipe.get(f'users:{uid}:listen_session:version')
+    pipe.get(listen_session_apps_version_key)
+    pipe.get(f'users:{uid}:in_progress_memory_last_tick')
+    descriptor, version, apps_version, last_tick = pipe.execute()
+    version = (int(version) if version else 0, int(apps_version) if apps_version else 0)
+
+    descriptor = json.loads(descriptor) if descriptor else None
+    if descriptor is not None and descriptor.pop('apps_version', 0) != version[1]:
+        descriptor = None
+    return descriptor, version, json.loads(last_tick) if last_tick else None
+
+
+def cache_listen_session_descriptor(uid: str, descriptor: dict, version: tuple, ttl: int = 60 * 60) -> bool:
+    version_key = f'users:{uid}:listen_session:version'
+    with r.pipeline() as pipe:
+        try:
+            pipe.watch(version_key, listen_session_apps_version_key)
+            current, apps_current = pipe.mget(version_key, listen_session_apps_version_key)
+            if (int(current) if current else 0, int(apps_current) if apps_current else 0) != version:
+                return False
+            pipe.multi()
+            pipe.set(
+                f'users:{uid}:listen_session', json.dumps({**descriptor, 'apps_version': version[1]}, default=str),
+                ex=ttl,
+            )
+            pipe.execute()
+            return True
+        except redis.WatchError:
+            return False
+
+
+def invalidate_listen_session_descriptor(uid: str):
+    # after the write it follows went through, a failure here mustn't fail that write,
+    # the descriptor is stale until its ttl then
+    try:
+        pipe = r.pipeline()
+        pipe.delete(f'users:{uid}:listen_session')
+        pipe.incr(f'users:{uid}:listen_session:version')
+        pipe.expire(f'users:{uid}:listen_session:version', 60 * 60 * 24)
+        pipe.execute()
+    except Exception as e:
+        print(f'invalidate_listen_session_descriptor failed: {e}', uid)
+
+
 def set_user_webhook_db(uid: str, wtype: str, url: str):
     r.set(f'users:{uid}:developer:webhook:{wtype}', url)
+    invalidate_listen_session_descriptor(uid)
 
 
 def disable_user_webhook_db(uid: str, wtype: str):
     r.set(f'users:{uid}:developer:webhook_status:{wtype}', str(False).lower())
+    invalidate_listen_session_descriptor(uid)
 
 
 def enable_user_webhook_db(uid: str, wtype: str):
     r.set(f'users:{uid}:developer:webhook_status:{wtype}', str(True).lower())
+    invalidate_listen_session_descriptor(uid)
 
 
 def user_webhook_status_db(uid: str, wtype: str):
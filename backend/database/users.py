@@ -3,6 +3,7 @@ from datetime import datetime, timezone
 from google.cloud.firestore_v1 import FieldFilter
 
 from ._client import db, document_id_from_seed
+from .redis_db import invalidate_listen_session_descriptor
 
 
 def is_exists_user(uid: str):
@@ -83,6 +84,7 @@ def delete_user_data(uid: str):
     batch.commit()
     # delete user
     user_ref.delete()
+    invalidate_listen_session_descriptor(uid)
     return {'status': 'ok', 'message': 'Account deleted successfully'}
 
 
@@ -7,9 +7,16 @@ from fastapi import FastAPI
 from modal import Image, App, asgi_app, Secret
 from routers import workflow, chat, firmware, plugins, memories, transcribe, notifications, \
     speech_profile, agents, facts, users, processing_memories, trends, sdcard, sync, apps, custom_auth, payment, \
-    integration, conversations
+    integration, conversations, metrics
 
+from utils.conversations.finalize import start_conversation_finalize_scheduler
+from utils.other.circuit_breaker import start_circuit_breakers
+from utils.other.http_fanout import get_http_fanout
+from utils.other.metrics import start_event_loop_lag_monitor
 from utils.other.timeout import TimeoutMiddleware
+from utils.pusher_mux import get_pusher_mux
+from utils.stt.streaming import prewarm_deepgram_pool
+from utils.webhook_delivery import start_webhook_delivery_workers
 
 if os.environ.get('SERVICE_ACCOUNT_JSON'):
     service_account_info = json.loads(os.environ["SERVICE_ACCOUNT_JSON"])
@@ -44,6 +51,23 @@ app.include_router(custom_auth.router)
 
 app.include_router(payment.router)
 
+app.include_router(metrics.router)
+
+
+@app.on_event("startup")
+async def startup():
+    prewarm_deepgram_pool()
+    start_event_loop_lag_monitor()
+    start_conversation_finalize_scheduler()
+    start_webhook_delivery_workers()
+    start_circuit_breakers()
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    await get_http_fanout().close()
+    await get_pusher_mux().close()
+
 
 methods_timeout = {
     "GET": os.environ.get('HTTP_GET_TIMEOUT'),
@@ -65,6 +65,17 @@ class ApiKey(BaseModel):
     created_at: Optional[datetime] = None
 
 
+class WebhookCircuit(BaseModel):
+    """The circuit breaker of the app's webhook and the window of its whole host, see utils/other/circuit_breaker.py"""
+    host: str
+    state: str  # closed, open or half_open
+    open_until: Optional[datetime] = None
+    window_seconds: int
+    requests: int
+    error_rate: float
+    slow_rate: float
+
+
 class App(BaseModel):
     id: str
     name: str
@@ -108,6 +119,7 @@ class App(BaseModel):
     thumbnails: Optional[List[str]] = []  # List of thumbnail IDs
     thumbnail_urls: Optional[List[str]] = []  # List of thumbnail URLs
     is_influencer: Optional[bool] = False
+    webhook_circuit: Optional[WebhookCircuit] = None  # only for the owner
 
     def get_rating_avg(self) -> Optional[str]:
         return f'{self.rating_avg:.1f}' if self.rating_avg is not None else None
@@ -3,6 +3,7 @@ from typing import List, Optional
 from pydantic import BaseModel
 
 from models.conversation import Conversation, Message
+from models.transcript_segment import TranscriptSegment
 
 
 class MessageEvent(BaseModel):
@@ -77,6 +78,7 @@ class MessageServiceStatusEvent(MessageEvent):
     event_type: str = "service_status"
     status: str
     status_text: Optional[str] = None
+    retry_after: Optional[int] = None  # seconds, when the session is rejected and can be retried
 
     def to_json(self):
         j = self.model_dump(mode="json")
@@ -104,3 +106,21 @@ class LastConversationEvent(MessageEvent):
         j["type"] = self.event_type
         del j["event_type"]
         return j
+
+
+class TranscriptDeltaEvent(MessageEvent):
+    """
+    Transcript of the in progress conversation for clients that connect with `transcript_deltas=true`.
+
+    `transcript_append` carries the segments added after the last one, `transcript_update_last` the
+    last segment again, extended, with the same id, and `transcript_resync` the full transcript on
+    connect. A different `conversation_id` means a new conversation started.
+    """
+    conversation_id: str
+    segments: List[TranscriptSegment]
+
+    def to_json(self):
+        j = self.model_dump(mode="json")
+        j["type"] = self.event_type
+        del j["event_type"]
+        return j
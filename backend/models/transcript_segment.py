@@ -5,6 +5,7 @@ from pydantic import BaseModel, Field
 
 
 class TranscriptSegment(BaseModel):
+    id: Optional[str] = None  # stable for the life of the segment, assigned by the in progress conversation
     text: str
     speaker: Optional[str] = 'SPEAKER_00'
     speaker_id: Optional[int] = None
@@ -26,24 +27,45 @@ class TranscriptSegment(BaseModel):
     def segments_as_string(segments, include_timestamps=False, user_name: str = None):
         if not user_name:
             user_name = 'User'
-        transcript = ''
         include_timestamps = include_timestamps and TranscriptSegment.can_display_seconds(segments)
+        lines = []
         for segment in segments:
             segment_text = segment.text.strip()
             timestamp_str = f'[{segment.get_timestamp_string()}] ' if include_timestamps else ''
-            transcript += f'{timestamp_str}{user_name if segment.is_user else f"Speaker {segment.speaker_id}"}: {segment_text}\n\n'
-        return transcript.strip()
+            lines.append(f'{timestamp_str}{user_name if segment.is_user else f"Speaker {segment.speaker_id}"}: {segment_text}')
+        return '\n\n'.join(lines).strip()
 
     @staticmethod
     def can_display_seconds(segments):
-        for i in range(len(segments)):
-            for j in range(i + 1, len(segments)):
-                if segments[i].start > segments[j].end or segments[i].end > segments[j].start:
-                    return False
+        # Single pass equivalent of comparing every pair: no segment may start or end
+        # before any of the previous ones started or ended.
+        max_start, max_end = float('-inf'), float('-inf')
+        for segment in segments:
+            if max_start > segment.end or max_end > segment.start:
+                return False
+            max_start = max(max_start, segment.start)
+            max_end = max(max_end, segment.end)
         return True
 
+    @staticmethod
+    def clean_text(text: str) -> str:
+        # Speechmatics specific issue with punctuation
+        return (
+            text.strip()
+            .replace('  ', '')
+            .replace(' ,', ',')
+            .replace(' .', '.')
+            .replace(' ?', '?')
+        )
+
     @staticmethod
     def combine_segments(segments: [], new_segments: [], delta_seconds: int = 0):
+        """
+        Merges `new_segments` into `segments` in place.
+
+        Only the segments touched by this call (the extended last one and the appended ones) are normalized,
+        the existing ones were already normalized when they were added, so appending costs O(len(new_segments)).
+        """
         if not new_segments or len(new_segments) == 0:
             return segments
 
@@ -61,6 +83,7 @@ class TranscriptSegment(BaseModel):
             else:
                 joined_similar_segments.append(new_segment)
 
+        touched_from = len(segments)
         if (segments and
                 (segments[-1].speaker == joined_similar_segments[0].speaker or
                  (segments[-1].is_user and joined_similar_segments[0].is_user)) and
@@ -68,18 +91,12 @@ class TranscriptSegment(BaseModel):
             segments[-1].text += f' {joined_similar_segments[0].text}'
             segments[-1].end = joined_similar_segments[0].end
             joined_similar_segments.pop(0)
+            touched_from -= 1
 
         segments.extend(joined_similar_segments)
 
-        # Speechmatics specific issue with punctuation
-        for i, segment in enumerate(segments):
-            segments[i].text = (
-                segments[i].text.strip()
-                .replace('  ', '')
-                .replace(' ,', ',')
-                .replace(' .', '.')
-                .replace(' ?', '?')
-            )
+        for segment in segments[touched_from:]:
+            segment.text = TranscriptSegment.clean_text(segment.text)
         return segments
 
 
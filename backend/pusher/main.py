@@ -5,7 +5,10 @@ import firebase_admin
 from fastapi import FastAPI
 
 from modal import Image, App, asgi_app, Secret
-from routers import pusher
+from routers import pusher, metrics
+from utils.other.circuit_breaker import start_circuit_breakers
+from utils.other.http_fanout import get_http_fanout
+from utils.other.metrics import start_event_loop_lag_monitor
 
 if os.environ.get('SERVICE_ACCOUNT_JSON'):
     service_account_info = json.loads(os.environ["SERVICE_ACCOUNT_JSON"])
@@ -16,6 +19,19 @@ else:
 
 app = FastAPI()
 app.include_router(pusher.router)
+app.include_router(metrics.router)
+
+
+@app.on_event("startup")
+async def startup():
+    start_event_loop_lag_monitor()
+    start_circuit_breakers()
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    await get_http_fanout().close()
+
 
 modal_app = App(
     name='pusher',
@@ -29,7 +29,8 @@ from utils.llm import generate_description, generate_persona_intro_message
 
 from utils.notifications import send_notification
 from utils.other import endpoints as auth
-from models.app import App, ActionType, AppCreate, AppUpdate
+from utils.other.circuit_breaker import get_circuit_status
+from models.app import App, ActionType, AppCreate, AppUpdate, WebhookCircuit
 from utils.other.storage import upload_plugin_logo, delete_plugin_logo, upload_app_thumbnail, get_app_thumbnail_url
 from utils.social import get_twitter_profile, verify_latest_tweet, \
     upsert_persona_from_twitter_profile, add_twitter_to_persona
@@ -340,7 +341,9 @@ def update_app(app_id: str, app_data: str = Form(...), file: UploadFile = File(N
 
     if plugin['approved'] and (plugin['private'] is None or plugin['private'] is False):
         delete_generic_cache('get_public_approved_apps_data')
-    delete_app_cache_by_id(app_id)
+    triggers_on = {(app.get('external_integration') or {}).get('triggers_on') for app in (plugin, data)}
+    audio_bytes_changed = 'external_integration' in data and len(triggers_on) > 1 and 'audio_bytes' in triggers_on
+    delete_app_cache_by_id(app_id, audio_bytes_changed=audio_bytes_changed)
     return {'status': 'ok'}
 
 
@@ -354,7 +357,9 @@ def delete_app(app_id: str, uid: str = Depends(auth.get_current_user_uid)):
     delete_app_from_db(app_id)
     if plugin['approved']:
         delete_generic_cache('get_public_approved_apps_data')
-    delete_app_cache_by_id(app_id)
+    delete_app_cache_by_id(
+        app_id, audio_bytes_changed=(plugin.get('external_integration') or {}).get('triggers_on') == 'audio_bytes',
+    )
     return {'status': 'ok'}
 
 
@@ -384,6 +389,13 @@ def get_app_details(app_id: str, uid: str = Depends(auth.get_current_user_uid)):
             for thumbnail_id in app.thumbnails
         ]
 
+    # whether calls to the webhook are currently skipped
+    if app.uid == uid and app.external_integration and app.external_integration.webhook_url:
+        if status := get_circuit_status(app.external_integration.webhook_url, app.id):
+            if status['open_until']:
+                status['open_until'] = datetime.fromtimestamp(status['open_until'], timezone.utc)
+            app.webhook_circuit = WebhookCircuit(**status)
+
     return app
 
 
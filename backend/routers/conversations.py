@@ -8,7 +8,7 @@ from database.vector_db import delete_vector
 from models.conversation import *
 from models.conversation import SearchRequest
 
-from routers.transcribe_v2 import retrieve_in_progress_conversation
+from utils.conversations.in_progress import retrieve_in_progress_conversation
 from utils.conversations.process_conversation import process_conversation
 from utils.conversations.search import search_conversations
 from utils.other import endpoints as auth
@@ -31,6 +31,7 @@ def process_in_progress_conversation(uid: str = Depends(auth.get_current_user_ui
     if not conversation:
         raise HTTPException(status_code=404, detail="Conversation in progress not found")
     redis_db.remove_in_progress_conversation_id(uid)
+    redis_db.cancel_conversation_finalize(uid, conversation['id'])
 
     conversation = Conversation(**conversation)
     conversations_db.update_conversation_status(uid, conversation.id, ConversationStatus.processing)
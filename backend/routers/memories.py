@@ -13,7 +13,7 @@ from database.vector_db import delete_vector
 from models.conversation import Conversation
 from models.conversation import *
 from routers.speech_profile import expand_speech_profile
-from routers.transcribe_v2 import retrieve_in_progress_conversation
+from utils.conversations.in_progress import retrieve_in_progress_conversation
 from utils.conversations.process_conversation import process_conversation
 from utils.conversations.search import search_conversations
 from utils.other import endpoints as auth
@@ -0,0 +1,50 @@
+import os
+
+from typing import Optional
+
+from fastapi import APIRouter, Header, HTTPException
+from fastapi.responses import PlainTextResponse
+
+from database import redis_db
+from utils.other.metrics import render_metrics
+from utils.stt.listen_session import list_listen_sessions
+from utils.webhook_delivery import list_dead_deliveries
+
+router = APIRouter()
+
+
+@router.get('/metrics', tags=['metrics'], response_class=PlainTextResponse)
+def get_metrics(secret_key: str = Header(...)):
+    if secret_key != os.getenv('ADMIN_KEY'):
+        raise HTTPException(status_code=403, detail='You are not authorized to perform this action')
+    return PlainTextResponse(render_metrics(), media_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+# sync, measuring every session walks their buffers, it runs in the threadpool instead of the event loop
+@router.get('/v1/debug/listen-sessions', tags=['metrics'])
+def get_listen_sessions(secret_key: str = Header(...)):
+    if secret_key != os.getenv('ADMIN_KEY'):
+        raise HTTPException(status_code=403, detail='You are not authorized to perform this action')
+    sessions = list_listen_sessions()
+    return {
+        'count': len(sessions),
+        'total_bytes': sum(session['memory']['total'] for session in sessions),
+        'sessions': sessions,
+    }
+
+
+@router.get('/v1/debug/deliveries', tags=['metrics'])
+def get_deliveries(limit: int = 100, before: Optional[str] = None, secret_key: str = Header(...)):
+    """The queue sizes and the dead lettered deliveries, newest first, page with the last id as `before`."""
+    if secret_key != os.getenv('ADMIN_KEY'):
+        raise HTTPException(status_code=403, detail='You are not authorized to perform this action')
+    return {**redis_db.count_deliveries(), 'dead_deliveries': list_dead_deliveries(min(limit, 1000), before)}
+
+
+@router.post('/v1/debug/deliveries/dead/{entry_id}/retry', tags=['metrics'])
+def retry_dead_delivery(entry_id: str, secret_key: str = Header(...)):
+    if secret_key != os.getenv('ADMIN_KEY'):
+        raise HTTPException(status_code=403, detail='You are not authorized to perform this action')
+    if not redis_db.retry_dead_delivery(entry_id):
+        raise HTTPException(status_code=404, detail='Delivery not found')
+    return {'status': 'ok'}
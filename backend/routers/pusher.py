@@ -1,18 +1,143 @@
 import struct
 import asyncio
 import json
+import time
 
+import msgpack
+import opuslib
 from fastapi import APIRouter
 from fastapi.websockets import WebSocketDisconnect, WebSocket
 from starlette.websockets import WebSocketState
 
-from utils.apps import is_audio_bytes_app_enabled
+from utils.apps_snapshot import AppsSnapshot, register_apps_snapshot, unregister_apps_snapshot
+from utils.other.metrics import Counter, Gauge, Histogram
+from utils.other.timer_wheel import get_timer_wheel
 from utils.plugins import trigger_realtime_integrations, trigger_realtime_audio_bytes
+from utils.pusher import TranscriptFrameDecoder, decode_opus_frame, decode_mux_frame, PUSHER_FRAME_AUDIO, \
+    PUSHER_FRAME_TRANSCRIPT, PUSHER_FRAME_TRANSCRIPT_V2, PUSHER_FRAME_OPUS_V2, PUSHER_FRAME_MUX, PUSHER_FRAME_MUX_OPEN, \
+    PUSHER_FRAME_MUX_CLOSE
 from utils.webhooks import send_audio_bytes_developer_webhook, realtime_transcript_webhook, \
     get_audio_bytes_webhook_seconds
 
 router = APIRouter()
 
+pusher_sessions_active = Gauge('pusher_sessions_active', 'Listen sessions currently open in this container')
+pusher_mux_connections_active = Gauge(
+    'pusher_mux_connections_active', 'Multiplexed trigger websockets currently open in this container',
+)
+pusher_mux_frames_total = Counter(
+    'pusher_mux_frames_total', 'Frames received on the multiplexed websockets: data, open, close, unknown_session',
+    ('type',),
+)
+pusher_frames_total = Counter('pusher_frames_total', 'Frames received from the listen sessions', ('type',))
+pusher_bytes_total = Counter('pusher_bytes_total', 'Bytes received from the listen sessions', ('type',))
+pusher_frame_handle_seconds = Histogram(
+    'pusher_frame_handle_seconds', 'Time to decode and dispatch a frame on the event loop', ('type',),
+    buckets=(0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5),
+)
+pusher_session_seconds = Histogram(
+    'pusher_session_seconds', 'Listen session duration',
+    buckets=(1, 10, 30, 60, 120, 300, 420, 600),
+)
+
+
+def _create_trigger_session(uid: str, sample_rate: int = 8000):
+    """
+    The state of one listen session, on its own websocket or on a multiplexed one.
+
+    Returns (start, handle_frame, close): `start` loads the user's settings, `handle_frame` decodes a
+    frame and dispatches the apps and webhooks without waiting for them.
+    """
+    pusher_sessions_active.inc()
+    session_started_at = time.monotonic()
+    loop = asyncio.get_event_loop()
+
+    # the user's apps, resolved once and rebuilt when they change
+    apps_snapshot = AppsSnapshot(uid)
+    register_apps_snapshot(apps_snapshot)
+
+    async def trigger_realtime_integrations_with_snapshot(segments, memory_id):
+        snapshot = await apps_snapshot.get()
+        if snapshot.realtime:
+            await trigger_realtime_integrations(uid, segments, memory_id, apps=snapshot.realtime)
+
+    async def trigger_realtime_audio_bytes_with_snapshot(data):
+        snapshot = await apps_snapshot.get()
+        if snapshot.audio_bytes:
+            await trigger_realtime_audio_bytes(uid, sample_rate, data, apps=snapshot.audio_bytes)
+
+    # audio bytes
+    audio_bytes_webhook_delay_seconds = None
+    audio_bytes_trigger_delay_seconds = 5
+
+    audiobuffer = bytearray()
+    trigger_audiobuffer = bytearray()
+    transcript_decoder = TranscriptFrameDecoder()
+    opus_decoder = None
+    frame_types = (PUSHER_FRAME_AUDIO, PUSHER_FRAME_TRANSCRIPT, PUSHER_FRAME_TRANSCRIPT_V2, PUSHER_FRAME_OPUS_V2)
+
+    async def start():
+        nonlocal audio_bytes_webhook_delay_seconds
+        await apps_snapshot.get()
+        audio_bytes_webhook_delay_seconds = await asyncio.to_thread(get_audio_bytes_webhook_seconds, uid)
+
+    def handle_frame(data: bytes):
+        nonlocal audiobuffer
+        nonlocal trigger_audiobuffer
+        nonlocal opus_decoder
+
+        header_type = struct.unpack('<I', data[:4])[0]
+        handle_start = time.monotonic()
+        frame_type = header_type if header_type in frame_types else 'other'
+        pusher_frames_total.labels(type=frame_type).inc()
+        pusher_bytes_total.labels(type=frame_type).inc(len(data))
+
+        # Transcript
+        if header_type in (PUSHER_FRAME_TRANSCRIPT, PUSHER_FRAME_TRANSCRIPT_V2):
+            if header_type == PUSHER_FRAME_TRANSCRIPT_V2:
+                segments, memory_id = transcript_decoder.decode(data[4:])
+            else:
+                res = json.loads(bytes(data[4:]).decode("utf-8"))
+                segments = res.get('segments')
+                memory_id = res.get('memory_id')
+            if not segments:
+                return
+            asyncio.run_coroutine_threadsafe(trigger_realtime_integrations_with_snapshot(segments, memory_id), loop)
+            asyncio.run_coroutine_threadsafe(realtime_transcript_webhook(uid, segments), loop)
+            pusher_frame_handle_seconds.labels(type=header_type).observe(time.monotonic() - handle_start)
+            return
+
+        # Audio bytes
+        if header_type in (PUSHER_FRAME_AUDIO, PUSHER_FRAME_OPUS_V2):
+            if header_type == PUSHER_FRAME_OPUS_V2:
+                packets, packets_sample_rate = decode_opus_frame(data[4:])
+                if opus_decoder is None:
+                    opus_decoder = opuslib.Decoder(packets_sample_rate, 1)
+                pcm = b''.join(opus_decoder.decode(packet, frame_size=160) for packet in packets)
+            else:
+                pcm = data[4:]
+            audiobuffer.extend(pcm)
+            trigger_audiobuffer.extend(pcm)
+            if len(trigger_audiobuffer) > sample_rate * audio_bytes_trigger_delay_seconds * 2:
+                if apps_snapshot.audio_bytes or apps_snapshot.stale:
+                    asyncio.run_coroutine_threadsafe(
+                        trigger_realtime_audio_bytes_with_snapshot(trigger_audiobuffer.copy()), loop)
+                trigger_audiobuffer = bytearray()
+            if audio_bytes_webhook_delay_seconds and len(
+                    audiobuffer) > sample_rate * audio_bytes_webhook_delay_seconds * 2:
+                asyncio.run_coroutine_threadsafe(
+                    send_audio_bytes_developer_webhook(uid, sample_rate, audiobuffer.copy()), loop)
+                audiobuffer = bytearray()
+            pusher_frame_handle_seconds.labels(type=header_type).observe(time.monotonic() - handle_start)
+            return
+
+    def close():
+        unregister_apps_snapshot(apps_snapshot)
+        pusher_sessions_active.dec()
+        pusher_session_seconds.observe(time.monotonic() - session_started_at)
+
+    return start, handle_frame, close
+
 
 async def _websocket_util_trigger(
         websocket: WebSocket, uid: str, sample_rate: int = 8000,
@@ -29,90 +154,168 @@ async def _websocket_util_trigger(
     websocket_active = True
     websocket_close_code = 1000
 
-    # heart beat
+    # heart beat, on the process timer wheel
     async def send_heartbeat():
-        print("pusher send_heartbeat", uid)
         nonlocal websocket_active
         nonlocal websocket_close_code
         try:
-            while websocket_active:
-                if websocket.client_state == WebSocketState.CONNECTED:
-                    await websocket.send_json({"type": "ping"})
-                else:
-                    break
-                await asyncio.sleep(10)
+            if websocket_active and websocket.client_state == WebSocketState.CONNECTED:
+                await websocket.send_json({"type": "ping"})
+                return
         except WebSocketDisconnect:
             print("WebSocket disconnected")
         except Exception as e:
             print(f'Heartbeat error: {e}')
             websocket_close_code = 1011
-        finally:
-            websocket_active = False
+        heartbeat_timer.cancel()
+        websocket_active = False
 
     # start heart beat
-    heartbeat_task = asyncio.create_task(send_heartbeat())
+    print("pusher send_heartbeat", uid)
+    heartbeat_timer = get_timer_wheel().schedule(0, send_heartbeat, interval=10)
 
-    loop = asyncio.get_event_loop()
-
-    # audio bytes
-    audio_bytes_webhook_delay_seconds = get_audio_bytes_webhook_seconds(uid)
-    audio_bytes_trigger_delay_seconds = 5
-    has_audio_apps_enabled = is_audio_bytes_app_enabled(uid)
+    session_start, handle_frame, session_close = _create_trigger_session(uid, sample_rate)
 
     # task
     async def receive_audio_bytes():
         nonlocal websocket_active
         nonlocal websocket_close_code
 
-        audiobuffer = bytearray()
-        trigger_audiobuffer = bytearray()
+        try:
+            while websocket_active:
+                handle_frame(await websocket.receive_bytes())
+
+        except WebSocketDisconnect:
+            print("WebSocket disconnected")
+        except Exception as e:
+            print(f'Could not process audio: error {e}')
+            websocket_close_code = 1011
+        finally:
+            websocket_active = False
+
+    try:
+        await session_start()
+        receive_task = asyncio.create_task(receive_audio_bytes())
+        await receive_task
+
+    except Exception as e:
+        print(f"Error during WebSocket operation: {e}")
+    finally:
+        websocket_active = False
+        heartbeat_timer.cancel()
+        session_close()
+        if websocket.client_state == WebSocketState.CONNECTED:
+            try:
+                await websocket.close(code=websocket_close_code)
+            except Exception as e:
+                print(f"Error closing WebSocket: {e}")
+
+
+async def _websocket_util_trigger_mux(websocket: WebSocket):
+    print('_websocket_util_trigger_mux')
+
+    try:
+        await websocket.accept()
+    except RuntimeError as e:
+        print(e)
+        await websocket.close(code=1011, reason="Dirty state")
+        return
+
+    websocket_active = True
+    websocket_close_code = 1000
+    pusher_mux_connections_active.inc()
+
+    # one heart beat for all the sessions
+    async def send_heartbeat():
+        nonlocal websocket_active
+        nonlocal websocket_close_code
+        try:
+            if websocket_active and websocket.client_state == WebSocketState.CONNECTED:
+                await websocket.send_json({"type": "ping"})
+                return
+        except WebSocketDisconnect:
+            print("WebSocket disconnected")
+        except Exception as e:
+            print(f'Heartbeat error: {e}')
+            websocket_close_code = 1011
+        heartbeat_timer.cancel()
+        websocket_active = False
+
+    heartbeat_timer = get_timer_wheel().schedule(0, send_heartbeat, interval=10)
+
+    # session id -> (start, handle_frame, close), the ids are the backend's, unique on this connection
+    sessions = {}
+
+    async def start_session(session_id, session_start):
+        try:
+            await session_start()
+        except Exception as e:
+            print(f'Could not start mux session {session_id}: {e}')
+
+    def close_session(session_id):
+        if session := sessions.pop(session_id, None):
+            session[2]()
+
+    async def receive_frames():
+        nonlocal websocket_active
+        nonlocal websocket_close_code
 
         try:
             while websocket_active:
-                data = await websocket.receive_bytes()
-                header_type = struct.unpack('<I', data[:4])[0]
-
-                # Transcript
-                if header_type == 102:
-                    res = json.loads(bytes(data[4:]).decode("utf-8"))
-                    segments = res.get('segments')
-                    memory_id = res.get('memory_id')
-                    asyncio.run_coroutine_threadsafe(trigger_realtime_integrations(uid, segments, memory_id), loop)
-                    asyncio.run_coroutine_threadsafe(realtime_transcript_webhook(uid, segments), loop)
+                header_type, session_id, payload = decode_mux_frame(await websocket.receive_bytes())
+
+                if header_type == PUSHER_FRAME_MUX:
+                    session = sessions.get(session_id)
+                    if session is None:
+                        pusher_mux_frames_total.labels(type='unknown_session').inc()
+                        continue
+                    pusher_mux_frames_total.labels(type='data').inc()
+                    try:
+                        session[1](payload)
+                    except Exception as e:
+                        # only this session, the backend opens it again with its next frame
+                        print(f'Could not process mux session {session_id} frame: error {e}')
+                        close_session(session_id)
+                        await websocket.send_json({"type": "session_closed", "session": session_id})
+                    continue
+
+                if header_type == PUSHER_FRAME_MUX_OPEN:
+                    pusher_mux_frames_total.labels(type='open').inc()
+                    close_session(session_id)
+                    params = msgpack.unpackb(payload, raw=False)
+                    session = sessions[session_id] = _create_trigger_session(params['uid'], params['sample_rate'])
+                    # frames coming meanwhile are handled, the apps are resolved on the first trigger
+                    asyncio.create_task(start_session(session_id, session[0]))
                     continue
 
-                # Audio bytes
-                if header_type == 101:
-                    audiobuffer.extend(data[4:])
-                    trigger_audiobuffer.extend(data[4:])
-                    if has_audio_apps_enabled and len(
-                            trigger_audiobuffer) > sample_rate * audio_bytes_trigger_delay_seconds * 2:
-                        asyncio.run_coroutine_threadsafe(
-                            trigger_realtime_audio_bytes(uid, sample_rate, trigger_audiobuffer.copy()), loop)
-                        trigger_audiobuffer = bytearray()
-                    if audio_bytes_webhook_delay_seconds and len(
-                            audiobuffer) > sample_rate * audio_bytes_webhook_delay_seconds * 2:
-                        asyncio.run_coroutine_threadsafe(
-                            send_audio_bytes_developer_webhook(uid, sample_rate, audiobuffer.copy()), loop)
-                        audiobuffer = bytearray()
+                if header_type == PUSHER_FRAME_MUX_CLOSE:
+                    pusher_mux_frames_total.labels(type='close').inc()
+                    close_session(session_id)
                     continue
 
+                pusher_mux_frames_total.labels(type='other').inc()
+
         except WebSocketDisconnect:
             print("WebSocket disconnected")
         except Exception as e:
-            print(f'Could not process audio: error {e}')
+            print(f'Could not process mux frames: error {e}')
             websocket_close_code = 1011
         finally:
             websocket_active = False
 
     try:
-        receive_task = asyncio.create_task(receive_audio_bytes())
-        await asyncio.gather(receive_task, heartbeat_task)
+        receive_task = asyncio.create_task(receive_frames())
+        await receive_task
 
     except Exception as e:
         print(f"Error during WebSocket operation: {e}")
     finally:
         websocket_active = False
+        heartbeat_timer.cancel()
+        print('_websocket_util_trigger_mux closed with', len(sessions), 'sessions')
+        for session_id in list(sessions):
+            close_session(session_id)
+        pusher_mux_connections_active.dec()
         if websocket.client_state == WebSocketState.CONNECTED:
             try:
                 await websocket.close(code=websocket_close_code)
@@ -125,3 +328,8 @@ async def websocket_endpoint_trigger(
         websocket: WebSocket, uid: str, sample_rate: int = 8000,
 ):
     await _websocket_util_trigger(websocket, uid, sample_rate)
+
+
+@router.websocket("/v1/trigger/listen/mux")
+async def websocket_endpoint_trigger_mux(websocket: WebSocket):
+    await _websocket_util_trigger_mux(websocket)
@@ -13,7 +13,7 @@ from utils.other import endpoints as auth
 from utils.other.storage import upload_profile_audio, get_profile_audio_if_exists, get_conversation_recording_if_exists, \
     upload_additional_profile_audio, delete_additional_profile_audio, get_additional_profile_recordings, \
     upload_user_person_speech_sample, delete_user_person_speech_sample, get_user_person_speech_samples, \
-    delete_speech_sample_for_people, get_user_has_speech_profile
+    delete_speech_sample_for_people, get_user_has_speech_profile, invalidate_cached_profile_audio
 from utils.stt.vad import apply_vad_for_speech_profile
 
 router = APIRouter()
@@ -63,6 +63,7 @@ def upload_profile(file: UploadFile, uid: str = Depends(auth.get_current_user_ui
     apply_vad_for_speech_profile(file_path)
     url = upload_profile_audio(file_path, uid)
     remove_user_soniox_speech_profile(uid)
+    invalidate_cached_profile_audio(uid)
     return {"url": url}
 
 
@@ -1,37 +1,56 @@
 import os
-import uuid
 import asyncio
 import struct
-from datetime import datetime, timezone, timedelta, time
+from datetime import datetime, timezone, time
 from enum import Enum
+from typing import Optional
 
 import opuslib
-import webrtcvad
 from fastapi import APIRouter, Depends
 from fastapi.websockets import WebSocketDisconnect, WebSocket
-from pydub import AudioSegment
 from starlette.websockets import WebSocketState
 
 import database.conversations as conversations_db
-import database.users as user_db
 from database import redis_db
 from database.redis_db import get_cached_user_geolocation
-from models.conversation import Conversation, TranscriptSegment, ConversationStatus, Structured, Geolocation
-from models.message_event import ConversationEvent, MessageEvent, MessageServiceStatusEvent, LastConversationEvent
-from utils.apps import is_audio_bytes_app_enabled
+from models.conversation import Conversation, TranscriptSegment, ConversationStatus, Geolocation
+from models.message_event import ConversationEvent, MessageEvent, MessageServiceStatusEvent, LastConversationEvent, \
+    TranscriptDeltaEvent
+from utils.conversations.finalize import claim_conversation_finalize, complete_conversation_finalize
+from utils.conversations.in_progress import InProgressConversationStore, \
+    conversation_creation_timeout as in_progress_creation_timeout
 from utils.conversations.location import get_google_maps_location
+from utils.conversations.session_descriptor import get_listen_session_descriptor
 from utils.conversations.process_conversation import process_conversation
 from utils.plugins import trigger_external_integrations
 from utils.stt.streaming import *
-from utils.stt.streaming import process_audio_soniox, process_audio_dg, process_audio_speechmatics, send_initial_file_path
-from utils.webhooks import get_audio_bytes_webhook_seconds
-from utils.pusher import connect_to_trigger_pusher
+from utils.stt.streaming import process_audio_soniox, process_audio_dg, process_audio_speechmatics, send_initial_file_path, \
+    stt_opus_passthrough_enabled, stt_opus_packets_per_page
+from utils.stt.ogg_opus import OggOpusWriter, opus_packet_samples
+from utils.stt.speech_gate import SpeechGate, speech_gate_enabled
+from utils.stt.admission import listen_admission
+from utils.stt.audio_stage import AudioStage
+from utils.stt.listen_session import ListenSession, register_listen_session, unregister_listen_session
+from utils.stt.metrics import ListenSessionMetrics
+from utils.pusher import connect_to_trigger_pusher, pusher_protocol_version, pusher_opus_audio, \
+    TranscriptFrameEncoder, encode_opus_frame
+from utils.pusher_mux import get_pusher_mux, pusher_multiplex
 
 from utils.other import endpoints as auth
-from utils.other.storage import get_profile_audio_if_exists
+from utils.other.buffers import SPILL, new_pusher_audio_buffer, new_pusher_audio_packet_buffer, \
+    new_pusher_segment_buffer, new_realtime_segment_buffer, pusher_audio_max_frame_bytes
+from utils.other.flush import FlushSignal
+from utils.other.storage import get_cached_profile_audio
+from utils.other.timer_wheel import Timer, get_timer_wheel
+from utils.other.websocket_writer import WebSocketWriter
 
 router = APIRouter()
 
+# Minimum spacing between two flushes of the listen consumers, data is flushed as soon as it arrives otherwise
+transcript_min_batch_seconds = float(os.getenv('LISTEN_TRANSCRIPT_MIN_BATCH_SECONDS', 0.1))
+pusher_transcript_min_batch_seconds = float(os.getenv('PUSHER_TRANSCRIPT_MIN_BATCH_SECONDS', 1))
+pusher_audio_min_batch_seconds = float(os.getenv('PUSHER_AUDIO_MIN_BATCH_SECONDS', 1))
+
 class STTService(str, Enum):
     deepgram = "deepgram"
     soniox = "soniox"
@@ -49,23 +68,10 @@ class STTService(str, Enum):
             return 'speechmatics_streaming'
 
 
-def retrieve_in_progress_conversation(uid):
-    conversation_id = redis_db.get_in_progress_conversation_id(uid)
-    existing = None
-
-    if conversation_id:
-        existing = conversations_db.get_conversation(uid, conversation_id)
-        if existing and existing['status'] != 'in_progress':
-            existing = None
-
-    if not existing:
-        existing = conversations_db.get_in_progress_conversation(uid)
-    return existing
-
-
 async def _listen(
         websocket: WebSocket, uid: str, language: str = 'en', sample_rate: int = 8000, codec: str = 'pcm8',
-        channels: int = 1, include_speech_profile: bool = True, stt_service: STTService = STTService.soniox
+        channels: int = 1, include_speech_profile: bool = True, stt_service: STTService = STTService.soniox,
+        session: Optional[ListenSession] = None, transcript_deltas: bool = False,
 ):
 
     print('_listen', uid, language, sample_rate, codec, include_speech_profile)
@@ -78,6 +84,11 @@ async def _listen(
     # if stt_service == STTService.soniox and language not in soniox_valid_languages:
     stt_service = STTService.deepgram
 
+    # Owned state, measured by the debug endpoint
+    if session is None:
+        session = ListenSession(uid, language, sample_rate, codec, stt_service.value)
+    session.stt_service = stt_service.value
+
     try:
         await websocket.accept()
     except RuntimeError as e:
@@ -88,87 +99,98 @@ async def _listen(
     websocket_active = True
     websocket_close_code = 1001  # Going Away, don't close with good from backend
 
-    async def _asend_message_event(msg: MessageEvent):
+    # Event driven consumers, woken up on close so they can drain and exit
+    flush_signals: List[FlushSignal] = []
+
+    def _wake_consumers():
+        for signal in flush_signals:
+            signal.notify()
+
+    # Every frame to the client goes through the writer, in order
+    def _on_writer_error(code: int):
         nonlocal websocket_active
+        nonlocal websocket_close_code
+        websocket_close_code = code
+        websocket_active = False
+        _wake_consumers()
+
+    outbound = session.outbound = WebSocketWriter(websocket, uid, on_error=_on_writer_error)
+    outbound.start()
+
+    def _send_message_event(msg: MessageEvent) -> bool:
         print(f"Message: type ${msg.event_type}", uid)
         if not websocket_active:
             return False
-        try:
-            await websocket.send_json(msg.to_json())
-            return True
-        except WebSocketDisconnect:
-            print("WebSocket disconnected", uid)
-            websocket_active = False
-        except RuntimeError as e:
-            print(f"Can not send message event, error: {e}", uid)
+        return outbound.send_event(msg.to_json())
 
-        return False
-
-    def _send_message_event(msg: MessageEvent):
-        return asyncio.create_task(_asend_message_event(msg))
+    # Delta transcript protocol, every tick, not logged
+    def _send_transcript_delta(event_type: str, conversation_id: str, segments: List[dict]) -> bool:
+        if not websocket_active:
+            return False
+        return outbound.send_event(
+            TranscriptDeltaEvent(event_type=event_type, conversation_id=conversation_id, segments=segments).to_json()
+        )
 
     # Heart beat
-    started_at = time.time()
     timeout_seconds = 420  # 7m # Soft timeout, should < MODAL_TIME_OUT - 3m
     has_timeout = os.getenv('NO_SOCKET_TIMEOUT') is None
 
+    # Session deadlines live on the process timer wheel, not in a sleeping task per session
+    timers = get_timer_wheel()
+
     # Send pong every 10s then handle it in the app \
     # since Starlette is not support pong automatically
-    async def send_heartbeat():
-        print("send_heartbeat", uid)
+    def send_heartbeat():
         nonlocal websocket_active
-        nonlocal websocket_close_code
-        nonlocal started_at
-
-        try:
-            while websocket_active:
-                # ping fast
-                if websocket.client_state == WebSocketState.CONNECTED:
-                    await websocket.send_text("ping")
-                else:
-                    break
-
-                # timeout
-                if has_timeout and time.time() - started_at >= timeout_seconds:
-                    print(f"Session timeout is hit by soft timeout {timeout_seconds}", uid)
-                    websocket_close_code = 1001
-                    websocket_active = False
-                    break
+        # ping fast
+        if websocket_active and websocket.client_state == WebSocketState.CONNECTED and outbound.send_ping():
+            return
+        heartbeat_timer.cancel()
+        websocket_active = False
+        _wake_consumers()
 
-                # next
-                await asyncio.sleep(10)
-        except WebSocketDisconnect:
-            print("WebSocket disconnected", uid)
-        except Exception as e:
-            print(f'Heartbeat error: {e}', uid)
-            websocket_close_code = 1011
-        finally:
-            websocket_active = False
+    def _on_soft_timeout():
+        nonlocal websocket_active
+        nonlocal websocket_close_code
+        if not websocket_active:
+            return
+        print(f"Session timeout is hit by soft timeout {timeout_seconds}", uid)
+        websocket_close_code = 1001
+        websocket_active = False
+        _wake_consumers()
 
     # Start heart beat
-    heartbeat_task = asyncio.create_task(send_heartbeat())
+    print("send_heartbeat", uid)
+    heartbeat_timer = timers.schedule(0, send_heartbeat, interval=10)
+    soft_timeout_timer = timers.schedule(timeout_seconds, _on_soft_timeout) if has_timeout else None
+
+    def _cancel_session_timers():
+        heartbeat_timer.cancel()
+        if soft_timeout_timer:
+            soft_timeout_timer.cancel()
 
     _send_message_event(MessageServiceStatusEvent(event_type="service_status", status="initiating", status_text="Service Starting"))
 
-    # Validate user
-    if not user_db.is_exists_user(uid):
+    # Validate user, the descriptor answers every connect time lookup in one redis round trip when cached
+    descriptor = await asyncio.to_thread(get_listen_session_descriptor, uid)
+    if not descriptor:
         websocket_active = False
+        _cancel_session_timers()
+        await outbound.close()
         await websocket.close(code=1008, reason="Bad user")
         return
 
-    # Stream transcript
-    async def _trigger_create_conversation_with_delay(delay_seconds: int, finished_at: datetime):
-        try:
-            await asyncio.sleep(delay_seconds)
+    # In progress conversation, firestore is only written on checkpoints
+    in_progress_store = session.in_progress_store = InProgressConversationStore(uid, language)
 
-            # recheck session
-            conversation = retrieve_in_progress_conversation(uid)
-            if not conversation or conversation['finished_at'] > finished_at:
-                print("_trigger_create_conversation_with_delay not conversation or not last session", uid)
-                return
-            await _create_current_conversation()
-        except asyncio.CancelledError:
-            pass
+    # Stream transcript
+    async def _trigger_create_conversation(finished_at: datetime):
+        # recheck session
+        conversation = in_progress_store.get()
+        if not conversation or conversation.finished_at > finished_at:
+            print("_trigger_create_conversation not conversation or not last session", uid)
+            return
+        await _create_current_conversation()
 
     async def _create_conversation(conversation: dict):
         conversation = Conversation(**conversation)
@@ -185,6 +207,7 @@ async def _listen(
                 conversation.geolocation = get_google_maps_location(geolocation.latitude, geolocation.longitude)
 
             conversation = process_conversation(uid, language, conversation)
+            redis_db.remove_in_progress_conversation_segments(uid, conversation.id)
             messages = trigger_external_integrations(uid, conversation)
         except Exception as e:
             print(f"Error processing conversation: {e}", uid)
@@ -194,58 +217,85 @@ async def _listen(
 
         _send_message_event(ConversationEvent(event_type="memory_created", memory=conversation, messages=messages))
 
-    async def finalize_processing_memories(processing: List[dict]):
+    async def finalize_processing_memories(processing_ids: List[str]):
         # handle edge case of conversation was actually processing? maybe later, doesn't hurt really anyway.
         # also fix from getMemories endpoint?
+        if not processing_ids:
+            return
+        processing = [
+            conversation for conversation in conversations_db.get_conversations_by_id(uid, processing_ids)
+            if conversation['status'] == ConversationStatus.processing
+        ]
         print('finalize_processing_memories len(processing):', len(processing), uid)
         for conversation in processing:
             await _create_conversation(conversation)
 
     # Process processing conversations
-    processing = conversations_db.get_processing_conversations(uid)
-    asyncio.create_task(finalize_processing_memories(processing))
+    asyncio.create_task(finalize_processing_memories(descriptor['processing_ids']))
 
     # Send last completed conversation to client
     async def send_last_conversation():
-        last_conversation = conversations_db.get_last_completed_conversation(uid)
-        if last_conversation:
-            await _send_message_event(LastConversationEvent(memory_id=last_conversation['id']))
+        if descriptor['last_completed_id']:
+            _send_message_event(LastConversationEvent(memory_id=descriptor['last_completed_id']))
     asyncio.create_task(send_last_conversation())
 
     async def _create_current_conversation():
         print("_create_current_conversation", uid)
-
-        # Reset state variables
         nonlocal seconds_to_trim
         nonlocal seconds_to_add
+
+        conversation = in_progress_store.get()
+        claimed = False
+        if conversation and conversation.transcript_segments:
+            # the shared scheduler may be finalizing it already
+            claimed, due_in_seconds = await asyncio.to_thread(claim_conversation_finalize, uid, conversation.id)
+            if due_in_seconds is not None:
+                print("_create_current_conversation not due yet", conversation.id, due_in_seconds, uid)
+                _schedule_conversation_creation(due_in_seconds, conversation.finished_at)
+                return
+
+        # Reset state variables
         seconds_to_trim = None
         seconds_to_add = None
 
-        conversation = retrieve_in_progress_conversation(uid)
-        if not conversation or not conversation['transcript_segments']:
+        if not conversation or not conversation.transcript_segments:
             return
-        await _create_conversation(conversation)
-
-    conversation_creation_task_lock = asyncio.Lock()
-    conversation_creation_task = None
+        if not claimed:
+            print("_create_current_conversation claimed by another backend", conversation.id, uid)
+            in_progress_store.reset()
+            return
+        in_progress_store.checkpoint(force=True)
+        in_progress_store.reset()
+        redis_db.remove_in_progress_conversation_id(uid)
+        await _create_conversation(conversation.dict())
+        complete_conversation_finalize(uid, conversation.id)
+
+    # Outlives the session on purpose, the conversation is still created after a disconnect
+    conversation_creation_timer: Optional[Timer] = None
     seconds_to_trim = None
     seconds_to_add = None
 
-    conversation_creation_timeout = 120
+    conversation_creation_timeout = in_progress_creation_timeout
+
+    def _schedule_conversation_creation(delay_seconds: float, finished_at: datetime):
+        nonlocal conversation_creation_timer
+        if conversation_creation_timer is None:
+            conversation_creation_timer = timers.schedule(delay_seconds, _trigger_create_conversation, finished_at)
+        else:
+            conversation_creation_timer.reschedule(delay_seconds, finished_at)
 
     # Process existing conversations
     def _process_in_progess_memories():
-        nonlocal conversation_creation_task
         nonlocal seconds_to_add
         nonlocal conversation_creation_timeout
         # Determine previous disconnected socket seconds to add + start processing timer if a conversation in progress
-        if existing_conversation := retrieve_in_progress_conversation(uid):
+        if existing_conversation := descriptor['in_progress']:
             # segments seconds alignment
-            started_at = datetime.fromisoformat(existing_conversation['started_at'].isoformat())
+            started_at = datetime.fromisoformat(existing_conversation['started_at'])
             seconds_to_add = (datetime.now(timezone.utc) - started_at).total_seconds()
 
             # processing if needed logic
-            finished_at = datetime.fromisoformat(existing_conversation['finished_at'].isoformat())
+            finished_at = datetime.fromisoformat(existing_conversation['finished_at'])
             seconds_since_last_segment = (datetime.now(timezone.utc) - finished_at).total_seconds()
             if seconds_since_last_segment >= conversation_creation_timeout:
                 print('_websocket_util processing existing_conversation', existing_conversation['id'], seconds_since_last_segment, uid)
@@ -253,56 +303,27 @@ async def _listen(
             else:
                 print('_websocket_util will process', existing_conversation['id'], 'in',
                       conversation_creation_timeout - seconds_since_last_segment, 'seconds')
-                conversation_creation_task = asyncio.create_task(
-                    _trigger_create_conversation_with_delay(conversation_creation_timeout - seconds_since_last_segment, finished_at)
-                )
+                _schedule_conversation_creation(conversation_creation_timeout - seconds_since_last_segment, finished_at)
 
     _send_message_event(MessageServiceStatusEvent(status="in_progress_memories_processing", status_text="Processing Memories"))
     _process_in_progess_memories()
 
-    def _get_or_create_in_progress_conversation(segments: List[dict]):
-        if existing := retrieve_in_progress_conversation(uid):
-            conversation = Conversation(**existing)
-            conversation.transcript_segments = TranscriptSegment.combine_segments(
-                conversation.transcript_segments, [TranscriptSegment(**segment) for segment in segments]
-            )
-            redis_db.set_in_progress_conversation_id(uid, conversation.id)
-            # current_conversation_id = conversation.id
-            return conversation
-
-        started_at = datetime.now(timezone.utc) - timedelta(seconds=segments[0]['end'] - segments[0]['start'])
-        conversation = Conversation(
-            id=str(uuid.uuid4()),
-            uid=uid,
-            structured=Structured(),
-            language=language,
-            created_at=started_at,
-            started_at=started_at,
-            finished_at=datetime.now(timezone.utc),
-            transcript_segments=[TranscriptSegment(**segment) for segment in segments],
-            status=ConversationStatus.in_progress,
-        )
-        print('_get_in_progress_conversation new', conversation, uid)
-        conversations_db.upsert_conversation(uid, conversation_data=conversation.dict())
-        redis_db.set_in_progress_conversation_id(uid, conversation.id)
-        return conversation
-
-    async def create_conversation_on_segment_received_task(finished_at: datetime):
-        nonlocal conversation_creation_task
-        async with conversation_creation_task_lock:
-            if conversation_creation_task is not None:
-                conversation_creation_task.cancel()
-                try:
-                    await conversation_creation_task
-                except asyncio.CancelledError:
-                    print("conversation_creation_task is cancelled now", uid)
-            conversation_creation_task = asyncio.create_task(
-                _trigger_create_conversation_with_delay(conversation_creation_timeout, finished_at))
+    # Reconnected delta clients get the transcript so far once, then only deltas
+    if transcript_deltas and descriptor['in_progress']:
+        try:
+            if conversation := await asyncio.to_thread(in_progress_store.get):
+                _send_transcript_delta(
+                    'transcript_resync', conversation.id, [s.dict() for s in conversation.transcript_segments]
+                )
+        except Exception as e:
+            print(f'transcript_resync failed: {e}', uid)
 
     # STT
     # Validate websocket_active before initiating STT
     if not websocket_active or websocket.client_state != WebSocketState.CONNECTED:
         print("websocket was closed", uid)
+        _cancel_session_timers()
+        await outbound.close()
         if websocket.client_state == WebSocketState.CONNECTED:
             try:
                 await websocket.close(code=websocket_close_code)
@@ -318,11 +339,37 @@ async def _listen(
     deepgram_socket2 = None
     speech_profile_duration = 0
 
-    realtime_segment_buffers = []
+    # Instrumentation, exposed on /metrics
+    session_metrics = session.metrics = ListenSessionMetrics(sample_rate, stt_service.value, codec)
+
+    # Speech gating, silent audio is not streamed to the STT provider
+    speech_gate = None
+    if speech_gate_enabled and sample_rate in (8000, 16000) and \
+            (codec in ('pcm8', 'pcm16') or (codec == 'opus' and sample_rate == 16000)):
+        speech_gate = session.speech_gate = SpeechGate(sample_rate)
+
+    # Audio bytes apps / webhooks, the pusher can take the opus packets as is with the compact protocol
+    audio_bytes_enabled = bool(descriptor['audio_bytes_webhook_seconds']) or descriptor['audio_bytes_app_enabled']
+    pusher_audio_opus = pusher_protocol_version >= 2 and pusher_opus_audio and codec == 'opus' and sample_rate == 16000
+
+    # Opus passthrough, the client packets go to deepgram as is and are only decoded for the pcm consumers:
+    # speech gating, the speech profile priming (sent as pcm on the same socket) and pcm audio bytes
+    opus_passthrough = False
+    ogg_writer = None
+
+    realtime_segment_buffers = session.realtime_segments = new_realtime_segment_buffer()
+    realtime_segment_flush = FlushSignal(transcript_min_batch_seconds)
+    flush_signals.append(realtime_segment_flush)
 
     def stream_transcript(segments):
-        nonlocal realtime_segment_buffers
+        if speech_gate is not None:
+            # provider timestamps only count the forwarded audio
+            for segment in segments:
+                segment['start'] = speech_gate.to_audio_seconds(segment['start'])
+                segment['end'] = speech_gate.to_audio_seconds(segment['end'])
+        session_metrics.on_stt_segments()
         realtime_segment_buffers.extend(segments)
+        realtime_segment_flush.notify()
 
     async def _process_stt():
         nonlocal websocket_close_code
@@ -331,43 +378,66 @@ async def _listen(
         nonlocal deepgram_socket
         nonlocal deepgram_socket2
         nonlocal speech_profile_duration
+        nonlocal opus_passthrough
+        nonlocal ogg_writer
+        nonlocal speech_gate
+
+        async def _prime_speech_profile(send):
+            session_metrics.on_speech_profile_primed(await send_initial_file_path(file_path, send))
+
         try:
             file_path, speech_profile_duration = None, 0
             # Thougts: how bee does for recognizing other languages speech profile?
             if language == 'en' and (codec == 'opus' or codec == 'pcm16') and include_speech_profile:
-                file_path = get_profile_audio_if_exists(uid)
-                speech_profile_duration = AudioSegment.from_wav(file_path).duration_seconds + 5 if file_path else 0
+                file_path, duration = await asyncio.to_thread(get_cached_profile_audio, uid)
+                speech_profile_duration = duration + 5 if file_path else 0
+            # the profile splits the audio over two deepgram sockets, each with its own timeline
+            if speech_profile_duration and speech_gate is not None:
+                speech_gate = session.speech_gate = None
 
             # DEEPGRAM
             if stt_service == STTService.deepgram:
+                opus_passthrough = stt_opus_passthrough_enabled and codec == 'opus' and sample_rate == 16000 \
+                    and speech_gate is None and not speech_profile_duration \
+                    and (not audio_bytes_enabled or pusher_audio_opus)
                 deepgram_socket = await process_audio_dg(
-                    stream_transcript, language, sample_rate, 1, preseconds=speech_profile_duration
+                    stream_transcript, language, sample_rate, 1, preseconds=speech_profile_duration,
+                    encoding='ogg-opus' if opus_passthrough else 'linear16',
                 )
+                session_metrics.on_stt_socket_opened()
+                if opus_passthrough:
+                    ogg_writer = session.ogg_writer = OggOpusWriter(sample_rate, packets_per_page=stt_opus_packets_per_page)
+                    deepgram_socket.send(ogg_writer.header())
                 if speech_profile_duration:
                     deepgram_socket2 = await process_audio_dg(stream_transcript, language, sample_rate, 1)
+                    session_metrics.on_stt_socket_opened()
 
                     async def deepgram_socket_send(data):
                         return deepgram_socket.send(data)
 
-                    asyncio.create_task(send_initial_file_path(file_path, deepgram_socket_send))
+                    asyncio.create_task(_prime_speech_profile(deepgram_socket_send))
             # SONIOX
             elif stt_service == STTService.soniox:
                 soniox_socket = await process_audio_soniox(
                     stream_transcript, sample_rate, language,
                     uid if include_speech_profile else None
                 )
+                session_metrics.on_stt_socket_opened()
             # SPEECHMATICS
             elif stt_service == STTService.speechmatics:
                 speechmatics_socket = await process_audio_speechmatics(
                     stream_transcript, sample_rate, language, preseconds=speech_profile_duration
                 )
+                session_metrics.on_stt_socket_opened()
                 if speech_profile_duration:
-                    asyncio.create_task(send_initial_file_path(file_path, speechmatics_socket.send))
+                    asyncio.create_task(_prime_speech_profile(speechmatics_socket.send))
                     print('speech_profile speechmatics duration', speech_profile_duration, uid)
 
         except Exception as e:
             print(f"Initial processing error: {e}", uid)
             websocket_close_code = 1011
+            _cancel_session_timers()
+            await outbound.close()
             await websocket.close(code=websocket_close_code)
             return
 
@@ -382,32 +452,42 @@ async def _listen(
         pusher_connect_lock = asyncio.Lock()
         pusher_connected = False
 
+        # Compact msgpack framing, the legacy json / pcm frames otherwise
+        compact_protocol = pusher_protocol_version >= 2
+        transcript_encoder = TranscriptFrameEncoder() if compact_protocol else None
+
         # Transcript
         transcript_ws = None
-        segment_buffers = []
+        segment_buffers = session.pusher_segments = new_pusher_segment_buffer()
+        segment_flush = FlushSignal(pusher_transcript_min_batch_seconds)
+        flush_signals.append(segment_flush)
         in_progress_conversation_id = None
 
         def transcript_send(segments, conversation_id):
-            nonlocal segment_buffers
             nonlocal in_progress_conversation_id
             in_progress_conversation_id = conversation_id
             segment_buffers.extend(segments)
+            segment_flush.notify()
 
         async def transcript_consume():
             nonlocal websocket_active
-            nonlocal segment_buffers
             nonlocal in_progress_conversation_id
             nonlocal transcript_ws
             nonlocal pusher_connected
-            while websocket_active or len(segment_buffers) > 0:
-                await asyncio.sleep(1)
+            # a backlog is only flushed to a connected pusher
+            while websocket_active or (transcript_ws and len(segment_buffers) > 0):
+                await segment_flush.wait()
                 if transcript_ws and len(segment_buffers) > 0:
                     try:
-                        # 102|data
-                        data = bytearray()
-                        data.extend(struct.pack("I", 102))
-                        data.extend(bytes(json.dumps({"segments":segment_buffers,"memory_id":in_progress_conversation_id}), "utf-8"))
-                        segment_buffers = []  # reset
+                        session_metrics.on_pusher_flush('transcript', len(segment_buffers))
+                        if transcript_encoder is not None:
+                            # 103|msgpack
+                            data = transcript_encoder.encode(segment_buffers.drain(), in_progress_conversation_id)
+                        else:
+                            # 102|data
+                            data = bytearray()
+                            data.extend(struct.pack("I", 102))
+                            data.extend(bytes(json.dumps({"segments":segment_buffers.drain(),"memory_id":in_progress_conversation_id}), "utf-8"))
                         await transcript_ws.send(data)
                     except websockets.exceptions.ConnectionClosed as e:
                         print(f"Pusher transcripts Connection closed: {e}", uid)
@@ -419,28 +499,43 @@ async def _listen(
 
         # Audio bytes
         audio_bytes_ws = None
-        audio_buffers = bytearray()
-        audio_bytes_enabled = bool(get_audio_bytes_webhook_seconds(uid)) or is_audio_bytes_app_enabled(uid)
-
-        def audio_bytes_send(audio_bytes):
-            nonlocal audio_buffers
-            audio_buffers.extend(audio_bytes)
+        # the client opus packets are forwarded as is when possible, smaller than the decoded pcm
+        audio_opus = pusher_audio_opus
+        audio_buffers = new_pusher_audio_packet_buffer(sample_rate) if audio_opus else new_pusher_audio_buffer(sample_rate)
+        session.pusher_audio = audio_buffers
+        audio_max_frame_bytes = pusher_audio_max_frame_bytes(sample_rate)
+        # spilled audio is read back from disk, in a thread
+        audio_spill = not audio_opus and audio_buffers.policy == SPILL
+        audio_flush = FlushSignal(pusher_audio_min_batch_seconds)
+        flush_signals.append(audio_flush)
+
+        def audio_bytes_send(audio_bytes, opus_packet: bytes = None):
+            audio_buffers.extend(opus_packet if audio_opus else audio_bytes)
+            audio_flush.notify()
 
         async def audio_bytes_consume():
             nonlocal websocket_active
-            nonlocal audio_buffers
             nonlocal audio_bytes_ws
             nonlocal pusher_connected
-            while websocket_active or len(audio_buffers) > 0:
-                await asyncio.sleep(1)
+            while websocket_active or (audio_bytes_ws and len(audio_buffers) > 0):
+                await audio_flush.wait()
                 if audio_bytes_ws and len(audio_buffers) > 0:
                     try:
-                        # 101|data
-                        data = bytearray()
-                        data.extend(struct.pack("I", 101))
-                        data.extend(audio_buffers.copy())
-                        audio_buffers = bytearray()  # reset
-                        await audio_bytes_ws.send(data)
+                        session_metrics.on_pusher_flush('audio_bytes', len(audio_buffers))
+                        # a backlog goes out as several bounded frames
+                        while audio_bytes_ws and len(audio_buffers) > 0:
+                            if audio_opus:
+                                # 104|msgpack
+                                data = encode_opus_frame(audio_buffers.read(audio_max_frame_bytes), sample_rate)
+                            else:
+                                # 101|data
+                                data = bytearray()
+                                data.extend(struct.pack("I", 101))
+                                if audio_spill:
+                                    data.extend(await asyncio.to_thread(audio_buffers.read, audio_max_frame_bytes))
+                                else:
+                                    data.extend(audio_buffers.read(audio_max_frame_bytes))
+                            await audio_bytes_ws.send(data)
                     except websockets.exceptions.ConnectionClosed as e:
                         print(f"Pusher audio_bytes Connection closed: {e}", uid)
                         audio_bytes_ws = None
@@ -461,11 +556,18 @@ async def _listen(
             nonlocal pusher_ws
             nonlocal transcript_ws
             nonlocal audio_bytes_ws
-            nonlocal audio_bytes_enabled
             nonlocal pusher_connected
 
             try:
-                pusher_ws = await connect_to_trigger_pusher(uid, sample_rate)
+                if pusher_multiplex:
+                    # a session on the process connection, it's reopened there after a reconnect
+                    pusher_ws = get_pusher_mux().open(
+                        uid, sample_rate, on_open=transcript_encoder.on_connect if transcript_encoder else None,
+                    )
+                else:
+                    pusher_ws = await connect_to_trigger_pusher(uid, sample_rate)
+                    if transcript_encoder is not None:
+                        transcript_encoder.on_connect()
                 pusher_connected = True
                 transcript_ws = pusher_ws
                 if audio_bytes_enabled:
@@ -474,6 +576,8 @@ async def _listen(
                 print(f"Exception in connect: {e}")
 
         async def close(code: int = 1000):
+            print('pusher buffers', segment_buffers.stats(), audio_buffers.stats(), uid)
+            audio_buffers.close()
             await pusher_ws.close(code)
 
         return (connect, close,
@@ -495,27 +599,26 @@ async def _listen(
 
     async def stream_transcript_process():
         nonlocal websocket_active
-        nonlocal realtime_segment_buffers
         nonlocal websocket
         nonlocal seconds_to_trim
         nonlocal current_conversation_id
 
         while websocket_active or len(realtime_segment_buffers) > 0:
             try:
-                await asyncio.sleep(0.3)  # 300ms
+                await realtime_segment_flush.wait()
 
-                if not realtime_segment_buffers or len(realtime_segment_buffers) == 0:
+                if len(realtime_segment_buffers) == 0:
                     continue
 
-                segments = realtime_segment_buffers.copy()
-                realtime_segment_buffers = []
+                segments = realtime_segment_buffers.drain()
+                audio_end_seconds = max(segment['end'] for segment in segments)
 
                 # Align the start, end segment
                 if seconds_to_trim is None:
                     seconds_to_trim = segments[0]["start"]
 
                 finished_at = datetime.now(timezone.utc)
-                await create_conversation_on_segment_received_task(finished_at)
+                _schedule_conversation_creation(conversation_creation_timeout, finished_at)
 
                 # Segments aligning duration seconds.
                 if seconds_to_add:
@@ -533,83 +636,105 @@ async def _listen(
                 segments = [segment.dict() for segment in
                             TranscriptSegment.combine_segments([], [TranscriptSegment(**segment) for segment in segments])]
 
-                # Send to client
-                await websocket.send_json(segments)
+                # Redis every tick, firestore on checkpoints, also gives the segments their ids
+                conversation, updated_last, appended = in_progress_store.add_segments(segments, finished_at)
+                current_conversation_id = conversation.id
+
+                # Send to client, list frames carry the tick's segments with their ids, delta clients the store's delta
+                if not transcript_deltas:
+                    outbound.send_segments(segments)
+                    session_metrics.on_segments_sent(audio_end_seconds)
+                else:
+                    if updated_last:
+                        _send_transcript_delta('transcript_update_last', conversation.id, [updated_last])
+                    if appended:
+                        _send_transcript_delta('transcript_append', conversation.id, appended)
+                    session_metrics.on_segments_sent(audio_end_seconds)
 
                 # Send to external trigger
                 if transcript_send is not None:
-                    transcript_send(segments,current_conversation_id)
-
-                # can trigger race condition? increase soniox utterance?
-                conversation = _get_or_create_in_progress_conversation(segments)
-                current_conversation_id = conversation.id
-                conversations_db.update_conversation_segments(uid, conversation.id,
-                                                   [s.dict() for s in conversation.transcript_segments])
-                conversations_db.update_conversation_finished_at(uid, conversation.id, finished_at)
+                    transcript_send(segments, current_conversation_id)
             except Exception as e:
                 print(f'Could not process transcript: error {e}', uid)
 
     # Audio bytes
     #
-    # # Initiate a separate vad for each websocket
-    # w_vad = webrtcvad.Vad()
-    # w_vad.set_mode(1)
-
     decoder = opuslib.Decoder(sample_rate, 1)
 
-    # # A  frame must be either 10, 20, or 30 ms in duration
-    # def _has_speech(data, sample_rate):
-    #     sample_size = 320 if sample_rate == 16000 else 160
-    #     offset = 0
-    #     while offset < len(data):
-    #         sample = data[offset:offset + sample_size]
-    #         if len(sample) < sample_size:
-    #             sample = sample + bytes([0x00] * (sample_size - len(sample) % sample_size))
-    #         has_speech = w_vad.is_speech(sample, sample_rate)
-    #         if has_speech:
-    #             return True
-    #         offset += sample_size
-    #     return False
+    # Runs on the audio worker pool, one batch per session at a time so the decoder / gate state is safe
+    def _process_audio_batch(frames: List[bytes]) -> List[tuple]:
+        results = []
+        for data in frames:
+            opus_packet = None
+            pcm_bytes = len(data)
+            if codec == 'opus' and sample_rate == 16000:
+                opus_packet = data
+                if opus_passthrough:
+                    data = None
+                    pcm_bytes = opus_packet_samples(opus_packet, sample_rate) * 2
+                else:
+                    data = decoder.decode(opus_packet, frame_size=160)
+                    pcm_bytes = len(data)
+
+            # STT
+            if opus_passthrough:
+                stt_data = ogg_writer.write(opus_packet)
+            else:
+                stt_data = speech_gate.process(data) if speech_gate is not None else data
+            results.append((data, opus_packet, stt_data, pcm_bytes))
+        return results
 
     async def receive_audio(dg_socket1, dg_socket2, soniox_socket, speechmatics_socket1):
         nonlocal websocket_active
         nonlocal websocket_close_code
 
         timer_start = time.time()
+        audio_stage = session.audio_stage = AudioStage(_process_audio_batch)
+
+        async def forward_audio():
+            nonlocal websocket_active
+            nonlocal websocket_close_code
+            nonlocal dg_socket2
+            try:
+                async for results in audio_stage.results():
+                    session_metrics.on_audio_stage_batch(len(audio_stage))
+                    for data, opus_packet, stt_data, pcm_bytes in results:
+                        session_metrics.on_audio_received(pcm_bytes)
+
+                        if stt_data:
+                            session_metrics.on_stt_sent(len(stt_data))
+                            if soniox_socket is not None:
+                                await soniox_socket.send(stt_data)
+
+                            if speechmatics_socket1 is not None:
+                                await speechmatics_socket1.send(stt_data)
+
+                            if dg_socket1 is not None:
+                                elapsed_seconds = time.time() - timer_start
+                                if elapsed_seconds > speech_profile_duration or not dg_socket2:
+                                    dg_socket1.send(stt_data)
+                                    if dg_socket2:
+                                        print('Killing socket2', uid)
+                                        await asyncio.to_thread(dg_socket2.finish)
+                                        dg_socket2 = None
+                                        session_metrics.on_stt_socket_closed()
+                                else:
+                                    dg_socket2.send(stt_data)
+
+                        # Send to external trigger
+                        if audio_bytes_send is not None:
+                            audio_bytes_send(data, opus_packet)
+            except Exception as e:
+                print(f'Could not process audio: error {e}', uid)
+                websocket_close_code = 1011
+                websocket_active = False
+                audio_stage.fail()
+
+        forward_task = asyncio.create_task(forward_audio())
         try:
             while websocket_active:
                 data = await websocket.receive_bytes()
-                if codec == 'opus' and sample_rate == 16000:
-                    data = decoder.decode(bytes(data), frame_size=160)
-                    # audio_data.extend(data)
-
-                # STT
-                has_speech = True
-                # thinh's comment: disabled cause bad performance
-                # if include_speech_profile and codec != 'opus':  # don't do for opus 1.0.4 for now
-                #     has_speech = _has_speech(data, sample_rate)
-
-                if has_speech:
-                    if soniox_socket is not None:
-                        await soniox_socket.send(data)
-
-                    if speechmatics_socket1 is not None:
-                        await speechmatics_socket1.send(data)
-
-                    if dg_socket1 is not None:
-                        elapsed_seconds = time.time() - timer_start
-                        if elapsed_seconds > speech_profile_duration or not dg_socket2:
-                            dg_socket1.send(data)
-                            if dg_socket2:
-                                print('Killing socket2', uid)
-                                dg_socket2.finish()
-                                dg_socket2 = None
-                        else:
-                            dg_socket2.send(data)
-
-                # Send to external trigger
-                if audio_bytes_send is not None:
-                    audio_bytes_send(data)
+                await audio_stage.put(data)
 
         except WebSocketDisconnect:
             print("WebSocket disconnected", uid)
@@ -618,10 +743,21 @@ async def _listen(
             websocket_close_code = 1011
         finally:
             websocket_active = False
+            _wake_consumers()
+            # drain what was received before closing the providers
+            await audio_stage.close()
+            await forward_task
+            if speech_gate is not None:
+                speech_gate.close()
+                print('speech_gate', speech_gate.stats(), uid)
+            print('session_metrics', session_metrics.summary(), uid)
+            if dg_socket1 and ogg_writer is not None:
+                if page := ogg_writer.flush():
+                    dg_socket1.send(page)
             if dg_socket1:
-                dg_socket1.finish()
+                await asyncio.to_thread(dg_socket1.finish)
             if dg_socket2:
-                dg_socket2.finish()
+                await asyncio.to_thread(dg_socket2.finish)
             if soniox_socket:
                 await soniox_socket.close()
             if speechmatics_socket:
@@ -644,13 +780,22 @@ async def _listen(
 
         _send_message_event(MessageServiceStatusEvent(status="ready"))
 
-        tasks = [audio_process_task, stream_transcript_task, heartbeat_task] + pusher_tasks
+        tasks = [audio_process_task, stream_transcript_task] + pusher_tasks
         await asyncio.gather(*tasks)
 
     except Exception as e:
         print(f"Error during WebSocket operation: {e}", uid)
     finally:
         websocket_active = False
+        _wake_consumers()
+        _cancel_session_timers()
+        session_metrics.close()
+        try:
+            in_progress_store.checkpoint(force=True)
+        except Exception as e:
+            print(f"Error checkpointing in progress conversation: {e}", uid)
+        await outbound.close()
+        print('outbound', outbound.stats(), uid)
         if websocket.client_state == WebSocketState.CONNECTED:
             try:
                 await websocket.close(code=websocket_close_code)
@@ -662,9 +807,37 @@ async def _listen(
             except Exception as e:
                 print(f"Error closing Pusher: {e}", uid)
 
+
+async def _reject_listen(websocket: WebSocket, uid: str, reason: str):
+    retry_after = listen_admission.retry_after()
+    print('_reject_listen', reason, 'retry after', retry_after, uid)
+    try:
+        await websocket.accept()
+        await websocket.send_json(MessageServiceStatusEvent(
+            status="busy", status_text="Service Busy", retry_after=retry_after,
+        ).to_json())
+        await websocket.close(code=1013, reason="Try again later")
+    except Exception as e:
+        print(f"Error rejecting WebSocket: {e}", uid)
+
+
 @router.websocket("/v3/listen")
 async def listen_handler(
         websocket: WebSocket, uid: str = Depends(auth.get_current_user_uid), language: str = 'en', sample_rate: int = 8000, codec: str = 'pcm8',
-        channels: int = 1, include_speech_profile: bool = True, stt_service: STTService = STTService.soniox
+        channels: int = 1, include_speech_profile: bool = True, stt_service: STTService = STTService.soniox,
+        transcript_deltas: bool = False,
 ):
-    await _listen(websocket, uid, language, sample_rate, codec, channels, include_speech_profile, stt_service)
+    # Shed load before the session does any work
+    if reason := listen_admission.admit():
+        await _reject_listen(websocket, uid, reason)
+        return
+    session = ListenSession(uid, language, sample_rate, codec, stt_service.value)
+    register_listen_session(session)
+    try:
+        await _listen(
+            websocket, uid, language, sample_rate, codec, channels, include_speech_profile, stt_service,
+            session=session, transcript_deltas=transcript_deltas,
+        )
+    finally:
+        unregister_listen_session(session)
+        listen_admission.release()
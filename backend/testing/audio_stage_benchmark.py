@@ -0,0 +1,83 @@
+# Event loop lag with the listen audio work inline vs on the audio worker pool.
+#
+# Every simulated session receives a 10ms pcm16 frame per tick at real time pace and runs it
+# through the speech gate, like receive_audio does. The p99 of a 10ms timer's delay on the
+# loop stands in for the websocket send latency of every other session in the process,
+# it should stay flat with the worker pool as the sessions per process grow.
+#
+# Run from backend/: python -m testing.audio_stage_benchmark
+import asyncio
+import time
+
+import numpy as np
+
+from utils.stt.audio_stage import AudioStage
+from utils.stt.speech_gate import SpeechGate
+
+SAMPLE_RATE = 16000
+FRAME_BYTES = SAMPLE_RATE // 100 * 2
+SECONDS = 5
+SESSIONS = (10, 50, 100, 200)
+
+
+def _frames():
+    rng = np.random.default_rng(0)
+    t = np.arange(SAMPLE_RATE // 100) / SAMPLE_RATE
+    speech = (3000 * np.sin(2 * np.pi * 220 * t) + rng.normal(0, 800, t.size)).astype(np.int16).tobytes()
+    noise = rng.normal(0, 300, t.size).astype(np.int16).tobytes()
+    return speech, noise
+
+
+async def _session(i: int, use_stage: bool, deadline: float, frames):
+    gate = SpeechGate(SAMPLE_RATE)
+
+    def process(batch):
+        return [gate.process(data) for data in batch]
+
+    stage = AudioStage(process) if use_stage else None
+
+    async def forward():
+        async for _ in stage.results():
+            pass
+
+    forward_task = asyncio.create_task(forward()) if stage else None
+    tick = 0
+    while time.monotonic() < deadline:
+        data = frames[(tick // 50 + i) % 2]
+        if stage:
+            await stage.put(data)
+        else:
+            process([data])
+        tick += 1
+        await asyncio.sleep(0.01)
+
+    if stage:
+        await stage.close()
+        await forward_task
+
+
+async def _lag(deadline: float, samples: list):
+    while time.monotonic() < deadline:
+        start = time.monotonic()
+        await asyncio.sleep(0.01)
+        samples.append(time.monotonic() - start - 0.01)
+
+
+async def bench(sessions: int, use_stage: bool):
+    frames = _frames()
+    deadline = time.monotonic() + SECONDS
+    samples = []
+    await asyncio.gather(_lag(deadline, samples), *[_session(i, use_stage, deadline, frames) for i in range(sessions)])
+    return np.percentile(samples, 50) * 1e3, np.percentile(samples, 99) * 1e3
+
+
+async def main():
+    for sessions in SESSIONS:
+        for use_stage in (False, True):
+            p50, p99 = await bench(sessions, use_stage)
+            mode = 'worker pool' if use_stage else 'inline'
+            print(f'{sessions:>4} sessions {mode:>11}: loop lag p50 {p50:6.2f} ms  p99 {p99:6.2f} ms')
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
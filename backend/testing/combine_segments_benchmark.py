@@ -0,0 +1,47 @@
+# Micro-benchmark for TranscriptSegment.combine_segments on the in progress path.
+#
+# Appends one tick of segments at a time to a growing conversation and reports the mean cost
+# per append around different conversation sizes, it should stay flat up to 10k segments.
+#
+# Run from backend/: python -m testing.combine_segments_benchmark
+import time
+
+from models.transcript_segment import TranscriptSegment
+
+TOTAL_SEGMENTS = 10_000
+WINDOW = 500
+
+
+def _tick(i: int):
+    # alternate speakers so each tick appends a new segment instead of extending the last one
+    return [TranscriptSegment(
+        text=f' word{i} , another  word {i} .',
+        speaker=f'SPEAKER_0{i % 2}',
+        is_user=False,
+        start=i * 2.0,
+        end=i * 2.0 + 1.5,
+    )]
+
+
+def bench_combine_segments():
+    segments = []
+    ticks = [_tick(i) for i in range(TOTAL_SEGMENTS)]
+    window_start = time.perf_counter()
+    for i, new_segments in enumerate(ticks, start=1):
+        segments = TranscriptSegment.combine_segments(segments, new_segments)
+        if i % WINDOW == 0:
+            elapsed = time.perf_counter() - window_start
+            print(f'combine_segments {i:>6} segments: {elapsed / WINDOW * 1e6:8.2f} us/append')
+            window_start = time.perf_counter()
+    return segments
+
+
+def bench_can_display_seconds(segments):
+    start = time.perf_counter()
+    result = TranscriptSegment.can_display_seconds(segments)
+    print(f'can_display_seconds {len(segments)} segments: {(time.perf_counter() - start) * 1e3:.2f} ms ({result})')
+
+
+if __name__ == '__main__':
+    segments = bench_combine_segments()
+    bench_can_display_seconds(segments)
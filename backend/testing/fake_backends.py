@@ -0,0 +1,262 @@
+# In memory stand-ins for the services /v3/listen talks to, for the local benchmarks.
+#
+# `install_fake_backends` has to run before any backend module is imported: it swaps the redis,
+# firestore and storage client constructors the database modules call at import time.
+# Redis is fakeredis (pip install 'fakeredis[lua]', the finalize scheduler uses scripts), firestore
+# is the small document store below, it covers the queries the listen path runs, not the full API.
+import copy
+import functools
+import itertools
+import operator
+import os
+
+_ops = {
+    '==': operator.eq,
+    '!=': operator.ne,
+    '<': operator.lt,
+    '<=': operator.le,
+    '>': operator.gt,
+    '>=': operator.ge,
+    'in': lambda value, options: value in options,
+    'not-in': lambda value, options: value not in options,
+    'array_contains': lambda value, item: item in (value or []),
+    'array-contains': lambda value, item: item in (value or []),
+    'array_contains_any': lambda value, items: any(item in (value or []) for item in items),
+    'array-contains-any': lambda value, items: any(item in (value or []) for item in items),
+}
+
+_missing = object()
+
+
+def _get_path(data: dict, path: str):
+    for part in path.split('.'):
+        if not isinstance(data, dict) or part not in data:
+            return _missing
+        data = data[part]
+    return data
+
+
+def _set_path(data: dict, path: str, value):
+    parts = path.split('.')
+    for part in parts[:-1]:
+        data = data.setdefault(part, {})
+    data[parts[-1]] = value
+
+
+class FakeDocumentSnapshot:
+    def __init__(self, reference: 'FakeDocumentReference', data):
+        self.reference = reference
+        self.id = reference.id
+        self._data = data
+
+    @property
+    def exists(self) -> bool:
+        return self._data is not None
+
+    def to_dict(self):
+        return copy.deepcopy(self._data)
+
+    def get(self, path: str):
+        value = _get_path(self._data or {}, path)
+        return None if value is _missing else copy.deepcopy(value)
+
+
+class FakeDocumentReference:
+    def __init__(self, store: 'FakeFirestore', path: tuple):
+        self._store = store
+        self._path = path
+        self.id = path[-1]
+
+    @property
+    def path(self) -> str:
+        return '/'.join(self._path)
+
+    def collection(self, name: str) -> 'FakeCollectionReference':
+        return FakeCollectionReference(self._store, self._path + (name,))
+
+    def get(self, *args, **kwargs) -> FakeDocumentSnapshot:
+        return FakeDocumentSnapshot(self, copy.deepcopy(self._store.documents.get(self._path)))
+
+    def set(self, data: dict, merge: bool = False):
+        data = copy.deepcopy(data)
+        if merge and self._path in self._store.documents:
+            self._store.documents[self._path].update(data)
+        else:
+            self._store.documents[self._path] = data
+
+    def update(self, data: dict):
+        if self._path not in self._store.documents:
+            raise KeyError(f'No document to update: {self.path}')
+        document = self._store.documents[self._path]
+        for path, value in data.items():
+            _set_path(document, path, copy.deepcopy(value))
+
+    def delete(self):
+        self._store.documents.pop(self._path, None)
+
+
+class FakeQuery:
+    def __init__(self, store: 'FakeFirestore', path: tuple, filters=(), orders=(), limit=None, offset=0):
+        self._store = store
+        self._path = path
+        self._filters = tuple(filters)
+        self._orders = tuple(orders)
+        self._limit = limit
+        self._offset = offset
+
+    def _copy(self, **kwargs) -> 'FakeQuery':
+        state = {'filters': self._filters, 'orders': self._orders, 'limit': self._limit, 'offset': self._offset}
+        state.update(kwargs)
+        return FakeQuery(self._store, self._path, **state)
+
+    def where(self, field_path: str = None, op_string: str = None, value=None, filter=None) -> 'FakeQuery':
+        if filter is not None:
+            field_path, op_string, value = filter.field_path, filter.op_string, filter.value
+        return self._copy(filters=self._filters + ((field_path, _ops[op_string], value),))
+
+    def order_by(self, field_path: str, direction: str = 'ASCENDING') -> 'FakeQuery':
+        return self._copy(orders=self._orders + ((field_path, direction == 'DESCENDING'),))
+
+    def limit(self, count: int) -> 'FakeQuery':
+        return self._copy(limit=count)
+
+    def offset(self, count: int) -> 'FakeQuery':
+        return self._copy(offset=count)
+
+    def stream(self, *args, **kwargs):
+        documents = []
+        for path, data in list(self._store.documents.items()):
+            if len(path) != len(self._path) + 1 or path[:-1] != self._path:
+                continue
+            matches = True
+            for field_path, op, value in self._filters:
+                field = _get_path(data, field_path)
+                try:
+                    matches = field is not _missing and op(field, value)
+                except TypeError:
+                    matches = False
+                if not matches:
+                    break
+            if matches:
+                documents.append((path, data))
+
+        # stable sorts, last key first
+        for field_path, descending in reversed(self._orders):
+            documents = [d for d in documents if _get_path(d[1], field_path) is not _missing]
+            documents.sort(key=lambda d: _get_path(d[1], field_path), reverse=descending)
+
+        documents = documents[self._offset:]
+        if self._limit is not None:
+            documents = documents[:self._limit]
+        for path, data in documents:
+            yield FakeDocumentSnapshot(FakeDocumentReference(self._store, path), copy.deepcopy(data))
+
+    def get(self, *args, **kwargs):
+        return list(self.stream())
+
+
+class FakeCollectionReference(FakeQuery):
+    _ids = itertools.count()
+
+    def __init__(self, store: 'FakeFirestore', path: tuple):
+        super().__init__(store, path)
+        self.id = path[-1]
+
+    def document(self, document_id: str = None) -> FakeDocumentReference:
+        return FakeDocumentReference(self._store, self._path + (document_id or f'doc-{next(self._ids)}',))
+
+    def add(self, data: dict):
+        reference = self.document()
+        reference.set(data)
+        return None, reference
+
+
+class FakeWriteBatch:
+    def __init__(self):
+        self._writes = []
+
+    def set(self, reference: FakeDocumentReference, data: dict, merge: bool = False):
+        self._writes.append(functools.partial(reference.set, data, merge=merge))
+
+    def update(self, reference: FakeDocumentReference, data: dict):
+        self._writes.append(functools.partial(reference.update, data))
+
+    def delete(self, reference: FakeDocumentReference):
+        self._writes.append(reference.delete)
+
+    def commit(self):
+        for write in self._writes:
+            write()
+        self._writes = []
+
+
+class FakeFirestore:
+    """Documents keyed by their path tuple, e.g. ('users', uid, 'memories', conversation_id)."""
+
+    def __init__(self, *args, **kwargs):
+        self.documents = {}
+
+    def collection(self, name: str) -> FakeCollectionReference:
+        return FakeCollectionReference(self, (name,))
+
+    def get_all(self, references, *args, **kwargs):
+        for reference in references:
+            yield reference.get()
+
+    def batch(self) -> FakeWriteBatch:
+        return FakeWriteBatch()
+
+
+class FakeBlob:
+    def __init__(self, name: str):
+        self.name = name
+
+    def exists(self) -> bool:
+        return False
+
+
+class FakeBucket:
+    def __init__(self, name: str):
+        self.name = name
+
+    def blob(self, name: str) -> FakeBlob:
+        return FakeBlob(name)
+
+    def list_blobs(self, *args, **kwargs):
+        return []
+
+
+class FakeStorageClient:
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def bucket(self, name: str) -> FakeBucket:
+        return FakeBucket(name)
+
+
+firestore_db = FakeFirestore()
+
+
+def install_fake_backends():
+    """Returns the fake firestore, to seed users with `seed_users`."""
+    try:
+        import fakeredis
+    except ImportError:
+        raise SystemExit("The listen benchmarks need fakeredis: pip install 'fakeredis[lua]'")
+    import redis
+    from google.cloud import firestore, storage
+
+    server = fakeredis.FakeServer()
+    redis.Redis = functools.partial(fakeredis.FakeRedis, server=server)
+    firestore.Client = lambda *args, **kwargs: firestore_db
+    storage.Client = FakeStorageClient
+
+    # clients built at import time only need a key to exist
+    for key in ('OPENAI_API_KEY', 'DEEPGRAM_API_KEY', 'TYPESENSE_API_KEY', 'HUME_API_KEY'):
+        os.environ.setdefault(key, 'fake')
+    return firestore_db
+
+
+def seed_users(db: FakeFirestore, uids):
+    for uid in uids:
+        db.collection('users').document(uid).set({'uid': uid, 'time_zone': 'UTC'})
@@ -0,0 +1,134 @@
+# A local stand-in for the deepgram live websocket, for the listen benchmarks.
+#
+# Accepts any /v1/listen socket and answers with `Results` messages shaped like deepgram's, with
+# words from a fixed script every `--result-seconds` of audio received. Time is audio time: bytes
+# for linear16, the ogg granule position for containerized opus. `--latency` delays every result,
+# the model's share of the end to end latency.
+#
+# Run from backend/: python -m testing.fake_deepgram --port 8081
+# and point the backend at it: DEEPGRAM_SELF_HOSTED_ENABLED=true DEEPGRAM_SELF_HOSTED_URL=ws://127.0.0.1:8081
+import argparse
+import asyncio
+import itertools
+import json
+import struct
+import uuid
+from urllib.parse import parse_qs, urlparse
+
+import websockets
+
+SCRIPT = (
+    'so I was thinking we could move the review to thursday afternoon if that works for everyone '
+    'the numbers from last week look good but the latency on the listen path still needs work '
+    'let us pick one thing to fix first and measure it before we change anything else'
+).split()
+WORDS_PER_SECOND = 2.5
+
+
+def _result(start: float, end: float, words: list, request_id: str) -> str:
+    return json.dumps({
+        'type': 'Results',
+        'channel_index': [0, 1],
+        'duration': round(end - start, 3),
+        'start': round(start, 3),
+        'is_final': True,
+        'speech_final': True,
+        'from_finalize': False,
+        'channel': {
+            'alternatives': [{
+                'transcript': ' '.join(word['punctuated_word'] for word in words),
+                'confidence': 0.99,
+                'words': words,
+            }],
+        },
+        'metadata': {
+            'request_id': request_id,
+            'model_info': {'name': 'fake', 'version': '0', 'arch': 'fake'},
+            'model_uuid': str(uuid.uuid4()),
+        },
+    })
+
+
+def _ogg_granule(data: bytes) -> int:
+    """Granule position of the last ogg page in `data`, -1 without one."""
+    granule, offset = -1, data.find(b'OggS')
+    while offset != -1 and offset + 14 <= len(data):
+        granule = max(granule, struct.unpack_from('<q', data, offset + 6)[0])
+        offset = data.find(b'OggS', offset + 4)
+    return granule
+
+
+class FakeListenSocket:
+    def __init__(self, websocket, result_seconds: float, latency: float):
+        self.websocket = websocket
+        self.result_seconds = result_seconds
+        self.latency = latency
+        self.request_id = str(uuid.uuid4())
+
+        query = parse_qs(urlparse(websocket.path).query)
+        self.encoding = query.get('encoding', [None])[0]  # none for containers
+        self.sample_rate = int(query.get('sample_rate', [16000])[0])
+        self.channels = int(query.get('channels', [1])[0])
+
+        self.audio_seconds = 0.0
+        self.emitted_until = 0.0
+        self.script = itertools.cycle(SCRIPT)
+
+    def _advance(self, data: bytes):
+        if self.encoding == 'linear16':
+            self.audio_seconds += len(data) / (2 * self.sample_rate * self.channels)
+        elif (granule := _ogg_granule(data)) > 0:
+            self.audio_seconds = max(self.audio_seconds, granule / 48000)
+
+    def _words(self, start: float, end: float) -> list:
+        count = max(int((end - start) * WORDS_PER_SECOND), 1)
+        step = (end - start) / count
+        words = []
+        for i in range(count):
+            word = next(self.script)
+            words.append({
+                'word': word, 'start': round(start + i * step, 3), 'end': round(start + (i + 1) * step, 3),
+                'confidence': 0.99, 'punctuated_word': word, 'speaker': 0, 'speaker_confidence': 0.9,
+            })
+        return words
+
+    async def _send(self, message: str):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        try:
+            await self.websocket.send(message)
+        except websockets.ConnectionClosed:
+            pass
+
+    async def run(self):
+        async for message in self.websocket:
+            if isinstance(message, str):
+                if json.loads(message).get('type') == 'CloseStream':
+                    break
+                continue  # KeepAlive
+
+            self._advance(message)
+            while self.audio_seconds - self.emitted_until >= self.result_seconds:
+                start, end = self.emitted_until, self.emitted_until + self.result_seconds
+                self.emitted_until = end
+                result = _result(start, end, self._words(start, end), self.request_id)
+                asyncio.create_task(self._send(result))
+
+
+async def serve(host: str, port: int, result_seconds: float, latency: float):
+    async def handler(websocket):
+        await FakeListenSocket(websocket, result_seconds, latency).run()
+
+    async with websockets.serve(handler, host, port, max_size=None):
+        print(f'fake deepgram listening on ws://{host}:{port}', flush=True)
+        await asyncio.Future()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--result-seconds', type=float, default=1.0)
+    parser.add_argument('--latency', type=float, default=0.0)
+    args = parser.parse_args()
+    asyncio.run(serve(args.host, args.port, args.result_seconds, args.latency))
@@ -0,0 +1,120 @@
+# Pusher batch latency of the realtime app fan-out, 50 enabled apps, some of them slow.
+#
+# `threads` is how utils/plugins.py delivered a batch before: a thread per app doing a blocking
+# requests.post, joined on the event loop. `fanout` is HttpFanout, pooled httpx clients and a
+# batch deadline shorter than the batch interval, slower requests finish in the background. A local
+# stub server answers /fast in 20ms and /slow in SLOW_SECONDS, every app on its own loopback address
+# like apps on their own hosts.
+# The loop lag is the worst delay of a 10ms ticker during the run.
+#
+# Run from backend/: python -m testing.http_fanout_benchmark
+import asyncio
+import multiprocessing
+import threading
+import time
+
+import numpy as np
+import requests
+
+from utils.other.http_fanout import FanoutRequest, HttpFanout
+
+APPS = 50
+BATCHES = 10
+BATCH_INTERVAL_SECONDS = 1
+FAST_SECONDS = 0.02
+SLOW_SECONDS = 3
+DEADLINE_SECONDS = 0.9
+PORT = 18090
+
+
+async def _stub_connection(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    try:
+        while request_line := await reader.readline():
+            length = 0
+            while (line := await reader.readline()) not in (b'\r\n', b''):
+                name, _, value = line.decode().partition(':')
+                if name.lower() == 'content-length':
+                    length = int(value)
+            await reader.readexactly(length)
+            await asyncio.sleep(SLOW_SECONDS if b'/slow' in request_line else FAST_SECONDS)
+            body = b'{}'
+            writer.write(b'HTTP/1.1 200 OK\r\nContent-Type: application/json\r\nContent-Length: %d\r\n\r\n%s' % (len(body), body))
+            await writer.drain()
+    except (ConnectionError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        writer.close()
+
+
+def _run_stub_server(started):
+    async def serve():
+        hosts = [f'127.0.0.{i + 1}' for i in range(APPS)]
+        server = await asyncio.start_server(_stub_connection, hosts, PORT, backlog=1024)
+        started.set()
+        async with server:
+            await server.serve_forever()
+
+    asyncio.run(serve())
+
+
+def _urls(slow_apps: int):
+    return [f'http://127.0.0.{i + 1}:{PORT}/{"slow" if i < slow_apps else "fast"}?uid=bench' for i in range(APPS)]
+
+
+def _threads_batch(urls: list, payload: dict):
+    def _single(url: str):
+        try:
+            requests.post(url, json=payload, timeout=30)
+        except Exception as e:
+            print(f'error: {e}')
+
+    threads = [threading.Thread(target=_single, args=(url,)) for url in urls]
+    [t.start() for t in threads]
+    [t.join() for t in threads]
+
+
+async def _loop_lag(stop: asyncio.Event, lags: list):
+    while not stop.is_set():
+        start = time.monotonic()
+        await asyncio.sleep(0.01)
+        lags.append(time.monotonic() - start - 0.01)
+
+
+async def bench(mode: str, slow_apps: int, fanout: HttpFanout):
+    urls = _urls(slow_apps)
+    payload = {'session_id': 'bench', 'segments': [{'text': 'hello there ' * 10, 'start': 0, 'end': 1}]}
+    stop, lags, latencies = asyncio.Event(), [], []
+    ticker = asyncio.create_task(_loop_lag(stop, lags))
+
+    for _ in range(BATCHES):
+        start = time.monotonic()
+        if mode == 'threads':
+            # blocking, as the pusher ran it
+            _threads_batch(urls, payload)
+        else:
+            requests_ = [FanoutRequest(f'app-{i}', url, {'json': payload}) for i, url in enumerate(urls)]
+            await fanout.fan_out('bench', requests_, DEADLINE_SECONDS)
+        latencies.append(time.monotonic() - start)
+        await asyncio.sleep(max(BATCH_INTERVAL_SECONDS - latencies[-1], 0))
+
+    stop.set()
+    await ticker
+    return np.percentile(latencies, 50) * 1e3, max(latencies) * 1e3, max(lags) * 1e3
+
+
+async def main():
+    started = multiprocessing.Event()
+    multiprocessing.Process(target=_run_stub_server, args=(started,), daemon=True).start()
+    started.wait()
+
+    fanout = HttpFanout()
+    print(f'{APPS} apps, {BATCHES} batches every {BATCH_INTERVAL_SECONDS}s, slow apps answer in {SLOW_SECONDS}s')
+    for slow_apps in (0, 5):
+        for mode in ('threads', 'fanout'):
+            p50, worst, lag = await bench(mode, slow_apps, fanout)
+            print(f'{mode:>8} {slow_apps} slow: batch p50 {p50:7.1f} ms  max {worst:7.1f} ms  loop lag max {lag:7.1f} ms')
+    await fanout.close()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
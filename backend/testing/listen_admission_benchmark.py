@@ -0,0 +1,77 @@
+# Latency of running listen sessions while new ones keep arriving, with and without admission control.
+#
+# Every simulated session does a fixed slice of work on the event loop per 20ms audio frame, a new
+# session arrives every 200ms, so the process saturates part way through. Frame lateness is how far
+# behind its audio a session is, it grows without bound once the loop is overloaded.
+#
+# The loop lag alone reacts only once the loop is already saturated, a session cap set from a run
+# like this one (LISTEN_ADMISSION_MAX_SESSIONS) keeps the headroom, the lag threshold stays as the
+# safety net for load the cap doesn't account for. The lag limit is off by default, the runs use
+# MAX_LOOP_LAG_SECONDS, a deployment opts in with LISTEN_ADMISSION_MAX_LOOP_LAG_SECONDS.
+#
+# Run from backend/: python -m testing.listen_admission_benchmark
+import asyncio
+import time
+
+import numpy as np
+
+from utils.other.metrics import start_event_loop_lag_monitor
+from utils.stt.admission import ListenAdmission
+
+FRAME_SECONDS = 0.02
+WORK_SECONDS = 0.0005  # event loop time per session per frame, ~40 sessions saturate the loop
+ARRIVAL_SECONDS = 0.2
+SECONDS = 20
+MAX_LOOP_LAG_SECONDS = 0.02
+MAX_SESSIONS = 32
+
+
+def _work(seconds: float):
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        pass
+
+
+async def _session(deadline: float, lateness: list, admission: ListenAdmission):
+    try:
+        next_frame = time.monotonic()
+        while time.monotonic() < deadline:
+            next_frame += FRAME_SECONDS
+            await asyncio.sleep(max(next_frame - time.monotonic(), 0))
+            lateness.append(max(time.monotonic() - next_frame, 0))
+            _work(WORK_SECONDS)
+    finally:
+        admission.release()
+
+
+async def bench(admission: ListenAdmission):
+    deadline = time.monotonic() + SECONDS
+    lateness, sessions, rejected = [], [], 0
+    while time.monotonic() < deadline:
+        if admission.admit():
+            rejected += 1
+        else:
+            sessions.append(asyncio.create_task(_session(deadline, lateness, admission)))
+        await asyncio.sleep(ARRIVAL_SECONDS)
+    await asyncio.gather(*sessions)
+
+    # the second half, once the process is loaded
+    tail = lateness[len(lateness) // 2:]
+    return len(sessions), rejected, np.percentile(tail, 50) * 1e3, np.percentile(tail, 99) * 1e3
+
+
+async def main():
+    start_event_loop_lag_monitor()
+    for name, admission in (
+            ('no admission', ListenAdmission()),
+            ('loop lag', ListenAdmission(max_loop_lag_seconds=MAX_LOOP_LAG_SECONDS)),
+            ('lag+sessions', ListenAdmission(max_sessions=MAX_SESSIONS, max_loop_lag_seconds=MAX_LOOP_LAG_SECONDS)),
+    ):
+        admitted, rejected, p50, p99 = await bench(admission)
+        print(f'{name:>12}: {admitted:>3} admitted {rejected:>3} rejected, frame lateness p50 {p50:7.2f} ms  p99 {p99:7.2f} ms')
+        # let the lag settle before the next run
+        await asyncio.sleep(2)
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,320 @@
+# End to end /v3/listen benchmark: N concurrent sessions stream recorded audio at real time into a
+# local backend that talks to the fake deepgram (testing/fake_deepgram.py) and in memory redis and
+# firestore (testing/fake_backends.py).
+#
+# Reports per session:
+# - time to first transcript, first audio frame sent to the first transcript frame received
+# - transcript latency, how long after its audio was sent a segment end arrives (the fake STT
+#   answers every second of audio, so this is the backend's share plus up to --result-seconds)
+# - backend cpu and memory, from /proc of the server process, and the sessions' own accounting
+#   from /v1/debug/listen-sessions
+#
+# Audio: a mono 16 bit WAV (pcm8 / pcm16 by its rate), an Ogg Opus file of 10ms packets at 16kHz
+# (what Omi devices send, the backend decodes 160 samples per packet), or synthesized pcm16.
+#
+# Run from backend/ (needs the backend requirements and fakeredis[lua]):
+#   python -m testing.listen_replay --sessions 50 --seconds 60 --audio recording.ogg
+import argparse
+import asyncio
+import os
+import socket
+import subprocess
+import sys
+import time
+import wave
+
+import numpy as np
+import orjson
+import websockets
+
+from utils.stt.ogg_opus import opus_packet_samples
+
+ADMIN_KEY = 'listen-replay-admin-'
+FRAME_SECONDS = 0.02
+
+
+def load_wav(path: str):
+    with wave.open(path, 'rb') as f:
+        if f.getnchannels() != 1 or f.getsampwidth() != 2 or f.getframerate() not in (8000, 16000):
+            raise SystemExit(f'{path}: needs mono 16 bit 8kHz or 16kHz audio')
+        sample_rate = f.getframerate()
+        data = f.readframes(f.getnframes())
+    frame_bytes = int(sample_rate * FRAME_SECONDS) * 2
+    frames = [data[i:i + frame_bytes] for i in range(0, len(data), frame_bytes)]
+    return 'pcm8' if sample_rate == 8000 else 'pcm16', sample_rate, [(frame, FRAME_SECONDS) for frame in frames]
+
+
+def load_ogg_opus(path: str):
+    with open(path, 'rb') as f:
+        data = f.read()
+    packets, packet, offset = [], b'', 0
+    while offset + 27 <= len(data):
+        if data[offset:offset + 4] != b'OggS':
+            raise SystemExit(f'{path}: not an ogg file')
+        segments = data[offset + 26]
+        lacing = data[offset + 27:offset + 27 + segments]
+        body = offset + 27 + segments
+        for size in lacing:
+            packet += data[body:body + size]
+            body += size
+            if size < 255:
+                packets.append(packet)
+                packet = b''
+        offset = body
+
+    # OpusHead and OpusTags first
+    packets = [p for p in packets[2:] if p]
+    durations = [opus_packet_samples(p, 16000) / 16000 for p in packets]
+    if any(abs(duration - 0.01) > 1e-6 for duration in durations):
+        print(f'{path}: packets other than 10ms, the backend decodes 10ms packets only', file=sys.stderr)
+    return 'opus', 16000, list(zip(packets, durations))
+
+
+def synthesize_pcm16(seconds: float = 30):
+    sample_rate = 16000
+    t = np.arange(int(sample_rate * seconds)) / sample_rate
+    # a warbling tone with noise, loud enough to pass a speech gate
+    signal = 0.3 * np.sin(2 * np.pi * (220 + 40 * np.sin(2 * np.pi * 3 * t)) * t)
+    signal += 0.05 * np.random.default_rng(0).standard_normal(len(t))
+    data = (np.clip(signal, -1, 1) * 32767).astype('<i2').tobytes()
+    frame_bytes = int(sample_rate * FRAME_SECONDS) * 2
+    return 'pcm16', sample_rate, [(data[i:i + frame_bytes], FRAME_SECONDS) for i in range(0, len(data), frame_bytes)]
+
+
+def load_audio(path: str):
+    if not path:
+        return synthesize_pcm16()
+    if path.endswith('.wav'):
+        return load_wav(path)
+    return load_ogg_opus(path)
+
+
+async def run_session(
+        url: str, uid: str, frames: list, seconds: float, start_delay: float, result: dict,
+):
+    await asyncio.sleep(start_delay)
+    result.update({'uid': uid, 'ttft': None, 'latencies': [], 'late_frames': 0, 'error': None})
+    try:
+        async with websockets.connect(
+                url, extra_headers={'authorization': ADMIN_KEY + uid}, max_size=None, open_timeout=30,
+        ) as ws:
+            t0 = None
+
+            async def receive():
+                async for message in ws:
+                    if message == 'ping':
+                        continue
+                    payload = orjson.loads(message)
+                    if not isinstance(payload, list) or not payload or t0 is None:
+                        continue
+                    now = time.monotonic()
+                    if result['ttft'] is None:
+                        result['ttft'] = now - t0
+                    result['latencies'].append(now - (t0 + max(segment['end'] for segment in payload)))
+
+            receiver = asyncio.create_task(receive())
+            sent = 0.0
+            t0 = time.monotonic()
+            for frame, duration in _looped(frames):
+                if sent >= seconds:
+                    break
+                delay = t0 + sent - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                elif delay < -FRAME_SECONDS:
+                    result['late_frames'] += 1
+                await ws.send(frame)
+                sent += duration
+
+            # the last results are in flight
+            await asyncio.sleep(2)
+            receiver.cancel()
+    except Exception as e:
+        result['error'] = repr(e)
+
+
+def _looped(frames: list):
+    while True:
+        yield from frames
+
+
+def _wait_for_port(port: int, process: subprocess.Popen, timeout: float = 60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        # e.g. the port is taken by a server left from an earlier run
+        if process.poll() is not None:
+            raise SystemExit(f'{process.args[2]} exited with {process.returncode}')
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise SystemExit(f'nothing listening on port {port} after {timeout}s')
+
+
+def _proc_cpu_seconds(pid: int) -> float:
+    with open(f'/proc/{pid}/stat') as f:
+        fields = f.read().rsplit(')', 1)[1].split()
+    # utime, stime
+    return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+
+def _proc_rss_bytes(pid: int) -> int:
+    with open(f'/proc/{pid}/status') as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) * 1024
+    return 0
+
+
+async def _listen_sessions(port: int):
+    import urllib.request
+    request = urllib.request.Request(
+        f'http://127.0.0.1:{port}/v1/debug/listen-sessions', headers={'secret-key': ADMIN_KEY},
+    )
+    try:
+        response = await asyncio.to_thread(urllib.request.urlopen, request, timeout=10)
+        return orjson.loads(response.read())
+    except Exception as e:
+        print(f'listen-sessions failed: {e}', file=sys.stderr)
+        return None
+
+
+def _percentiles(values: list, scale: float = 1e3) -> str:
+    if not values:
+        return 'n/a'
+    p50, p90, p99 = (np.percentile(values, p) * scale for p in (50, 90, 99))
+    return f'p50 {p50:8.1f}  p90 {p90:8.1f}  p99 {p99:8.1f}  max {max(values) * scale:8.1f}'
+
+
+async def drive(args, server_pid: int):
+    codec, sample_rate, frames = load_audio(args.audio)
+    url = (
+        f'ws://127.0.0.1:{args.port}/v3/listen?language=en&sample_rate={sample_rate}&codec={codec}'
+        f'&channels=1&include_speech_profile=false'
+    )
+    print(f'{args.sessions} sessions of {args.seconds}s {codec} {sample_rate}Hz, ramp {args.ramp}s')
+
+    rss_idle = _proc_rss_bytes(server_pid)
+    results = [{} for _ in range(args.sessions)]
+    sessions = asyncio.gather(*[
+        run_session(url, f'replay-{i}', frames, args.seconds, args.ramp * i / args.sessions, results[i])
+        for i in range(args.sessions)
+    ])
+
+    # steady state, every session started and none finished
+    await asyncio.sleep(args.ramp + 1)
+    cpu_start, wall_start = _proc_cpu_seconds(server_pid), time.monotonic()
+    steady = max(args.seconds - args.ramp - 2, 1)
+    await asyncio.sleep(steady / 2)
+    debug = await _listen_sessions(args.port)
+    rss_loaded = _proc_rss_bytes(server_pid)
+    await asyncio.sleep(steady / 2)
+    cpu = _proc_cpu_seconds(server_pid) - cpu_start
+    wall = time.monotonic() - wall_start
+    await sessions
+
+    failed = [r for r in results if r.get('error') or r.get('ttft') is None]
+    ttft = [r['ttft'] for r in results if r.get('ttft') is not None]
+    # the fake answers every --result-seconds, so the first one is expected after that much audio
+    latencies = [latency for r in results for latency in r.get('latencies', [])]
+    late_frames = sum(r.get('late_frames', 0) for r in results)
+
+    print(f'sessions: {args.sessions - len(failed)} ok, {len(failed)} without transcript')
+    for r in failed[:5]:
+        print(f'  {r.get("uid")}: {r.get("error") or "no transcript"}')
+    print(f'time to first transcript (ms): {_percentiles(ttft)}')
+    print(f'transcript latency (ms):       {_percentiles(latencies)}')
+    print(f'client frames sent late:       {late_frames}')
+    print(f'server cpu per session:        {cpu / wall / args.sessions * 100:.2f}% of a core '
+          f'({cpu / wall * 100:.1f}% total)')
+    print(f'server rss per session:        {(rss_loaded - rss_idle) / args.sessions / 1024:.0f} KiB '
+          f'(idle {rss_idle / 2 ** 20:.0f} MiB, loaded {rss_loaded / 2 ** 20:.0f} MiB)')
+    if debug and debug['sessions']:
+        totals = [session['memory']['total'] for session in debug['sessions']]
+        print(f'accounted session memory:      {debug["count"]} sessions, mean {np.mean(totals) / 1024:.0f} KiB, '
+              f'max {max(totals) / 1024:.0f} KiB')
+
+
+def serve(args):
+    """The backend under test, /v3/listen and the debug endpoints on fakes."""
+    from testing.fake_backends import install_fake_backends, seed_users
+    db = install_fake_backends()
+    seed_users(db, [f'replay-{i}' for i in range(args.sessions)])
+
+    import firebase_admin
+    import uvicorn
+    from fastapi import FastAPI
+
+    from routers import metrics, transcribe
+    from utils.other.metrics import start_event_loop_lag_monitor
+
+    # the admin key auth never reaches firebase, the app only has to exist
+    firebase_admin.initialize_app(options={'projectId': 'listen-replay'})
+
+    app = FastAPI()
+    app.include_router(transcribe.router)
+    app.include_router(metrics.router)
+
+    @app.on_event('startup')
+    async def startup():
+        start_event_loop_lag_monitor()
+
+    uvicorn.run(app, host='127.0.0.1', port=args.port, log_level=os.getenv('LISTEN_REPLAY_LOG_LEVEL', 'warning'), ws_max_size=2 ** 24)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('mode', nargs='?', default='run', choices=('run', 'serve'))
+    parser.add_argument('--sessions', type=int, default=10)
+    parser.add_argument('--seconds', type=float, default=30)
+    parser.add_argument('--ramp', type=float, default=5, help='seconds over which the sessions start')
+    parser.add_argument('--audio', default='', help='.wav or ogg opus file, synthesized pcm16 if empty')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--stt-port', type=int, default=8766)
+    parser.add_argument('--result-seconds', type=float, default=1.0)
+    parser.add_argument('--stt-latency', type=float, default=0.0)
+    args = parser.parse_args()
+
+    if args.mode == 'serve':
+        serve(args)
+        return
+
+    env = dict(
+        os.environ,
+        ADMIN_KEY=ADMIN_KEY,
+        DEEPGRAM_SELF_HOSTED_ENABLED='true',
+        DEEPGRAM_SELF_HOSTED_URL=f'ws://127.0.0.1:{args.stt_port}',
+        CONVERSATION_FINALIZE_SCHEDULER='false',
+        LISTEN_ADMISSION_MAX_LOOP_LAG_SECONDS='0',
+        HOSTED_PUSHER_API_URL='',
+        NO_SOCKET_TIMEOUT='true',
+    )
+    processes = [
+        subprocess.Popen([
+            sys.executable, '-m', 'testing.fake_deepgram', '--port', str(args.stt_port),
+            '--result-seconds', str(args.result_seconds), '--latency', str(args.stt_latency),
+        ], env=env),
+    ]
+    try:
+        _wait_for_port(args.stt_port, processes[0])
+        server = subprocess.Popen([
+            sys.executable, '-m', 'testing.listen_replay', 'serve', '--port', str(args.port),
+            '--sessions', str(args.sessions),
+        ], env=env, stdout=subprocess.DEVNULL if not os.getenv('LISTEN_REPLAY_VERBOSE') else None)
+        processes.append(server)
+        _wait_for_port(args.port, server)
+        asyncio.run(drive(args, server.pid))
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            try:
+                process.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                print(f'{process.args[2]} did not stop, killed', file=sys.stderr)
+                process.kill()
+
+
+if __name__ == '__main__':
+    main()
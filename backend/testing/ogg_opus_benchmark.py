@@ -0,0 +1,64 @@
+# Micro-benchmark for the Ogg Opus pages streamed to deepgram on the opus passthrough path.
+#
+# Reports the cost of the page crc, the python loop it replaced against the zlib based one, and of a
+# whole OggOpusWriter page per packets per page. A 16kHz session sends 100 packets of ~40-80 bytes a
+# second, at 5 packets per page that's 20 pages a second per session on the event loop.
+#
+# Run from backend/: python -m testing.ogg_opus_benchmark
+import os
+import time
+
+from utils.stt.ogg_opus import OggOpusWriter, _ogg_crc
+
+PACKET_BYTES = 60
+ITERATIONS = 20_000
+
+
+def _crc_table():
+    table = []
+    for i in range(256):
+        crc = i << 24
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x04C11DB7) if crc & 0x80000000 else (crc << 1)
+        table.append(crc & 0xFFFFFFFF)
+    return table
+
+
+_CRC_TABLE = _crc_table()
+
+
+def _ogg_crc_loop(data: bytes) -> int:
+    crc = 0
+    for byte in data:
+        crc = ((crc << 8) & 0xFFFFFFFF) ^ _CRC_TABLE[((crc >> 24) & 0xFF) ^ byte]
+    return crc
+
+
+def bench_crc():
+    for packets in (1, 5, 20):
+        page = os.urandom(27 + packets + packets * PACKET_BYTES)
+        assert _ogg_crc(page) == _ogg_crc_loop(page)
+        for name, crc in (('loop', _ogg_crc_loop), ('zlib', _ogg_crc)):
+            start = time.perf_counter()
+            for _ in range(ITERATIONS):
+                crc(page)
+            elapsed = time.perf_counter() - start
+            print(f'crc {name} {len(page):>5} byte page: {elapsed / ITERATIONS * 1e6:8.2f} us')
+
+
+def bench_writer():
+    packet = os.urandom(PACKET_BYTES)
+    for packets_per_page in (1, 5, 20):
+        writer = OggOpusWriter(16000, packets_per_page=packets_per_page)
+        start = time.perf_counter()
+        for _ in range(ITERATIONS):
+            writer.write(packet)
+        elapsed = time.perf_counter() - start
+        # the session budget, 100 packets a second
+        print(f'writer {packets_per_page:>2} packets/page: {elapsed / ITERATIONS * 1e6:6.2f} us/packet, '
+              f'{elapsed / ITERATIONS * 100 * 1e3:.3f} ms per session second')
+
+
+if __name__ == '__main__':
+    bench_crc()
+    bench_writer()
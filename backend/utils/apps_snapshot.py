@@ -0,0 +1,152 @@
+import asyncio
+import json
+import os
+import threading
+import time
+from typing import Dict, List, Optional, Set
+
+from database import redis_db
+from models.app import App
+from utils.apps import get_available_apps
+from utils.other.metrics import Counter, Gauge
+
+# Rebuilt on the next batch after this long even without an invalidation, missed pub/sub messages heal
+apps_snapshot_max_age_seconds = int(os.getenv('APPS_SNAPSHOT_MAX_AGE_SECONDS', 60 * 10))
+
+apps_snapshots_active = Gauge('apps_snapshots_active', 'Pusher sessions holding an apps snapshot')
+apps_snapshot_builds_total = Counter('apps_snapshot_builds_total', 'Apps snapshots built', ('reason',))
+apps_snapshot_invalidations_total = Counter(
+    'apps_snapshot_invalidations_total', 'Apps changed messages received, by the kind of change', ('kind',),
+)
+
+
+class AppsSnapshot:
+    """
+    The user's enabled apps that a pusher session delivers to, resolved once instead of every batch.
+
+    `get` returns the snapshot as is while it's fresh, without I/O. It's rebuilt from
+    `get_available_apps` once `invalidate` marked it stale, on an apps changed message for the user
+    or one of their enabled apps, or after `apps_snapshot_max_age_seconds`.
+    """
+
+    def __init__(self, uid: str):
+        self.uid = uid
+        self.realtime: List[App] = []
+        self.audio_bytes: List[App] = []
+        self.enabled_ids: Set[str] = set()
+        self.built_at = 0.0
+        self.stale = True
+        self._lock = asyncio.Lock()
+
+    def invalidate(self):
+        self.stale = True
+
+    async def get(self) -> 'AppsSnapshot':
+        if not self.stale and time.monotonic() - self.built_at < apps_snapshot_max_age_seconds:
+            return self
+        async with self._lock:
+            if self.stale or time.monotonic() - self.built_at >= apps_snapshot_max_age_seconds:
+                await self._build()
+        return self
+
+    async def _build(self):
+        apps_snapshot_builds_total.labels(reason='initial' if not self.built_at else 'refresh').inc()
+        # a message arriving while this builds marks it stale again
+        self.stale = False
+        try:
+            apps = await asyncio.to_thread(get_available_apps, self.uid)
+        except Exception as e:
+            print(f'AppsSnapshot build failed: {e}', self.uid)
+            self.stale = True
+            return
+
+        enabled = [app for app in apps if app.enabled and not app.deleted]
+        self.enabled_ids = {app.id for app in enabled}
+        self.realtime = [
+            app for app in enabled if app.triggers_realtime() and app.external_integration.webhook_url
+        ]
+        self.audio_bytes = [
+            app for app in enabled if app.triggers_realtime_audio_bytes() and app.external_integration.webhook_url
+        ]
+        self.built_at = time.monotonic()
+
+
+_snapshots: Dict[str, Set[AppsSnapshot]] = {}
+_loop: Optional[asyncio.AbstractEventLoop] = None
+_listener: Optional[threading.Thread] = None
+
+
+def register_apps_snapshot(snapshot: AppsSnapshot):
+    _snapshots.setdefault(snapshot.uid, set()).add(snapshot)
+    apps_snapshots_active.inc()
+    _start_apps_changed_listener()
+
+
+def unregister_apps_snapshot(snapshot: AppsSnapshot):
+    snapshots = _snapshots.get(snapshot.uid)
+    if not snapshots or snapshot not in snapshots:
+        return
+    snapshots.discard(snapshot)
+    if not snapshots:
+        del _snapshots[snapshot.uid]
+    apps_snapshots_active.dec()
+
+
+def _on_apps_changed(message: dict):
+    if uid := message.get('uid'):
+        apps_snapshot_invalidations_total.labels(kind='user').inc()
+        for snapshot in _snapshots.get(uid, ()):
+            snapshot.invalidate()
+    elif app_id := message.get('app_id'):
+        # rare, a scan over the sessions is fine
+        apps_snapshot_invalidations_total.labels(kind='app').inc()
+        for snapshots in _snapshots.values():
+            for snapshot in snapshots:
+                if app_id in snapshot.enabled_ids:
+                    snapshot.invalidate()
+
+
+def _invalidate_all():
+    for snapshots in _snapshots.values():
+        for snapshot in snapshots:
+            snapshot.invalidate()
+
+
+def _listen_apps_changed():
+    # blocking redis client, so a thread, the snapshots are only touched from the event loop
+    backoff, resubscribed, pubsub = 1, False, None
+    while True:
+        try:
+            pubsub = redis_db.apps_changed_pubsub()
+            # messages may have been missed while not subscribed
+            if resubscribed:
+                _loop.call_soon_threadsafe(_invalidate_all)
+            backoff = 1
+            while True:
+                message = pubsub.get_message(timeout=1.0)
+                if not message or message['type'] != 'message':
+                    continue
+                try:
+                    data = json.loads(message['data'])
+                except ValueError:
+                    continue
+                _loop.call_soon_threadsafe(_on_apps_changed, data)
+        except Exception as e:
+            print(f'apps changed listener error, resubscribing in {backoff}s: {e}')
+            resubscribed = True
+            if pubsub is not None:
+                try:
+                    pubsub.close()
+                except Exception:
+                    pass
+            time.sleep(backoff)
+            backoff = min(backoff * 2, 30)
+
+
+def _start_apps_changed_listener():
+    global _loop, _listener
+    if _listener is not None:
+        return
+    _loop = asyncio.get_running_loop()
+    _listener = threading.Thread(target=_listen_apps_changed, name='apps-changed-listener', daemon=True)
+    _listener.start()
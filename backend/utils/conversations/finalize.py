@@ -0,0 +1,138 @@
+import asyncio
+import os
+import time
+from datetime import datetime, timezone
+from typing import Optional, Tuple
+
+import database.conversations as conversations_db
+from database import redis_db
+from models.conversation import Conversation, ConversationStatus, Geolocation
+from utils.conversations.in_progress import retrieve_in_progress_conversation, conversation_creation_timeout
+from utils.conversations.location import get_google_maps_location
+from utils.conversations.process_conversation import process_conversation
+from utils.other.metrics import Counter
+from utils.plugins import trigger_external_integrations
+
+# Every backend polls the shared schedule, a claimed job is retried if not completed within the lease
+conversation_finalize_scheduler_enabled = os.getenv('CONVERSATION_FINALIZE_SCHEDULER', 'true').lower() == 'true'
+conversation_finalize_poll_seconds = float(os.getenv('CONVERSATION_FINALIZE_POLL_SECONDS', 5))
+conversation_finalize_batch = int(os.getenv('CONVERSATION_FINALIZE_BATCH', 10))
+conversation_finalize_lease_seconds = int(os.getenv('CONVERSATION_FINALIZE_LEASE_SECONDS', 600))
+# The scheduler leaves a due conversation to its listen session this long, a connected session
+# claims it at the deadline and sends memory_created itself
+conversation_finalize_grace_seconds = float(os.getenv('CONVERSATION_FINALIZE_GRACE_SECONDS', 60))
+
+conversation_finalize_total = Counter(
+    'conversation_finalize_total', 'In progress conversations finalized by the shared scheduler', ('result',),
+)
+
+_scheduler_task: Optional[asyncio.Task] = None
+
+
+def claim_conversation_finalize(uid: str, conversation_id: str) -> Tuple[bool, Optional[float]]:
+    """
+    True if the caller should finalize the conversation now, i.e. it won the claim or it was never
+    scheduled. When it isn't due yet, e.g. a segment arrived on another backend, also the seconds until it is.
+    """
+    now = time.time()
+    try:
+        claimed = redis_db.claim_conversation_finalize(uid, conversation_id, now, conversation_finalize_lease_seconds)
+        if claimed == 2:
+            finalize_at = redis_db.get_conversation_finalize_at(uid, conversation_id)
+            # claimed by the scheduler in between otherwise
+            return False, max(finalize_at - now, 0) if finalize_at is not None else None
+    except Exception as e:
+        print(f'claim_conversation_finalize failed: {e}', uid)
+        return True, None
+    return claimed != 0, None
+
+
+def complete_conversation_finalize(uid: str, conversation_id: str):
+    try:
+        redis_db.complete_conversation_finalize(uid, conversation_id)
+    except Exception as e:
+        print(f'complete_conversation_finalize failed: {e}', uid)
+
+
+def finalize_in_progress_conversation(uid: str, conversation_id: str) -> str:
+    """
+    Finalizes a claimed conversation whose listen session didn't, e.g. the pod died or the client never
+    reconnected. Returns the outcome, used as the metric label.
+    """
+    conversation = retrieve_in_progress_conversation(uid)
+    if not conversation or conversation['id'] != conversation_id:
+        return 'gone'
+    if not conversation.get('transcript_segments'):
+        return 'empty'
+
+    # a segment that arrived after the job was claimed moves the deadline
+    finished_at = conversation['finished_at']
+    if finished_at.tzinfo is None:
+        finished_at = finished_at.replace(tzinfo=timezone.utc)
+    if (datetime.now(timezone.utc) - finished_at).total_seconds() < conversation_creation_timeout:
+        redis_db.schedule_conversation_finalize(uid, conversation_id, finished_at.timestamp() + conversation_creation_timeout)
+        return 'rescheduled'
+
+    redis_db.remove_in_progress_conversation_id(uid)
+    conversation = Conversation(**conversation)
+    # the hot copy in redis may be ahead of the last checkpoint
+    conversations_db.update_conversation(uid, conversation.id, {
+        'transcript_segments': [s.dict() for s in conversation.transcript_segments],
+        'finished_at': conversation.finished_at,
+    })
+    conversations_db.update_conversation_status(uid, conversation.id, ConversationStatus.processing)
+    conversation.status = ConversationStatus.processing
+
+    try:
+        geolocation = redis_db.get_cached_user_geolocation(uid)
+        if geolocation:
+            geolocation = Geolocation(**geolocation)
+            conversation.geolocation = get_google_maps_location(geolocation.latitude, geolocation.longitude)
+
+        conversation = process_conversation(uid, conversation.language, conversation)
+        redis_db.remove_in_progress_conversation_segments(uid, conversation.id)
+        trigger_external_integrations(uid, conversation)
+    except Exception as e:
+        print(f'Error processing conversation: {e}', uid)
+        conversations_db.set_conversation_as_discarded(uid, conversation.id)
+        return 'discarded'
+    return 'finalized'
+
+
+async def _finalize(uid: str, conversation_id: str):
+    try:
+        result = await asyncio.to_thread(finalize_in_progress_conversation, uid, conversation_id)
+    except Exception as e:
+        # left in the processing set, retried once the lease expires
+        print(f'finalize_in_progress_conversation failed: {e}', uid, conversation_id)
+        conversation_finalize_total.labels(result='error').inc()
+        return
+    print('finalize_in_progress_conversation', conversation_id, result, uid)
+    conversation_finalize_total.labels(result=result).inc()
+    complete_conversation_finalize(uid, conversation_id)
+
+
+async def _run_conversation_finalize_scheduler():
+    while True:
+        await asyncio.sleep(conversation_finalize_poll_seconds)
+        try:
+            now = time.time()
+            await asyncio.to_thread(redis_db.requeue_expired_conversation_finalizes, now)
+            due_at = now - conversation_finalize_grace_seconds
+            due = await asyncio.to_thread(redis_db.get_due_conversation_finalizes, due_at, conversation_finalize_batch)
+            claimed = []
+            for uid, conversation_id in due:
+                if await asyncio.to_thread(redis_db.claim_conversation_finalize, uid, conversation_id, now,
+                                           conversation_finalize_lease_seconds, due_at) == 1:
+                    claimed.append((uid, conversation_id))
+            if claimed:
+                await asyncio.gather(*[_finalize(uid, conversation_id) for uid, conversation_id in claimed])
+        except Exception as e:
+            print(f'Conversation finalize scheduler error: {e}')
+
+
+def start_conversation_finalize_scheduler():
+    """Runs for the life of the process, call it from the app startup hook."""
+    global _scheduler_task
+    if conversation_finalize_scheduler_enabled and _scheduler_task is None:
+        _scheduler_task = asyncio.create_task(_run_conversation_finalize_scheduler())
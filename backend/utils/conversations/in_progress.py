@@ -0,0 +1,208 @@
+import os
+import time
+import uuid
+from datetime import datetime, timezone, timedelta
+from typing import List, Optional, Tuple
+
+import database.conversations as conversations_db
+from database import redis_db
+from models.conversation import Conversation, ConversationStatus, Structured
+from models.transcript_segment import TranscriptSegment
+from utils.other.memory import deep_getsizeof
+from utils.other.metrics import Histogram
+
+# How often the in progress conversation is written to firestore, redis holds it in between
+checkpoint_interval_seconds = int(os.getenv('IN_PROGRESS_CONVERSATION_CHECKPOINT_SECONDS', 30))
+
+# Silence after the last segment before the conversation is finalized
+conversation_creation_timeout = 120
+
+in_progress_firestore_write_seconds = Histogram(
+    'in_progress_firestore_write_seconds', 'Firestore writes of the in progress conversation', ('op',),
+)
+
+
+def _copy_segment_ids(segments: List[dict], last_id: Optional[str], appended: List[dict]):
+    # the tick is combined already, only its first segment can have been merged into the last one
+    merged = len(segments) - len(appended)
+    for segment, segment_id in zip(segments, [last_id] * merged + [s['id'] for s in appended]):
+        segment['id'] = segment_id
+
+
+def retrieve_in_progress_conversation(uid):
+    conversation_id = redis_db.get_in_progress_conversation_id(uid)
+    existing = None
+
+    if conversation_id:
+        existing = conversations_db.get_conversation(uid, conversation_id)
+        if existing and existing['status'] != 'in_progress':
+            existing = None
+
+    if not existing:
+        existing = conversations_db.get_in_progress_conversation(uid)
+
+    # segments received after the last checkpoint only live in redis
+    if existing:
+        if hot := redis_db.get_in_progress_conversation_segments(uid, existing['id']):
+            segments, finished_at = hot
+            existing['transcript_segments'] = segments
+            existing['finished_at'] = datetime.fromisoformat(finished_at)
+    return existing
+
+
+def _assign_segment_ids(segments: List[TranscriptSegment]) -> bool:
+    assigned = False
+    for segment in segments:
+        if not segment.id:
+            segment.id = str(uuid.uuid4())
+            assigned = True
+    return assigned
+
+
+class InProgressConversationStore:
+    """
+    Session copy of the in progress conversation.
+
+    Every tick appends to the in memory conversation and its redis hot copy,
+    firestore is only written on checkpoints and when the conversation is finalized.
+    """
+
+    def __init__(self, uid: str, language: str, checkpoint_seconds: int = checkpoint_interval_seconds):
+        self.uid = uid
+        self.language = language
+        self.checkpoint_seconds = checkpoint_seconds
+        self.conversation: Optional[Conversation] = None
+        self._checkpoint_at = 0
+        self._dirty = False
+        # approximate bytes of `conversation`, kept up to date per tick instead of walking the transcript
+        self._bytes = 0
+
+    def get(self) -> Optional[Conversation]:
+        if self.conversation:
+            # finalized somewhere else, e.g. POST /v1/conversations
+            if redis_db.get_in_progress_conversation_id(self.uid) == self.conversation.id:
+                return self.conversation
+            self.reset()
+
+        if existing := retrieve_in_progress_conversation(self.uid):
+            self.conversation = Conversation(**existing)
+            self._checkpoint_at = time.time()
+            self._bytes = deep_getsizeof(self.conversation)
+            # written before segments had ids, the hot copy gets them now so they stay stable
+            if _assign_segment_ids(self.conversation.transcript_segments):
+                self._dirty = True
+                redis_db.set_in_progress_conversation_segments(
+                    self.uid, self.conversation.id, [s.dict() for s in self.conversation.transcript_segments],
+                    self.conversation.finished_at.isoformat(),
+                    finalize_at=self._finalize_at(self.conversation.finished_at),
+                )
+        return self.conversation
+
+    def add_segments(
+            self, segments: List[dict], finished_at: datetime,
+    ) -> Tuple[Conversation, Optional[dict], List[dict]]:
+        """
+        Appends a tick of segments, returns the conversation and the delta: the last known segment if
+        it was extended (same id), and the segments appended after it. The tick's segment dicts get the
+        ids of the stored segments they ended up in.
+        """
+        conversation = self.get()
+        if not conversation:
+            conversation = self._create(segments, finished_at)
+            appended = [s.dict() for s in conversation.transcript_segments]
+            _copy_segment_ids(segments, None, appended)
+            return conversation, None, appended
+
+        count = len(conversation.transcript_segments)
+        last = conversation.transcript_segments[-1] if count else None
+        last_state = (last.text, last.end) if last else None
+        last_bytes = deep_getsizeof(last) if last else 0
+        conversation.transcript_segments = TranscriptSegment.combine_segments(
+            conversation.transcript_segments, [TranscriptSegment(**segment) for segment in segments]
+        )
+        conversation.finished_at = finished_at
+        _assign_segment_ids(conversation.transcript_segments[count:])
+
+        # the last known segment might have been extended, everything after it is new
+        appended = [s.dict() for s in conversation.transcript_segments[count:]]
+        replace_last = last.dict() if last and (last.text, last.end) != last_state else None
+        # a list slot per appended segment
+        self._bytes += sum(deep_getsizeof(s) + 8 for s in conversation.transcript_segments[count:])
+        if replace_last:
+            self._bytes += deep_getsizeof(last) - last_bytes
+        try:
+            redis_db.append_in_progress_conversation_segments(
+                self.uid, conversation.id, appended, finished_at.isoformat(), replace_last=replace_last,
+                finalize_at=self._finalize_at(finished_at),
+            )
+        except Exception as e:
+            print(f'append_in_progress_conversation_segments failed, resetting hot copy: {e}', self.uid)
+            redis_db.set_in_progress_conversation_segments(
+                self.uid, conversation.id, [s.dict() for s in conversation.transcript_segments],
+                finished_at.isoformat(), finalize_at=self._finalize_at(finished_at),
+            )
+            redis_db.set_in_progress_conversation_id(self.uid, conversation.id)
+
+        self._dirty = True
+        self.checkpoint()
+        _copy_segment_ids(segments, last.id if last else None, appended)
+        return conversation, replace_last, appended
+
+    def _create(self, segments: List[dict], finished_at: datetime) -> Conversation:
+        started_at = datetime.now(timezone.utc) - timedelta(seconds=segments[0]['end'] - segments[0]['start'])
+        conversation = Conversation(
+            id=str(uuid.uuid4()),
+            uid=self.uid,
+            structured=Structured(),
+            language=self.language,
+            created_at=started_at,
+            started_at=started_at,
+            finished_at=finished_at,
+            transcript_segments=[TranscriptSegment(**segment) for segment in segments],
+            status=ConversationStatus.in_progress,
+        )
+        _assign_segment_ids(conversation.transcript_segments)
+        print('_get_in_progress_conversation new', conversation, self.uid)
+        start = time.monotonic()
+        conversations_db.upsert_conversation(self.uid, conversation_data=conversation.dict())
+        in_progress_firestore_write_seconds.labels(op='create').observe(time.monotonic() - start)
+        redis_db.set_in_progress_conversation_segments(
+            self.uid, conversation.id, [s.dict() for s in conversation.transcript_segments], finished_at.isoformat(),
+            finalize_at=self._finalize_at(finished_at),
+        )
+        redis_db.set_in_progress_conversation_id(self.uid, conversation.id)
+
+        self.conversation = conversation
+        self._checkpoint_at = time.time()
+        self._dirty = False
+        self._bytes = deep_getsizeof(conversation)
+        return conversation
+
+    @staticmethod
+    def _finalize_at(finished_at: datetime) -> float:
+        # any backend finalizes it if this session is gone by then, see utils/conversations/finalize.py
+        return finished_at.timestamp() + conversation_creation_timeout
+
+    def checkpoint(self, force: bool = False) -> bool:
+        if not self.conversation or not self._dirty:
+            return False
+        if not force and time.time() - self._checkpoint_at < self.checkpoint_seconds:
+            return False
+
+        start = time.monotonic()
+        conversations_db.update_conversation(self.uid, self.conversation.id, {
+            'transcript_segments': [s.dict() for s in self.conversation.transcript_segments],
+            'finished_at': self.conversation.finished_at,
+        })
+        in_progress_firestore_write_seconds.labels(op='checkpoint').observe(time.monotonic() - start)
+        self._checkpoint_at = time.time()
+        self._dirty = False
+        return True
+
+    def reset(self):
+        self.conversation = None
+        self._dirty = False
+        self._bytes = 0
+
+    def memory_usage(self) -> int:
+        return self._bytes
@@ -0,0 +1,65 @@
+import os
+from datetime import datetime
+from typing import Optional
+
+import database.conversations as conversations_db
+import database.users as user_db
+from database import redis_db
+from utils.apps import is_audio_bytes_app_enabled
+from utils.conversations.in_progress import retrieve_in_progress_conversation
+from utils.webhooks import get_audio_bytes_webhook_seconds
+
+listen_session_descriptor_ttl = int(os.getenv('LISTEN_SESSION_DESCRIPTOR_TTL_SECONDS', 60 * 60))
+
+
+def _build_listen_session_descriptor(uid: str) -> Optional[dict]:
+    if not user_db.is_exists_user(uid):
+        return None
+
+    in_progress = None
+    if conversation := retrieve_in_progress_conversation(uid):
+        started_at = conversation.get('started_at') or conversation['created_at']
+        in_progress = {
+            'id': conversation['id'],
+            'started_at': started_at.isoformat(),
+            'finished_at': conversation['finished_at'].isoformat(),
+        }
+
+    last_completed = conversations_db.get_last_completed_conversation(uid)
+    return {
+        'user_exists': True,
+        'in_progress': in_progress,
+        'processing_ids': [conversation['id'] for conversation in conversations_db.get_processing_conversations(uid)],
+        'last_completed_id': last_completed['id'] if last_completed else None,
+        'audio_bytes_webhook_seconds': get_audio_bytes_webhook_seconds(uid),
+        'audio_bytes_app_enabled': is_audio_bytes_app_enabled(uid),
+    }
+
+
+def get_listen_session_descriptor(uid: str) -> Optional[dict]:
+    """
+    Everything /v3/listen needs before audio can flow, from a single redis round trip when cached.
+
+    None if the user doesn't exist. The in progress `finished_at` comes from the last tick written by
+    the session that owns the conversation, the cached value is only the one seen at build time.
+    """
+    try:
+        descriptor, version, last_tick = redis_db.get_listen_session_descriptor(uid)
+    except Exception as e:
+        print(f'get_listen_session_descriptor failed, building it: {e}', uid)
+        return _build_listen_session_descriptor(uid)
+
+    if not descriptor:
+        descriptor = _build_listen_session_descriptor(uid)
+        if not descriptor:
+            return None
+        try:
+            redis_db.cache_listen_session_descriptor(uid, descriptor, version, ttl=listen_session_descriptor_ttl)
+        except Exception as e:
+            print(f'cache_listen_session_descriptor failed: {e}', uid)
+
+    in_progress = descriptor.get('in_progress')
+    if in_progress and last_tick and last_tick['id'] == in_progress['id'] \
+            and datetime.fromisoformat(last_tick['finished_at']) > datetime.fromisoformat(in_progress['finished_at']):
+        in_progress['finished_at'] = last_tick['finished_at']
+    return descriptor
@@ -0,0 +1,403 @@
+import os
+import sys
+import threading
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Tuple
+
+from utils.other.memory import deep_getsizeof
+from utils.other.metrics import Counter
+
+buffer_dropped_total = Counter(
+    'listen_buffer_dropped_total', 'Items dropped by the bounded listen buffers on overflow', ('buffer', 'unit'),
+)
+buffer_coalesced_total = Counter(
+    'listen_buffer_coalesced_total', 'Segments merged by the bounded listen buffers on overflow', ('buffer',),
+)
+buffer_spilled_bytes_total = Counter(
+    'listen_buffer_spilled_bytes_total', 'Bytes spilled to disk by the bounded listen buffers', ('buffer',),
+)
+
+DROP_OLDEST = 'drop_oldest'
+COALESCE = 'coalesce'
+SPILL = 'spill'
+
+# Spill files are written off the event loop, shared by every buffer of the process
+_spill_executor = ThreadPoolExecutor(max_workers=int(os.getenv('LISTEN_BUFFER_SPILL_THREADS', 2)),
+                                     thread_name_prefix='buffer-spill')
+
+
+class AudioRingBuffer:
+    """
+    Bounded byte buffer between the audio receiver and a consumer that may be stalled, e.g. the pusher.
+
+    Holds at most `max_bytes` in memory; on overflow the oldest audio is dropped (`drop_oldest`) or moved
+    to a spill file on disk (`spill`) which is itself capped by `max_spill_bytes`, past it the oldest
+    spilled audio is dropped so what's kept stays contiguous. Consumers read with `read(max_bytes)` so a
+    backlog goes out as several bounded frames, not one huge one.
+
+    The spill file is a ring of `max_spill_bytes` written by `_spill_executor`, `extend` never touches the
+    disk. `read` does once audio was spilled, call it from a thread then.
+    """
+
+    def __init__(
+            self, name: str, max_bytes: int, policy: str = DROP_OLDEST, max_spill_bytes: int = 0,
+            spill_dir: str = '_temp', frame_bytes: int = 2,
+    ):
+        if policy not in (DROP_OLDEST, SPILL):
+            raise ValueError(f'Unsupported audio buffer policy: {policy}')
+
+        self.name = name
+        # whole samples only, so the consumer never gets half a frame
+        self.frame_bytes = max(frame_bytes, 1)
+        self.max_bytes = max(max_bytes - max_bytes % self.frame_bytes, self.frame_bytes)
+        self.policy = policy
+        self.max_spill_bytes = max_spill_bytes - max_spill_bytes % self.frame_bytes
+        self.spill_dir = spill_dir
+
+        self._buffer = bytearray()
+        self._lock = threading.Lock()
+        # spilled audio as offsets into an endless stream, the file holds [head, tail) at offset % max_spill_bytes
+        # and the writer has [tail, tail + len(writing)) in flight, pending follows it
+        self._spill_path: Optional[str] = None
+        self._spill_fd: Optional[int] = None
+        self._spill_head = 0
+        self._spill_tail = 0
+        self._spill_writing = b''
+        self._spill_pending = bytearray()
+        self._spill_scheduled = False
+        self._closed = False
+
+        self.dropped_bytes = 0
+        self.spilled_bytes = 0
+
+    def _spill_end(self) -> int:
+        return self._spill_tail + len(self._spill_writing) + len(self._spill_pending)
+
+    def __len__(self):
+        return len(self._buffer) + self._spill_end() - self._spill_head
+
+    def extend(self, data: bytes):
+        with self._lock:
+            self._buffer.extend(data)
+            overflow = len(self._buffer) - self.max_bytes
+            if overflow <= 0:
+                return
+            overflow += (-overflow) % self.frame_bytes
+
+            if self.policy == SPILL and self.max_spill_bytes > 0 and not self._closed:
+                self._spill(self._buffer[:overflow])
+                del self._buffer[:overflow]
+                # over the spill cap the oldest audio overall goes, the head of the spill
+                excess = self._spill_end() - self._spill_head - self.max_spill_bytes
+                if excess > 0:
+                    self._spill_head += excess
+                    self._drop(excess)
+                return
+
+            del self._buffer[:overflow]
+            self._drop(overflow)
+
+    def read(self, max_bytes: int = 0) -> bytes:
+        """Oldest audio first, at most `max_bytes` (0 for everything)."""
+        with self._lock:
+            size = len(self)
+            if max_bytes > 0:
+                size = min(size, max_bytes - max_bytes % self.frame_bytes)
+
+            data = bytearray()
+            if size > 0 and self._spill_head < self._spill_end():
+                data.extend(self._unspill(size))
+            take = size - len(data)
+            if take > 0:
+                data.extend(self._buffer[:take])
+                del self._buffer[:take]
+            return bytes(data)
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+            self._buffer = bytearray()
+            self._spill_pending = bytearray()
+            self._spill_head = self._spill_end()
+            # the writer removes the file once its write is done
+            if not self._spill_scheduled:
+                self._remove_spill()
+
+    def stats(self) -> dict:
+        return {'buffered_bytes': len(self), 'dropped_bytes': self.dropped_bytes, 'spilled_bytes': self.spilled_bytes}
+
+    def memory_usage(self) -> int:
+        # the spilled audio is on disk once written
+        with self._lock:
+            return sys.getsizeof(self._buffer) + sys.getsizeof(self._spill_pending) + len(self._spill_writing)
+
+    def _drop(self, size: int):
+        self.dropped_bytes += size
+        buffer_dropped_total.labels(buffer=self.name, unit='bytes').inc(size)
+
+    def _spill(self, data: bytes):
+        self._spill_pending.extend(data)
+        self.spilled_bytes += len(data)
+        buffer_spilled_bytes_total.labels(buffer=self.name).inc(len(data))
+        if not self._spill_scheduled:
+            self._spill_scheduled = True
+            _spill_executor.submit(self._write_spill)
+
+    def _ring(self, offset: int, size: int) -> List[Tuple[int, int]]:
+        # file positions of a stream range, split where it wraps
+        position = offset % self.max_spill_bytes
+        first = min(size, self.max_spill_bytes - position)
+        return [(position, first)] + ([(0, size - first)] if size > first else [])
+
+    def _write_spill(self):
+        while True:
+            with self._lock:
+                if self._closed:
+                    self._spill_scheduled = False
+                    self._remove_spill()
+                    return
+                # read meanwhile, not worth writing
+                skip = min(max(self._spill_head - self._spill_tail, 0), len(self._spill_pending))
+                if skip:
+                    self._spill_tail += skip
+                    del self._spill_pending[:skip]
+                if not self._spill_pending:
+                    self._spill_scheduled = False
+                    return
+                data = self._spill_writing = bytes(self._spill_pending)
+                self._spill_pending = bytearray()
+                offset = self._spill_tail
+
+            try:
+                if self._spill_fd is None:
+                    os.makedirs(self.spill_dir, exist_ok=True)
+                    self._spill_path = os.path.join(self.spill_dir, f'{self.name}_{uuid.uuid4()}.spill')
+                    self._spill_fd = os.open(self._spill_path, os.O_RDWR | os.O_CREAT, 0o600)
+                # outside the lock, the range is past the tail, nothing reads it from the file yet
+                written = 0
+                for position, size in self._ring(offset, len(data)):
+                    os.pwrite(self._spill_fd, data[written:written + size], position)
+                    written += size
+            except OSError as e:
+                print(f'{self.name} spill write failed: {e}')
+                with self._lock:
+                    # lost, the head skips it so what's left stays in order
+                    self._spill_tail += len(data)
+                    self._spill_writing = b''
+                    lost = self._spill_tail - self._spill_head
+                    if lost > 0:
+                        self._spill_head = self._spill_tail
+                        self._drop(lost)
+                continue
+
+            with self._lock:
+                self._spill_tail += len(data)
+                self._spill_writing = b''
+
+    def _unspill(self, size: int) -> bytes:
+        data = bytearray()
+        head = self._spill_head
+        if head < self._spill_tail:
+            count = min(size, self._spill_tail - head)
+            for position, length in self._ring(head, count):
+                data.extend(os.pread(self._spill_fd, length, position))
+            head += count
+
+        # not written yet, read from memory
+        start = self._spill_tail
+        for chunk in (self._spill_writing, self._spill_pending):
+            if len(data) < size and head < start + len(chunk):
+                part = chunk[max(head - start, 0):max(head - start, 0) + size - len(data)]
+                data.extend(part)
+                head += len(part)
+            start += len(chunk)
+        self._spill_head = head
+        return data
+
+    def _remove_spill(self):
+        if self._spill_fd is not None:
+            os.close(self._spill_fd)
+            self._spill_fd = None
+        if self._spill_path and os.path.exists(self._spill_path):
+            os.remove(self._spill_path)
+        self._spill_path = None
+
+
+class AudioPacketBuffer:
+    """
+    Bounded buffer of encoded audio packets (e.g. opus), which can't be cut at arbitrary bytes.
+
+    Holds at most `max_bytes` of packets and drops the oldest whole packets on overflow.
+    """
+
+    def __init__(self, name: str, max_bytes: int):
+        self.name = name
+        self.max_bytes = max_bytes
+        self._packets = deque()
+        self._size = 0
+        self._lock = threading.Lock()
+
+        self.dropped_bytes = 0
+
+    def __len__(self):
+        return self._size
+
+    def extend(self, packet: bytes):
+        with self._lock:
+            self._packets.append(packet)
+            self._size += len(packet)
+            dropped = 0
+            while self._size > self.max_bytes and len(self._packets) > 1:
+                size = len(self._packets.popleft())
+                self._size -= size
+                dropped += size
+            if dropped:
+                self.dropped_bytes += dropped
+                buffer_dropped_total.labels(buffer=self.name, unit='bytes').inc(dropped)
+
+    def read(self, max_bytes: int = 0) -> List[bytes]:
+        """Oldest packets first, at most `max_bytes` of them (0 for everything) but at least one."""
+        with self._lock:
+            packets = []
+            size = 0
+            while self._packets and (max_bytes <= 0 or not packets or size + len(self._packets[0]) <= max_bytes):
+                packet = self._packets.popleft()
+                size += len(packet)
+                packets.append(packet)
+            self._size -= size
+            return packets
+
+    def close(self):
+        with self._lock:
+            self._packets.clear()
+            self._size = 0
+
+    def stats(self) -> dict:
+        return {'buffered_bytes': self._size, 'dropped_bytes': self.dropped_bytes, 'spilled_bytes': 0}
+
+    def memory_usage(self) -> int:
+        with self._lock:
+            return deep_getsizeof(self._packets)
+
+
+class SegmentBuffer:
+    """
+    Bounded buffer of transcript segment dicts.
+
+    On overflow `coalesce` merges the oldest consecutive segments of the same speaker and segment id
+    so no text is lost, then falls back to dropping the oldest segments; `drop_oldest` drops them
+    straight away.
+    """
+
+    def __init__(self, name: str, max_segments: int, policy: str = COALESCE):
+        if policy not in (DROP_OLDEST, COALESCE):
+            raise ValueError(f'Unsupported segment buffer policy: {policy}')
+
+        self.name = name
+        self.max_segments = max(max_segments, 1)
+        self.policy = policy
+        self._segments = deque()
+        self._lock = threading.Lock()
+
+        self.dropped_segments = 0
+        self.coalesced_segments = 0
+
+    def __len__(self):
+        return len(self._segments)
+
+    def extend(self, segments: List[dict]):
+        with self._lock:
+            self._segments.extend(segments)
+            overflow = len(self._segments) - self.max_segments
+            if overflow <= 0:
+                return
+
+            if self.policy == COALESCE:
+                overflow -= self._coalesce(overflow)
+
+            if overflow > 0:
+                for _ in range(overflow):
+                    self._segments.popleft()
+                self.dropped_segments += overflow
+                buffer_dropped_total.labels(buffer=self.name, unit='segments').inc(overflow)
+
+    def drain(self) -> List[dict]:
+        with self._lock:
+            segments = list(self._segments)
+            self._segments.clear()
+            return segments
+
+    def stats(self) -> dict:
+        return {
+            'buffered_segments': len(self._segments),
+            'dropped_segments': self.dropped_segments,
+            'coalesced_segments': self.coalesced_segments,
+        }
+
+    def memory_usage(self) -> int:
+        with self._lock:
+            return deep_getsizeof(self._segments)
+
+    def _coalesce(self, target: int) -> int:
+        merged = []
+        count = 0
+        while self._segments:
+            segment = self._segments.popleft()
+            last = merged[-1] if merged else None
+            # segments with different ids stay apart, the consumers key on the id
+            if count < target and last is not None and last.get('id') == segment.get('id') \
+                    and last.get('speaker') == segment.get('speaker') and last.get('is_user') == segment.get('is_user'):
+                # copied, the segment dicts are shared with the other consumers
+                merged[-1] = {
+                    **last, 'text': f"{last['text']} {segment['text']}".strip(), 'end': max(last['end'], segment['end']),
+                }
+                count += 1
+            else:
+                merged.append(segment)
+
+        self._segments.extend(merged)
+        if count:
+            self.coalesced_segments += count
+            buffer_coalesced_total.labels(buffer=self.name).inc(count)
+        return count
+
+
+# Listen pipeline limits, per session
+pusher_audio_buffer_seconds = float(os.getenv('PUSHER_AUDIO_BUFFER_SECONDS', 60))
+pusher_audio_buffer_max_bytes = int(os.getenv('PUSHER_AUDIO_BUFFER_MAX_BYTES', 0))  # 0, derived from the seconds
+pusher_audio_buffer_policy = os.getenv('PUSHER_AUDIO_BUFFER_POLICY', DROP_OLDEST)
+pusher_audio_spill_seconds = float(os.getenv('PUSHER_AUDIO_SPILL_SECONDS', 600))
+pusher_audio_max_frame_seconds = float(os.getenv('PUSHER_AUDIO_MAX_FRAME_SECONDS', 5))
+pusher_segment_buffer_max = int(os.getenv('PUSHER_SEGMENT_BUFFER_MAX', 200))
+pusher_segment_buffer_policy = os.getenv('PUSHER_SEGMENT_BUFFER_POLICY', COALESCE)
+realtime_segment_buffer_max = int(os.getenv('LISTEN_SEGMENT_BUFFER_MAX', 500))
+realtime_segment_buffer_policy = os.getenv('LISTEN_SEGMENT_BUFFER_POLICY', COALESCE)
+
+
+def new_pusher_audio_buffer(sample_rate: int) -> AudioRingBuffer:
+    bytes_per_second = sample_rate * 2
+    max_bytes = pusher_audio_buffer_max_bytes or int(pusher_audio_buffer_seconds * bytes_per_second)
+    return AudioRingBuffer(
+        'pusher_audio', max_bytes, policy=pusher_audio_buffer_policy,
+        max_spill_bytes=int(pusher_audio_spill_seconds * bytes_per_second),
+    )
+
+
+def new_pusher_audio_packet_buffer(sample_rate: int) -> AudioPacketBuffer:
+    # same memory bound as the decoded audio, encoded packets cover a lot more seconds with it
+    max_bytes = pusher_audio_buffer_max_bytes or int(pusher_audio_buffer_seconds * sample_rate * 2)
+    return AudioPacketBuffer('pusher_audio_packets', max_bytes)
+
+
+def pusher_audio_max_frame_bytes(sample_rate: int) -> int:
+    return int(pusher_audio_max_frame_seconds * sample_rate) * 2
+
+
+def new_pusher_segment_buffer() -> SegmentBuffer:
+    return SegmentBuffer('pusher_segments', pusher_segment_buffer_max, policy=pusher_segment_buffer_policy)
+
+
+def new_realtime_segment_buffer() -> SegmentBuffer:
+    return SegmentBuffer('realtime_segments', realtime_segment_buffer_max, policy=realtime_segment_buffer_policy)
@@ -0,0 +1,212 @@
+import asyncio
+import os
+import threading
+import time
+from typing import Dict, List, Optional, Set, Tuple
+from urllib.parse import urlsplit
+
+import httpx
+import requests
+
+from database import redis_db
+from utils.other.metrics import Counter, Gauge
+
+# Shared by every process through redis, one per host and target (an app, a user's webhook), a target
+# failing doesn't cut off the others on its host
+circuit_breakers_enabled = os.getenv('CIRCUIT_BREAKERS', 'true').lower() == 'true'
+# The rolling window, in buckets, the breaker opens when enough of its requests failed or were slow
+circuit_bucket_seconds = int(os.getenv('CIRCUIT_BUCKET_SECONDS', 10))
+circuit_window_buckets = int(os.getenv('CIRCUIT_WINDOW_BUCKETS', 6))
+circuit_min_requests = int(os.getenv('CIRCUIT_MIN_REQUESTS', 20))
+circuit_error_rate = float(os.getenv('CIRCUIT_ERROR_RATE', 0.5))
+# Slower responses count as slow, callers waiting longer than this raise it to their own timeout
+circuit_slow_seconds = float(os.getenv('CIRCUIT_SLOW_SECONDS', 5))
+circuit_slow_rate = float(os.getenv('CIRCUIT_SLOW_RATE', 0.8))
+# Open this long, doubled every time it opens again within a day
+circuit_open_seconds = float(os.getenv('CIRCUIT_OPEN_SECONDS', 30))
+circuit_max_open_seconds = float(os.getenv('CIRCUIT_MAX_OPEN_SECONDS', 60 * 10))
+# Half open, successful probes across the processes that close it, one probe in flight per process
+circuit_half_open_probes = int(os.getenv('CIRCUIT_HALF_OPEN_PROBES', 3))
+# Outcomes are sent and the states read this often, the processes agree within about that
+circuit_sync_seconds = float(os.getenv('CIRCUIT_SYNC_SECONDS', 1))
+
+circuit_requests_total = Counter(
+    'circuit_requests_total', 'Requests through the circuit breakers by outcome: ok, error, slow or skipped',
+    ('result',),
+)
+circuit_transitions_total = Counter('circuit_transitions_total', 'Breaker states seen changing by this process', ('state',))
+circuit_open = Gauge('circuit_open', 'Breakers open or half open, as this process last saw them')
+
+CIRCUIT_OK = 'ok'
+CIRCUIT_ERROR = 'error'
+CIRCUIT_SLOW = 'slow'
+
+
+def circuit_host(url: str) -> str:
+    return urlsplit(url).netloc.lower()
+
+
+def circuit_key(url: str, target: str) -> str:
+    return f'{circuit_host(url)}/{target}'
+
+
+def circuit_result(status_code: Optional[int], seconds: float, slow_seconds: float = circuit_slow_seconds) -> str:
+    """The outcome of a call that got a response, a 4xx still means the host is up."""
+    if status_code is not None and (status_code >= 500 or status_code == 429):
+        return CIRCUIT_ERROR
+    return CIRCUIT_SLOW if seconds > slow_seconds else CIRCUIT_OK
+
+
+def circuit_error_result(error: Exception) -> str:
+    """The outcome of a call that got no response, only a failed connection or request is an error."""
+    if isinstance(error, (httpx.ConnectTimeout, requests.exceptions.ConnectTimeout)):
+        return CIRCUIT_ERROR
+    # the host took the request but didn't answer in time, it's slow rather than down
+    if isinstance(error, (httpx.TimeoutException, requests.exceptions.Timeout)):
+        return CIRCUIT_SLOW
+    return CIRCUIT_ERROR
+
+
+class CircuitBreakers:
+    """
+    The breakers of the hosts and targets this process calls, the states as of the last sync.
+
+    `allow` is checked before a call and `record` given its outcome, both in memory and safe from
+    threads. A sync task sends the outcomes to redis, where a script keeps the rolling window and
+    moves the state: closed, open once the window has `circuit_min_requests` and too many errors
+    or slow responses, half open after `circuit_open_seconds`, closed again after
+    `circuit_half_open_probes` successful probes or open on a failed one.
+    """
+
+    def __init__(self):
+        self._states: Dict[str, Tuple[str, float]] = {}
+        self._outcomes: Dict[str, List[int]] = {}
+        self._probing: Set[str] = set()
+        self._lock = threading.Lock()
+        self._task: Optional[asyncio.Task] = None
+
+    def allow(self, url: str, target: str) -> bool:
+        if not circuit_breakers_enabled:
+            return True
+        key = circuit_key(url, target)
+        with self._lock:
+            state = self._states.get(key)
+            if state is None:
+                return True
+            if state[0] == 'open' and time.time() < state[1]:
+                circuit_requests_total.labels(result='skipped').inc()
+                return False
+            # half open, or open past its time and about to be
+            if key in self._probing:
+                circuit_requests_total.labels(result='skipped').inc()
+                return False
+            self._probing.add(key)
+            return True
+
+    def is_open(self, url: str, target: str) -> Optional[float]:
+        """When the breaker is open, the time it's open until, without taking a probe."""
+        state = self._states.get(circuit_key(url, target))
+        if state is not None and state[0] == 'open' and time.time() < state[1]:
+            return state[1]
+        return None
+
+    def record(self, url: str, target: str, result: str):
+        if not circuit_breakers_enabled:
+            return
+        key = circuit_key(url, target)
+        circuit_requests_total.labels(result=result).inc()
+        with self._lock:
+            self._probing.discard(key)
+            outcomes = self._outcomes.setdefault(key, [0, 0, 0])
+            outcomes[0] += 1
+            if result == CIRCUIT_ERROR:
+                outcomes[1] += 1
+            elif result == CIRCUIT_SLOW:
+                outcomes[2] += 1
+
+    def release(self, url: str, target: str):
+        with self._lock:
+            self._probing.discard(circuit_key(url, target))
+
+    def _sync(self):
+        with self._lock:
+            outcomes, self._outcomes = self._outcomes, {}
+            # only the breakers known not to be closed are read, there's one per user webhook and app.
+            # one another process opened is learned from the state the next recorded outcome returns
+            idle = [key for key in self._states if key not in outcomes]
+
+        states = redis_db.record_circuit_outcomes(
+            outcomes, time.time(), circuit_bucket_seconds, circuit_window_buckets, circuit_min_requests,
+            circuit_error_rate, circuit_slow_rate, circuit_open_seconds, circuit_max_open_seconds,
+            circuit_half_open_probes,
+        ) if outcomes else {}
+        states = {key: state for key, state in states.items() if state[0] != 'closed'}
+        if idle:
+            states.update(redis_db.get_circuit_states(idle))
+
+        with self._lock:
+            for key in set(states) | set(self._states):
+                before = self._states.get(key, ('closed', 0))[0]
+                after = states.get(key, ('closed', 0))[0]
+                if before != after:
+                    print(f'Circuit {key} {before} -> {after}')
+                    circuit_transitions_total.labels(state=after).inc()
+            self._states = states
+            # a probe whose outcome never came, e.g. the process restarted the request
+            self._probing &= set(states)
+        circuit_open.set(len(states))
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(circuit_sync_seconds)
+            try:
+                await asyncio.to_thread(self._sync)
+            except Exception as e:
+                print(f'Circuit breakers sync error: {e}')
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+
+_circuit_breakers: Optional[CircuitBreakers] = None
+
+
+def get_circuit_breakers() -> CircuitBreakers:
+    global _circuit_breakers
+    if _circuit_breakers is None:
+        _circuit_breakers = CircuitBreakers()
+    return _circuit_breakers
+
+
+def start_circuit_breakers():
+    """Syncs with redis for the life of the process, call it from the app startup hook."""
+    if circuit_breakers_enabled:
+        get_circuit_breakers().start()
+
+
+def get_circuit_status(url: str, target: str) -> Optional[dict]:
+    """A breaker's state and the current window of its whole host, for the app owner."""
+    host = circuit_host(url)
+    if not host:
+        return None
+    state, window = redis_db.get_circuit(circuit_key(url, target), host)
+    bucket = int(time.time() // circuit_bucket_seconds)
+    counts = {'t': 0, 'e': 0, 's': 0}
+    for field, count in window.items():
+        field_bucket, kind = field.split(':')
+        if int(field_bucket) > bucket - circuit_window_buckets:
+            counts[kind] += count
+
+    status = state.get('state', 'closed')
+    if status == 'open' and time.time() >= float(state['until']):
+        status = 'half_open'
+    return {
+        'host': host,
+        'state': status,
+        'open_until': float(state['until']) if status == 'open' else None,
+        'window_seconds': circuit_bucket_seconds * circuit_window_buckets,
+        'requests': counts['t'],
+        'error_rate': counts['e'] / counts['t'] if counts['t'] else 0,
+        'slow_rate': counts['s'] / counts['t'] if counts['t'] else 0,
+    }
@@ -0,0 +1,42 @@
+import asyncio
+import threading
+import time
+
+
+class FlushSignal:
+    """
+    Wakes a consumer as soon as a producer has data, instead of polling on a fixed interval.
+
+    Consecutive flushes are spaced by at least `min_batch_seconds` so bursts go out as one batch,
+    and an idle consumer only wakes up every `idle_seconds` to re-check its state.
+    `notify` is safe to call from other threads (e.g. deepgram callbacks).
+    """
+
+    def __init__(self, min_batch_seconds: float = 0, idle_seconds: float = 5):
+        self.min_batch_seconds = min_batch_seconds
+        self.idle_seconds = idle_seconds
+        self._loop = asyncio.get_running_loop()
+        self._thread_id = threading.get_ident()
+        self._event = asyncio.Event()
+        self._flushed_at = 0
+
+    def notify(self):
+        if threading.get_ident() == self._thread_id:
+            self._event.set()
+        else:
+            self._loop.call_soon_threadsafe(self._event.set)
+
+    async def wait(self) -> bool:
+        """True when there is something to flush, False on idle timeout."""
+        try:
+            await asyncio.wait_for(self._event.wait(), timeout=self.idle_seconds)
+        except asyncio.TimeoutError:
+            return False
+
+        remaining = self.min_batch_seconds - (time.monotonic() - self._flushed_at)
+        if remaining > 0:
+            await asyncio.sleep(remaining)
+
+        self._event.clear()
+        self._flushed_at = time.monotonic()
+        return True
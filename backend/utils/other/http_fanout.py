@@ -0,0 +1,252 @@
+import asyncio
+import os
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, List, NamedTuple, Optional, Set, Tuple
+from urllib.parse import urlsplit
+
+import httpx
+
+from utils.other.circuit_breaker import circuit_error_result, circuit_result, circuit_slow_seconds, \
+    get_circuit_breakers
+from utils.other.metrics import Counter, Gauge, Histogram
+from utils.other.timer_wheel import get_timer_wheel
+
+# Shared by every fan-out of the process, pooled per host
+http_fanout_max_hosts = int(os.getenv('HTTP_FANOUT_MAX_HOSTS', 512))
+http_fanout_max_connections_per_host = int(os.getenv('HTTP_FANOUT_MAX_CONNECTIONS_PER_HOST', 32))
+http_fanout_max_keepalive_per_host = int(os.getenv('HTTP_FANOUT_MAX_KEEPALIVE_PER_HOST', 8))
+# Requests in flight to one target (an app, a user webhook) across all sessions, above it requests are shed
+http_fanout_max_in_flight_per_target = int(os.getenv('HTTP_FANOUT_MAX_IN_FLIGHT_PER_TARGET', 32))
+# A request the caller stopped waiting for keeps going in the background up to this
+http_fanout_response_timeout_seconds = float(os.getenv('HTTP_FANOUT_RESPONSE_TIMEOUT_SECONDS', 30))
+
+http_fanout_requests_total = Counter(
+    'http_fanout_requests_total',
+    'Fan-out requests by outcome: ok, status, connect_error, error, shed or circuit_open',
+    ('kind', 'result'),
+)
+http_fanout_late_total = Counter(
+    'http_fanout_late_total', 'Fan-out requests still running at the caller deadline, finished in the background',
+    ('kind',),
+)
+http_fanout_request_seconds = Histogram('http_fanout_request_seconds', 'Fan-out request latency', ('kind',))
+http_fanout_in_flight = Gauge('http_fanout_in_flight', 'Fan-out requests in flight')
+http_fanout_hosts = Gauge('http_fanout_hosts', 'Hosts with a pooled fan-out client')
+
+
+class FanoutRequest(NamedTuple):
+    target: str  # concurrency key, e.g. the app id
+    url: str
+    kwargs: dict  # for httpx post: json, content, headers
+    on_late_response: Optional[Callable] = None  # see `HttpFanout.post`
+
+
+class HttpFanout:
+    """
+    Posts to many endpoints at once on pooled `httpx.AsyncClient`s, fire and collect.
+
+    `fan_out` starts every request together and returns, at most `deadline` seconds later, the response
+    of each one or None: failed, too slow, or shed because its target already has
+    `max_in_flight_per_target` requests in flight. A slow endpoint costs its own requests, not the batch.
+
+    A request isn't cancelled at the deadline, only no longer waited for: it finishes in the background
+    within `response_timeout`, so its connection is kept alive and its reply can still be handled.
+
+    Every request goes through the breaker of its target on its host, an open one fails the request
+    right away. A request answered within its deadline or `circuit_slow_seconds` isn't slow for the
+    breaker, one timing out is slow, only a failed connection, a 5xx or a 429 is an error.
+
+    There is a client per host, the least recently used are closed above `max_hosts`: httpcore scans its
+    whole pool for every queued request, one pool for every app host costs O(connections) per request.
+    """
+
+    def __init__(
+            self, max_hosts: int = http_fanout_max_hosts,
+            max_connections_per_host: int = http_fanout_max_connections_per_host,
+            max_keepalive_per_host: int = http_fanout_max_keepalive_per_host,
+            max_in_flight_per_target: int = http_fanout_max_in_flight_per_target,
+            response_timeout: float = http_fanout_response_timeout_seconds,
+    ):
+        self.max_hosts = max_hosts
+        self.response_timeout = response_timeout
+        self.limits = httpx.Limits(
+            max_connections=max_connections_per_host, max_keepalive_connections=max_keepalive_per_host,
+            keepalive_expiry=30,
+        )
+        self.max_in_flight_per_target = max_in_flight_per_target
+        self._clients: OrderedDict[str, httpx.AsyncClient] = OrderedDict()
+        self._in_flight: Dict[str, int] = {}
+        # requests past their deadline and their late reply handlers
+        self._late: Set[asyncio.Task] = set()
+        # loading the CA bundle takes ~20ms, every host client shares one context
+        self._ssl_context = None
+
+    def client(self, url: str) -> httpx.AsyncClient:
+        parts = urlsplit(url)
+        host = f'{parts.scheme}://{parts.netloc}'
+        if client := self._clients.get(host):
+            self._clients.move_to_end(host)
+            return client
+
+        if self._ssl_context is None:
+            self._ssl_context = httpx.create_ssl_context()
+        # timeouts are set per request, see `post`
+        client = self._clients[host] = httpx.AsyncClient(
+            limits=self.limits, timeout=None, follow_redirects=True, verify=self._ssl_context,
+        )
+        while len(self._clients) > self.max_hosts:
+            _, evicted = self._clients.popitem(last=False)
+            # its requests are past their deadline by then
+            get_timer_wheel().schedule(60, evicted.aclose)
+        http_fanout_hosts.set(len(self._clients))
+        return client
+
+    async def post(
+            self, kind: str, target: str, url: str, deadline: float, on_late_response: Optional[Callable] = None,
+            **kwargs,
+    ) -> Optional[httpx.Response]:
+        """
+        The response, or None if there was none within `deadline`. A request still running then goes on
+        in the background, `on_late_response` is called with its response if it gets one, a coroutine it
+        returns is run as a task.
+        """
+        response, _ = await self.post_result(kind, target, url, deadline, on_late_response, **kwargs)
+        return response
+
+    async def post_result(
+            self, kind: str, target: str, url: str, deadline: float, on_late_response: Optional[Callable] = None,
+            on_late_result: Optional[Callable] = None, **kwargs,
+    ) -> Tuple[Optional[httpx.Response], str]:
+        """
+        `post` and how it went: ok, status, connect_error (nothing was sent), error, late (still running),
+        shed or circuit_open (not sent). `on_late_result` is called like `on_late_response`, with the
+        response and how it went once a late request is over, response or not.
+        """
+        in_flight = self._in_flight.get(target, 0)
+        if in_flight >= self.max_in_flight_per_target:
+            http_fanout_requests_total.labels(kind=kind, result='shed').inc()
+            return None, 'shed'
+
+        # the target's breaker is open, or half open and this process already has its probe in flight
+        if not get_circuit_breakers().allow(url, target):
+            http_fanout_requests_total.labels(kind=kind, result='circuit_open').inc()
+            return None, 'circuit_open'
+
+        self._in_flight[target] = in_flight + 1
+        http_fanout_in_flight.inc()
+        kwargs.setdefault('timeout', self.response_timeout)
+        # a response the caller waited for isn't slow
+        slow_seconds = max(circuit_slow_seconds, deadline)
+        request = asyncio.create_task(self._post(kind, target, url, slow_seconds, **kwargs))
+        try:
+            await asyncio.wait((request,), timeout=deadline)
+        finally:
+            # not cancelled with the caller either
+            if not request.done():
+                self._background(request)
+        if request.done():
+            return request.result()
+
+        http_fanout_late_total.labels(kind=kind).inc()
+        print(f'{kind} {target} no response in {deadline}s, finishing in the background')
+        if on_late_response is not None:
+            request.add_done_callback(lambda task: self._on_late_response(kind, target, task, on_late_response))
+        if on_late_result is not None:
+            request.add_done_callback(lambda task: self._on_late_result(kind, target, task, on_late_result))
+        return None, 'late'
+
+    def _background(self, task: asyncio.Task):
+        self._late.add(task)
+        task.add_done_callback(self._late.discard)
+
+    def _on_late_response(self, kind: str, target: str, request: asyncio.Task, on_late_response: Callable):
+        if request.cancelled() or request.result()[0] is None:
+            return
+        try:
+            handled = on_late_response(request.result()[0])
+            if asyncio.iscoroutine(handled):
+                self._background(asyncio.create_task(self._await_late_response(kind, target, handled)))
+        except Exception as e:
+            print(f'{kind} {target} late response error: {e}')
+
+    def _on_late_result(self, kind: str, target: str, request: asyncio.Task, on_late_result: Callable):
+        if request.cancelled():
+            return
+        try:
+            handled = on_late_result(*request.result())
+            if asyncio.iscoroutine(handled):
+                self._background(asyncio.create_task(self._await_late_response(kind, target, handled)))
+        except Exception as e:
+            print(f'{kind} {target} late response error: {e}')
+
+    @staticmethod
+    async def _await_late_response(kind: str, target: str, handled):
+        try:
+            await handled
+        except Exception as e:
+            print(f'{kind} {target} late response error: {e}')
+
+    async def _post(
+            self, kind: str, target: str, url: str, slow_seconds: float, **kwargs,
+    ) -> Tuple[Optional[httpx.Response], str]:
+        breakers = get_circuit_breakers()
+        start = time.monotonic()
+        result = 'error'
+        outcome = None
+        try:
+            response = await self.client(url).post(url, **kwargs)
+            result = 'ok' if response.status_code < 400 else 'status'
+            outcome = circuit_result(response.status_code, time.monotonic() - start, slow_seconds)
+            return response, result
+        except (httpx.ConnectError, httpx.ConnectTimeout) as e:
+            result = 'connect_error'
+            outcome = circuit_error_result(e)
+            print(f'{kind} {target} connect error: {e}')
+            return None, result
+        except Exception as e:
+            outcome = circuit_error_result(e)
+            print(f'{kind} {target} error: {e}')
+            return None, result
+        finally:
+            if outcome is not None:
+                breakers.record(url, target, outcome)
+            else:
+                # cancelled, no outcome but the probe is given back
+                breakers.release(url, target)
+            http_fanout_requests_total.labels(kind=kind, result=result).inc()
+            http_fanout_request_seconds.labels(kind=kind).observe(time.monotonic() - start)
+            http_fanout_in_flight.dec()
+            if self._in_flight[target] <= 1:
+                del self._in_flight[target]
+            else:
+                self._in_flight[target] -= 1
+
+    async def fan_out(self, kind: str, requests: List[FanoutRequest], deadline: float) -> List[Optional[httpx.Response]]:
+        """Responses in the order of `requests`."""
+        if not requests:
+            return []
+        return await asyncio.gather(*[
+            self.post(kind, request.target, request.url, deadline, request.on_late_response, **request.kwargs)
+            for request in requests
+        ])
+
+    async def close(self):
+        for task in list(self._late):
+            task.cancel()
+        clients = list(self._clients.values())
+        self._clients.clear()
+        http_fanout_hosts.set(0)
+        for client in clients:
+            await client.aclose()
+
+
+_http_fanout: Optional[HttpFanout] = None
+
+
+def get_http_fanout() -> HttpFanout:
+    """The process fan-out, the host clients are created on first use from the event loop."""
+    global _http_fanout
+    if _http_fanout is None:
+        _http_fanout = HttpFanout()
+    return _http_fanout
@@ -0,0 +1,26 @@
+import sys
+from collections import deque
+
+from pydantic import BaseModel
+
+
+def deep_getsizeof(obj, seen: set = None) -> int:
+    """
+    Approximate bytes held by plain data: containers, strings, bytes and pydantic models.
+
+    Any other object only counts its own size, references to sockets, locks or the app are not followed.
+    """
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(deep_getsizeof(k, seen) + deep_getsizeof(v, seen) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset, deque)):
+        size += sum(deep_getsizeof(item, seen) for item in obj)
+    elif isinstance(obj, BaseModel):
+        size += deep_getsizeof(obj.__dict__, seen)
+    return size
@@ -0,0 +1,203 @@
+import asyncio
+import bisect
+import math
+import threading
+import time
+from typing import Dict, List, Tuple
+
+# In process metrics, rendered in the prometheus text format on GET /metrics (ADMIN_KEY as the secret_key header).
+# Every container keeps its own registry, a scrape only sees the container that served it.
+_registry: Dict[str, '_Metric'] = {}
+_registry_lock = threading.Lock()
+
+default_latency_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return '+Inf'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def _format_labels(names: Tuple[str, ...], values: Tuple[str, ...], extra: str = '') -> str:
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class _Metric:
+    type = ''
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._children = {}
+        if not self.labelnames:
+            self._children[()] = self._new_child()
+
+        with _registry_lock:
+            if name in _registry:
+                raise ValueError(f'Metric {name} is already registered')
+            _registry[name] = self
+
+    def _child(self, labels: dict):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f'{self.name} expects labels {self.labelnames}, got {tuple(labels)}')
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with self._lock:
+            if key not in self._children:
+                self._children[key] = self._new_child()
+            return self._children[key]
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def _samples(self, key, child) -> List[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type}']
+        with self._lock:
+            children = list(self._children.items())
+        for key, child in children:
+            lines.extend(self._samples(key, child))
+        return '\n'.join(lines)
+
+
+class _Value:
+    def __init__(self):
+        self.value = 0.0
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1):
+        with self._lock:
+            self.value += amount
+
+    def dec(self, amount: float = 1):
+        with self._lock:
+            self.value -= amount
+
+    def set(self, value: float):
+        with self._lock:
+            self.value = value
+
+
+class Counter(_Metric):
+    type = 'counter'
+
+    def _new_child(self):
+        return _Value()
+
+    def labels(self, **labels) -> _Value:
+        return self._child(labels)
+
+    def inc(self, amount: float = 1):
+        self._child({}).inc(amount)
+
+    def _samples(self, key, child):
+        return [f'{self.name}{_format_labels(self.labelnames, key)} {_format_value(child.value)}']
+
+
+class Gauge(Counter):
+    type = 'gauge'
+
+    def dec(self, amount: float = 1):
+        self._child({}).dec(amount)
+
+    def set(self, value: float):
+        self._child({}).set(value)
+
+    def get(self) -> float:
+        return self._child({}).value
+
+
+class _HistogramValue:
+    def __init__(self, buckets: Tuple[float, ...]):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[i] += 1
+            self.sum += value
+
+
+class Histogram(_Metric):
+    type = 'histogram'
+
+    def __init__(
+            self, name: str, documentation: str, labelnames: Tuple[str, ...] = (),
+            buckets: Tuple[float, ...] = default_latency_buckets,
+    ):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames)
+
+    def _new_child(self):
+        return _HistogramValue(self.buckets)
+
+    def labels(self, **labels) -> _HistogramValue:
+        return self._child(labels)
+
+    def observe(self, value: float):
+        self._child({}).observe(value)
+
+    def _samples(self, key, child):
+        with child._lock:
+            counts, total = list(child.counts), child.sum
+
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (math.inf,), counts):
+            cumulative += count
+            le = _format_labels(self.labelnames, key, f'le="{_format_value(bound)}"')
+            lines.append(f'{self.name}_bucket{le} {cumulative}')
+        labels = _format_labels(self.labelnames, key)
+        lines.append(f'{self.name}_sum{labels} {_format_value(total)}')
+        lines.append(f'{self.name}_count{labels} {cumulative}')
+        return lines
+
+
+def render_metrics() -> str:
+    with _registry_lock:
+        metrics = list(_registry.values())
+    return '\n'.join(metric.render() for metric in metrics) + '\n'
+
+
+event_loop_lag_seconds = Histogram(
+    'event_loop_lag_seconds', 'Delay of a timer callback on the event loop, time other tasks held it',
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1),
+)
+
+
+_event_loop_lag_task = None
+_event_loop_lag_recent = 0.0
+
+
+async def _monitor_event_loop_lag(interval: float, smoothing: float = 0.2):
+    global _event_loop_lag_recent
+    while True:
+        start = time.monotonic()
+        await asyncio.sleep(interval)
+        lag = max(time.monotonic() - start - interval, 0)
+        event_loop_lag_seconds.observe(lag)
+        _event_loop_lag_recent += smoothing * (lag - _event_loop_lag_recent)
+
+
+def get_event_loop_lag() -> float:
+    """Smoothed recent event loop lag in seconds, 0 until the monitor is started."""
+    return _event_loop_lag_recent
+
+
+def start_event_loop_lag_monitor(interval: float = 0.1):
+    """Runs for the life of the process, call it from the app startup hook."""
+    global _event_loop_lag_task
+    if _event_loop_lag_task is None:
+        _event_loop_lag_task = asyncio.create_task(_monitor_event_loop_lag(interval))
@@ -1,13 +1,17 @@
 import datetime
+import glob
 import json
 import os
-from typing import List
+import uuid
+import wave
+from typing import List, Optional, Tuple
 
 from google.cloud import storage
 from google.oauth2 import service_account
 from google.cloud.storage import transfer_manager
 
-from database.redis_db import cache_signed_url, get_cached_signed_url
+from database.redis_db import cache_signed_url, get_cached_signed_url, cache_speech_profile, \
+    get_cached_speech_profile, remove_cached_speech_profile
 
 if os.environ.get('SERVICE_ACCOUNT_JSON'):
     service_account_info = json.loads(os.environ["SERVICE_ACCOUNT_JSON"])
@@ -55,6 +59,60 @@ def get_profile_audio_if_exists(uid: str, download: bool = True) -> str:
     return None
 
 
+speech_profiles_cache_dir = '_speech_profiles'
+
+
+def get_cached_profile_audio(uid: str) -> Tuple[Optional[str], float]:
+    """
+    Local copy of the user speech profile and its duration in seconds.
+
+    Files are kept per GCS generation in `_speech_profiles/`, generation and duration live in redis,
+    so reconnects skip GCS and audio decoding until `invalidate_cached_profile_audio` is called.
+    """
+    cached = get_cached_speech_profile(uid)
+    if cached is not None:
+        if not cached['generation']:
+            return None, 0
+        file_path = f'{speech_profiles_cache_dir}/{uid}_{cached["generation"]}.wav'
+        if os.path.exists(file_path):
+            return file_path, cached['duration']
+
+    bucket = storage_client.bucket(speech_profiles_bucket)
+    blob = bucket.get_blob(f'{uid}/speech_profile.wav')
+    if not blob:
+        cache_speech_profile(uid, '', 0, ttl=60 * 60)
+        return None, 0
+
+    file_path = f'{speech_profiles_cache_dir}/{uid}_{blob.generation}.wav'
+    if not os.path.exists(file_path):
+        os.makedirs(speech_profiles_cache_dir, exist_ok=True)
+        # concurrent connects of the same user download side by side, the last rename wins
+        tmp_path = f'{file_path}.{uuid.uuid4().hex}.tmp'
+        try:
+            blob.download_to_filename(tmp_path)
+            os.replace(tmp_path, file_path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        _remove_cached_profile_files(uid, keep=file_path)
+
+    with wave.open(file_path, 'rb') as wav:
+        duration = wav.getnframes() / wav.getframerate()
+    cache_speech_profile(uid, str(blob.generation), duration)
+    return file_path, duration
+
+
+def invalidate_cached_profile_audio(uid: str):
+    remove_cached_speech_profile(uid)
+    _remove_cached_profile_files(uid)
+
+
+def _remove_cached_profile_files(uid: str, keep: str = None):
+    for file_path in glob.glob(f'{speech_profiles_cache_dir}/{uid}_*.wav'):
+        if file_path != keep:
+            os.remove(file_path)
+
+
 def upload_additional_profile_audio(file_path: str, uid: str) -> None:
     bucket = storage_client.bucket(speech_profiles_bucket)
     path = f'{uid}/additional_profile_recordings/{file_path.split("/")[-1]}'
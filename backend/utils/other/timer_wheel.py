@@ -0,0 +1,133 @@
+import asyncio
+import os
+import time
+from typing import Callable, Optional, Set
+
+from utils.other.metrics import Counter, Gauge
+
+# Shared by every session of the process, timers fire at most one tick late and never early
+timer_wheel_tick_seconds = float(os.getenv('TIMER_WHEEL_TICK_SECONDS', 0.5))
+timer_wheel_slots = int(os.getenv('TIMER_WHEEL_SLOTS', 1024))
+
+timer_wheel_timers = Gauge('timer_wheel_timers', 'Timers scheduled on the process timer wheel')
+timer_wheel_fired_total = Counter('timer_wheel_fired_total', 'Timers fired by the process timer wheel')
+
+
+class Timer:
+    """Handle returned by `TimerWheel.schedule`, `reschedule` and `cancel` are O(1)."""
+
+    __slots__ = ('wheel', 'callback', 'args', 'interval', 'slot', 'deadline', 'active')
+
+    def __init__(self, wheel: 'TimerWheel', callback: Callable, args: tuple, interval: Optional[float]):
+        self.wheel = wheel
+        self.callback = callback
+        self.args = args
+        self.interval = interval
+        self.slot = None
+        self.deadline = 0
+        self.active = False
+
+    def reschedule(self, delay_seconds: float, *args):
+        """Moves the deadline to `delay_seconds` from now, with new callback arguments if any are given."""
+        if args:
+            self.args = args
+        self.wheel._remove(self)
+        self.wheel._add(self, delay_seconds)
+
+    def cancel(self):
+        self.wheel._remove(self)
+
+
+class TimerWheel:
+    """
+    Hashed timer wheel, one task drives the deadlines of every session in the process.
+
+    A timer lands in the slot its deadline tick falls into, so scheduling, rescheduling and
+    cancelling never scan other timers. Every `tick_seconds` the task fires the timers of the
+    current slot that are due, the ones a full turn of the wheel or more away stay. Callbacks run on
+    the event loop and must not block, a coroutine they return is run as a task. Timers with an
+    `interval` are re-armed after each fire.
+    """
+
+    def __init__(self, tick_seconds: float = timer_wheel_tick_seconds, slots: int = timer_wheel_slots):
+        self.tick_seconds = tick_seconds
+        self.slots = [dict() for _ in range(max(slots, 1))]
+        self._ticks = 0
+        # monotonic time tick `_ticks + 1` fires at
+        self._next_tick = 0.0
+        self._count = 0
+        self._task: Optional[asyncio.Task] = None
+        self._callback_tasks: Set[asyncio.Task] = set()
+
+    def __len__(self):
+        return self._count
+
+    def schedule(self, delay_seconds: float, callback: Callable, *args, interval: Optional[float] = None) -> Timer:
+        if self._task is None:
+            self._next_tick = time.monotonic() + self.tick_seconds
+            self._task = asyncio.create_task(self._run())
+        timer = Timer(self, callback, args, interval)
+        self._add(timer, delay_seconds)
+        return timer
+
+    def _add(self, timer: Timer, delay_seconds: float):
+        # counted from the actual time, not the last tick, so a timer never fires before its delay
+        late = time.monotonic() + delay_seconds - self._next_tick
+        self._insert(timer, max(int(-(-late // self.tick_seconds)), 0) + 1)
+
+    def _insert(self, timer: Timer, ticks: int):
+        timer.deadline = self._ticks + ticks
+        timer.slot = timer.deadline % len(self.slots)
+        timer.active = True
+        self.slots[timer.slot][id(timer)] = timer
+        self._count += 1
+        timer_wheel_timers.inc()
+
+    def _remove(self, timer: Timer):
+        if not timer.active:
+            return
+        timer.active = False
+        del self.slots[timer.slot][id(timer)]
+        self._count -= 1
+        timer_wheel_timers.dec()
+
+    def _advance(self):
+        self._ticks += 1
+        slot = self.slots[self._ticks % len(self.slots)]
+        due = [timer for timer in slot.values() if timer.deadline <= self._ticks]
+        for timer in due:
+            # an earlier callback may have cancelled or moved it
+            if not timer.active or timer.deadline > self._ticks:
+                continue
+            self._remove(timer)
+            if timer.interval:
+                # counted from this tick, so the period doesn't drift by the callback latency
+                self._insert(timer, max(int(-(-timer.interval // self.tick_seconds)), 1))
+            timer_wheel_fired_total.inc()
+            try:
+                result = timer.callback(*timer.args)
+                if asyncio.iscoroutine(result):
+                    task = asyncio.create_task(result)
+                    self._callback_tasks.add(task)
+                    task.add_done_callback(self._callback_tasks.discard)
+            except Exception as e:
+                print(f'Timer callback error: {e}')
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(max(self._next_tick - time.monotonic(), 0))
+            # catch up on the ticks missed while the loop was busy
+            while self._next_tick <= time.monotonic():
+                self._next_tick += self.tick_seconds
+                self._advance()
+
+
+_timer_wheel: Optional[TimerWheel] = None
+
+
+def get_timer_wheel() -> TimerWheel:
+    """The process timer wheel, started on first use from the event loop."""
+    global _timer_wheel
+    if _timer_wheel is None:
+        _timer_wheel = TimerWheel()
+    return _timer_wheel
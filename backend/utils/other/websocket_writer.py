@@ -0,0 +1,192 @@
+import asyncio
+import os
+import time
+from collections import deque
+from typing import Callable, Optional
+
+import orjson
+from fastapi.websockets import WebSocketDisconnect
+from starlette.websockets import WebSocket
+
+from utils.other.memory import deep_getsizeof
+from utils.other.metrics import Counter, Histogram
+from utils.stt.metrics import listen_websocket_send_seconds
+
+# Per session, an event or a transcript segment each count as one pending item
+listen_outbound_max_pending = int(os.getenv('LISTEN_OUTBOUND_MAX_PENDING', 1000))
+
+listen_outbound_queue_depth = Histogram(
+    'listen_outbound_queue_depth', 'Items waiting for the client websocket when the writer picks them up',
+    buckets=(0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000),
+)
+listen_outbound_frames_total = Counter(
+    'listen_outbound_frames_total', 'Frames written to the client websocket', ('kind',),
+)
+listen_outbound_coalesced_total = Counter(
+    'listen_outbound_coalesced_total', 'Frames saved by merging pending transcripts or pings', ('kind',),
+)
+listen_outbound_overflow_total = Counter(
+    'listen_outbound_overflow_total', 'Sessions closed because the client did not keep up with its frames',
+)
+
+EVENT = 'event'
+TRANSCRIPT = 'transcript'
+PING = 'ping'
+
+
+class WebSocketWriter:
+    """
+    The only writer of a listen websocket, frames go out in the order they were queued.
+
+    `send_event`, `send_segments` and `send_ping` queue without waiting and return False once the
+    writer is closed. Whatever is pending when the writer wakes up is written back to back:
+    consecutive transcript lists are merged into one frame, and a ping is skipped when another frame
+    is already pending. Frames are encoded with orjson.
+
+    More than `max_pending` items waiting means the client is not reading, the queue is dropped and
+    `on_error` is called so the session closes instead of growing.
+    """
+
+    def __init__(
+            self, websocket: WebSocket, uid: str, on_error: Optional[Callable[[int], None]] = None,
+            max_pending: int = listen_outbound_max_pending,
+    ):
+        self.websocket = websocket
+        self.uid = uid
+        self.on_error = on_error
+        self.max_pending = max(max_pending, 1)
+
+        self._pending = deque()  # [kind, payload]
+        self._pending_items = 0
+        self._event = asyncio.Event()
+        self._closed = False
+        self._task: Optional[asyncio.Task] = None
+
+        self.frames = 0
+        self.coalesced = 0
+        self.overflowed = False
+
+    def __len__(self):
+        return self._pending_items
+
+    @property
+    def closed(self) -> bool:
+        return self._closed
+
+    def start(self) -> asyncio.Task:
+        self._task = asyncio.create_task(self._run())
+        return self._task
+
+    def send_event(self, event: dict) -> bool:
+        return self._put(EVENT, event, 1)
+
+    def send_segments(self, segments: list) -> bool:
+        if not segments:
+            return True
+        if self._pending and self._pending[-1][0] == TRANSCRIPT:
+            if self._closed:
+                return False
+            # copied, the list may be shared with the pusher
+            tail = self._pending[-1]
+            tail[1] = tail[1] + segments
+            self._pending_items += len(segments)
+            self._coalesced(TRANSCRIPT)
+            return self._check_overflow()
+        return self._put(TRANSCRIPT, segments, len(segments))
+
+    def send_ping(self) -> bool:
+        if self._pending:
+            if self._closed:
+                return False
+            # anything written keeps the client alive just as well
+            self._coalesced(PING)
+            return True
+        return self._put(PING, 'ping', 1)
+
+    async def close(self, timeout: float = 2):
+        """Writes what's pending, at most `timeout` seconds, then stops the writer."""
+        if self._closed:
+            return
+        self._closed = True
+        self._event.set()
+        if self._task is None:
+            return
+        try:
+            await asyncio.wait_for(asyncio.shield(self._task), timeout=timeout)
+        except asyncio.TimeoutError:
+            print(f'WebSocketWriter close timed out with {self._pending_items} items pending', self.uid)
+            self._task.cancel()
+        except Exception as e:
+            print(f'WebSocketWriter close error: {e}', self.uid)
+
+    def stats(self) -> dict:
+        return {
+            'pending_items': self._pending_items, 'frames': self.frames, 'coalesced': self.coalesced,
+            'overflowed': self.overflowed,
+        }
+
+    def memory_usage(self) -> int:
+        return deep_getsizeof(self._pending)
+
+    def _put(self, kind: str, payload, items: int) -> bool:
+        if self._closed:
+            return False
+        self._pending.append([kind, payload])
+        self._pending_items += items
+        self._event.set()
+        return self._check_overflow()
+
+    def _coalesced(self, kind: str):
+        self.coalesced += 1
+        listen_outbound_coalesced_total.labels(kind=kind).inc()
+
+    def _check_overflow(self) -> bool:
+        if self._pending_items <= self.max_pending:
+            return True
+        print(f'WebSocketWriter overflow, {self._pending_items} items pending, closing', self.uid)
+        self.overflowed = True
+        listen_outbound_overflow_total.inc()
+        self._fail(1011)
+        return False
+
+    def _fail(self, code: int):
+        if self._closed and not self._pending:
+            return
+        self._closed = True
+        self._pending.clear()
+        self._pending_items = 0
+        self._event.set()
+        if self.on_error:
+            self.on_error(code)
+
+    async def _run(self):
+        while True:
+            await self._event.wait()
+            self._event.clear()
+            if not self._pending:
+                if self._closed:
+                    return
+                continue
+
+            listen_outbound_queue_depth.observe(self._pending_items)
+            while self._pending:
+                kind, payload = self._pending.popleft()
+                self._pending_items -= len(payload) if kind == TRANSCRIPT else 1
+                data = payload if kind == PING else orjson.dumps(payload).decode()
+                try:
+                    send_start = time.monotonic()
+                    await self.websocket.send_text(data)
+                    listen_websocket_send_seconds.labels(kind=kind).observe(time.monotonic() - send_start)
+                except WebSocketDisconnect:
+                    print('WebSocket disconnected', self.uid)
+                    self._fail(1001)
+                    return
+                except Exception as e:
+                    print(f'Can not send {kind}, error: {e}', self.uid)
+                    self._fail(1011)
+                    return
+                self.frames += 1
+                listen_outbound_frames_total.labels(kind=kind).inc()
+
+            if self._closed:
+                return
@@ -1,5 +1,7 @@
+import asyncio
+import json
 import threading
-from typing import List
+from typing import List, Optional, Tuple
 import os
 import requests
 import time
@@ -18,6 +20,10 @@ from models.notification_message import NotificationMessage
 from models.plugin import Plugin, UsageHistoryType
 from utils.apps import get_available_apps, weighted_rating
 from utils.notifications import send_notification
+from utils.other.circuit_breaker import circuit_error_result, circuit_result, get_circuit_breakers
+from utils.other.http_fanout import FanoutRequest, get_http_fanout
+from utils.webhook_delivery import delivery_idempotency_key, enqueue_delivery, register_delivery_handler, \
+    webhook_delivery_queue_enabled
 from utils.llm import (
     generate_embedding,
     get_proactive_message
@@ -27,6 +33,10 @@ import database.conversations as conversations_db
 
 PROACTIVE_NOTI_LIMIT_SECONDS = 30  # 1 noti / 30s
 
+# Per request, shorter than the pusher batches (1s transcripts, 5s audio bytes) so a slow app never spans two
+REALTIME_INTEGRATIONS_DEADLINE_SECONDS = float(os.getenv('REALTIME_INTEGRATIONS_DEADLINE_SECONDS', 0.9))
+REALTIME_AUDIO_BYTES_DEADLINE_SECONDS = float(os.getenv('REALTIME_AUDIO_BYTES_DEADLINE_SECONDS', 4))
+
 
 def get_github_docs_content(repo="BasedHardware/omi", path="docs/docs"):
     """
@@ -158,8 +168,46 @@ def get_plugins_data(uid: str, include_reviews: bool = False) -> List[Plugin]:
 # ************* EXTERNAL INTEGRATIONS **************
 # **************************************************
 
+def _conversation_created_request(uid: str, app: App, conversation: Conversation) -> Tuple[str, dict]:
+    conversation_dict = conversation.as_dict_cleaned_dates()
+
+    # Ignore external data on workflow
+    if conversation.source == ConversationSource.workflow and 'external_data' in conversation_dict:
+        conversation_dict['external_data'] = None
+
+    url = app.external_integration.webhook_url
+    if '?' in url:
+        url += '&uid=' + uid
+    else:
+        url += '?uid=' + uid
+    return url, conversation_dict
+
+
+def _on_conversation_created_response(uid: str, app_id: str, conversation_id: str, record_usage: bool,
+                                      response_data: dict) -> str:
+    if record_usage:
+        record_app_usage(uid, app_id, UsageHistoryType.memory_created_external_integration,
+                         conversation_id=conversation_id)
+    return (response_data or {}).get('message', '')
+
+
+def _on_conversation_created_app_delivered(uid: str, meta: dict, response):
+    """A queued delivery got through, its message arrives in the app chat and as a notification."""
+    message = _on_conversation_created_response(
+        uid, meta['app_id'], meta['conversation_id'], meta['record_usage'], response.json(),
+    )
+    if not message:
+        return
+    add_plugin_message(message, meta['app_id'], uid, meta['conversation_id'])
+    token = notification_db.get_token_only(uid)
+    send_plugin_notification(token, meta['app_name'], meta['app_id'], message)
+
+
+register_delivery_handler('app_conversation_created', _on_conversation_created_app_delivered)
+
+
 def trigger_external_integrations(uid: str, conversation: Conversation) -> list:
-    """ON CONVERSATION CREATED"""
+    """ON CONVERSATION CREATED, with the delivery queue the apps' messages come later and this returns none"""
     if not conversation or conversation.discarded:
         return []
 
@@ -169,43 +217,50 @@ def trigger_external_integrations(uid: str, conversation: Conversation) -> list:
     if not filtered_apps:
         return []
 
+    if webhook_delivery_queue_enabled:
+        for app in filtered_apps:
+            if not app.external_integration.webhook_url:
+                continue
+            url, conversation_dict = _conversation_created_request(uid, app, conversation)
+            enqueue_delivery(
+                'app_conversation_created', uid, app.id, url, json.dumps(conversation_dict).encode(),
+                meta={
+                    'app_id': app.id, 'app_name': app.name, 'conversation_id': conversation.id,
+                    'record_usage': app.uid is None or app.uid != uid,
+                },
+                idempotency_key=delivery_idempotency_key(uid, conversation.id, app.id, 'conversation_created'),
+            )
+        return []
+
     threads = []
     results = {}
+    breakers = get_circuit_breakers()
 
     def _single(app: App):
         if not app.external_integration.webhook_url:
             return
 
-        conversation_dict = conversation.as_dict_cleaned_dates()
-
-        # Ignore external data on workflow
-        if conversation.source == ConversationSource.workflow and 'external_data' in conversation_dict:
-            conversation_dict['external_data'] = None
-
-        url = app.external_integration.webhook_url
-        if '?' in url:
-            url += '&uid=' + uid
-        else:
-            url += '?uid=' + uid
-
+        url, conversation_dict = _conversation_created_request(uid, app, conversation)
+        if not breakers.allow(url, app.id):
+            # without the delivery queue nothing would send it later, it's attempted anyway
+            print('App integration circuit open, sending anyway', app.id)
+        start = time.monotonic()
+        response = None
         try:
             response = requests.post(url, json=conversation_dict, timeout=30, )  # TODO: failing?
+            # within the 30s timeout isn't slow
+            breakers.record(url, app.id, circuit_result(response.status_code, time.monotonic() - start, 30))
             if response.status_code != 200:
                 print('App integration failed', app.id, 'status:', response.status_code, 'result:', response.text[:100])
                 return
 
-            if app.uid is not None:
-                if app.uid != uid:
-                    record_app_usage(uid, app.id, UsageHistoryType.memory_created_external_integration,
-                                     conversation_id=conversation.id)
-            else:
-                record_app_usage(uid, app.id, UsageHistoryType.memory_created_external_integration,
-                                 conversation_id=conversation.id)
-
             # print('response', response.json())
-            if message := response.json().get('message', ''):
+            if message := _on_conversation_created_response(
+                    uid, app.id, conversation.id, app.uid is None or app.uid != uid, response.json()):
                 results[app.id] = message
         except Exception as e:
+            if response is None:
+                breakers.record(url, app.id, circuit_error_result(e))
             print(f"Plugin integration error: {e}")
             return
 
@@ -223,18 +278,18 @@ def trigger_external_integrations(uid: str, conversation: Conversation) -> list:
     return messages
 
 
-async def trigger_realtime_integrations(uid: str, segments: list[dict], conversation_id: str | None):
+async def trigger_realtime_integrations(
+        uid: str, segments: list[dict], conversation_id: str | None, apps: List[App] | None = None,
+):
     print("trigger_realtime_integrations", uid)
-    """REALTIME STREAMING"""
-    # TODO: don't retrieve token before knowing if to notify
-    token = notification_db.get_token_only(uid)
-    _trigger_realtime_integrations(uid, token, segments, conversation_id)
+    """REALTIME STREAMING, `apps` are the realtime apps from the session's snapshot if it has one"""
+    await _trigger_realtime_integrations(uid, segments, conversation_id, apps)
 
 
-async def trigger_realtime_audio_bytes(uid: str, sample_rate: int, data: bytearray):
+async def trigger_realtime_audio_bytes(uid: str, sample_rate: int, data: bytearray, apps: List[App] | None = None):
     print("trigger_realtime_audio_bytes", uid)
-    """REALTIME AUDIO STREAMING"""
-    _trigger_realtime_audio_bytes(uid, sample_rate, data)
+    """REALTIME AUDIO STREAMING, `apps` are the audio bytes apps from the session's snapshot if it has one"""
+    await _trigger_realtime_audio_bytes(uid, sample_rate, data, apps)
 
 
 # proactive notification
@@ -332,100 +387,122 @@ def _process_proactive_notification(uid: str, token: str, plugin: App, data):
     return message
 
 
-def _trigger_realtime_audio_bytes(uid: str, sample_rate: int, data: bytearray):
-    apps: List[App] = get_available_apps(uid)
+async def _trigger_realtime_audio_bytes(uid: str, sample_rate: int, data: bytearray, apps: List[App] | None):
+    if apps is None:
+        apps = await asyncio.to_thread(get_available_apps, uid)
     filtered_apps = [
         app for app in apps if
-        app.triggers_realtime_audio_bytes() and app.enabled and not app.deleted
+        app.triggers_realtime_audio_bytes() and app.enabled and not app.deleted and app.external_integration.webhook_url
     ]
     if not filtered_apps:
-        return {}
-
-    threads = []
-    results = {}
-
-    def _single(app: App):
-        if not app.external_integration.webhook_url:
-            return
-
-        url = app.external_integration.webhook_url
-        url += f'?sample_rate={sample_rate}&uid={uid}'
-        try:
-            response = requests.post(url, data=data, headers={'Content-Type': 'application/octet-stream'}, timeout=15)
+        return
+
+    data = bytes(data)
+    fanout_requests = [
+        FanoutRequest(app.id, app.external_integration.webhook_url + f'?sample_rate={sample_rate}&uid={uid}', {
+            'content': data, 'headers': {'Content-Type': 'application/octet-stream'},
+        })
+        for app in filtered_apps
+    ]
+    responses = await get_http_fanout().fan_out(
+        'realtime_audio_bytes', fanout_requests, REALTIME_AUDIO_BYTES_DEADLINE_SECONDS,
+    )
+    for app, response in zip(filtered_apps, responses):
+        if response is not None:
             print('trigger_realtime_audio_bytes', app.id, 'status:', response.status_code)
-        except Exception as e:
-            print(f"Plugin integration error: {e}")
-            return
 
-    for app in filtered_apps:
-        threads.append(threading.Thread(target=_single, args=(app,)))
-
-    [t.start() for t in threads]
-    [t.join() for t in threads]
-
-    return results
 
-
-def _trigger_realtime_integrations(uid: str, token: str, segments: List[dict], conversation_id: str | None) -> dict:
-    apps: List[App] = get_available_apps(uid)
+async def _trigger_realtime_integrations(
+        uid: str, segments: List[dict], conversation_id: str | None, apps: List[App] | None,
+) -> list:
+    if apps is None:
+        apps = await asyncio.to_thread(get_available_apps, uid)
     filtered_apps = [
         app for app in apps if
-        app.triggers_realtime() and app.enabled and not app.deleted
+        app.triggers_realtime() and app.enabled and not app.deleted and app.external_integration.webhook_url
     ]
     if not filtered_apps:
-        return {}
-
-    threads = []
-    results = {}
-
-    def _single(app: App):
-        if not app.external_integration.webhook_url:
-            return
+        return []
 
+    fanout_requests = []
+    for app in filtered_apps:
         url = app.external_integration.webhook_url
         if '?' in url:
             url += '&uid=' + uid
         else:
             url += '?uid=' + uid
+        fanout_requests.append(FanoutRequest(
+            app.id, url, {'json': {"session_id": uid, "segments": segments}},
+            _on_late_realtime_integration_response(uid, conversation_id, app),
+        ))
 
-        try:
-            response = requests.post(url, json={"session_id": uid, "segments": segments}, timeout=30)
-            if response.status_code != 200:
-                print('trigger_realtime_integrations', app.id, 'status: ', response.status_code, 'results:',
-                      response.text[:100])
-                return
+    responses = await get_http_fanout().fan_out(
+        'realtime_integrations', fanout_requests, REALTIME_INTEGRATIONS_DEADLINE_SECONDS,
+    )
 
+    answered = []
+    for app, response in zip(filtered_apps, responses):
+        if response is not None and (answer := _realtime_integration_answer(app, response)):
+            answered.append(answer)
+    if not answered:
+        return []
+
+    # usage, notifications and proactive messages are blocking, one worker thread for the whole batch
+    return await asyncio.to_thread(_process_realtime_integration_responses, uid, conversation_id, answered)
+
+
+def _realtime_integration_answer(app: App, response) -> Optional[Tuple[App, dict]]:
+    if response.status_code != 200:
+        print('trigger_realtime_integrations', app.id, 'status: ', response.status_code, 'results:',
+              response.text[:100])
+        return None
+    try:
+        return app, response.json()
+    except ValueError:
+        return app, None
+
+
+def _on_late_realtime_integration_response(uid: str, conversation_id: str | None, app: App):
+    # past the batch deadline, its notifications are still sent and its messages saved
+    def on_late_response(response):
+        if answer := _realtime_integration_answer(app, response):
+            return asyncio.to_thread(_process_realtime_integration_responses, uid, conversation_id, [answer])
+
+    return on_late_response
+
+
+def _process_realtime_integration_responses(uid: str, conversation_id: str | None, answered: List[Tuple[App, dict]]) -> list:
+    token = None
+    results = {}
+    for app, response_data in answered:
+        try:
             if (app.uid is None or app.uid != uid) and conversation_id is not None:
                 record_app_usage(uid, app.id, UsageHistoryType.transcript_processed_external_integration, conversation_id=conversation_id)
 
-            response_data = response.json()
             if not response_data:
-                return
+                continue
 
             # message
             message = response_data.get('message', '')
             # print('Plugin', plugin.id, 'response message:', message)
             if message and len(message) > 5:
+                token = token or notification_db.get_token_only(uid)
                 send_plugin_notification(token, app.name, app.id, message)
                 results[app.id] = message
 
             # proactive_notification
             noti = response_data.get('notification', None)
             # print('Plugin', plugin.id, 'response notification:', noti)
-            if app.has_capability("proactive_notification"):
+            if app.has_capability("proactive_notification") and noti:
+                token = token or notification_db.get_token_only(uid)
                 message = _process_proactive_notification(uid, token, app, noti)
                 if message:
                     results[app.id] = message
 
         except Exception as e:
             print(f"App integration error: {e}")
-            return
-
-    for app in filtered_apps:
-        threads.append(threading.Thread(target=_single, args=(app,)))
+            continue
 
-    [t.start() for t in threads]
-    [t.join() for t in threads]
     messages = []
     for key, message in results.items():
         if not message:
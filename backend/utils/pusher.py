@@ -1,9 +1,34 @@
 import os
 import random
 import asyncio
+import struct
+import zlib
+from typing import List, Optional, Tuple
+
+import msgpack
 import websockets
 
 PusherAPI = os.getenv('HOSTED_PUSHER_API_URL')
+# Comma separated pusher instances, a user's sessions always go to the same one
+pusher_api_urls = [url.strip() for url in (PusherAPI or '').split(',') if url.strip()]
+
+# Backend -> pusher framing, 4 bytes little endian header type then the payload.
+# 101|pcm, 102|json {"segments", "memory_id"} are the legacy (v1) frames, the pusher keeps accepting them.
+# 103|msgpack transcript and 104|msgpack opus audio are the compact (v2) frames, the transcript payload is at v3.
+PUSHER_FRAME_AUDIO = 101
+PUSHER_FRAME_TRANSCRIPT = 102
+PUSHER_FRAME_TRANSCRIPT_V2 = 103
+PUSHER_FRAME_OPUS_V2 = 104
+# Multiplexed connection (/v1/trigger/listen/mux), 4 bytes header type, 4 bytes session id then the payload.
+# 105|session|frame wraps any of the frames above, 106|session|msgpack {"uid", "sample_rate"} opens a session
+# and 107|session closes it.
+PUSHER_FRAME_MUX = 105
+PUSHER_FRAME_MUX_OPEN = 106
+PUSHER_FRAME_MUX_CLOSE = 107
+
+pusher_protocol_version = int(os.getenv('PUSHER_PROTOCOL_VERSION', 1))
+# Only with the v2 protocol, forward the client opus packets instead of the decoded pcm
+pusher_opus_audio = os.getenv('PUSHER_OPUS_AUDIO', '').lower() == 'true'
 
 async def connect_to_trigger_pusher(uid: str, sample_rate: int = 8000, retries: int = 3):
     print("connect_to_trigger_pusher", uid)
@@ -20,10 +45,19 @@ async def connect_to_trigger_pusher(uid: str, sample_rate: int = 8000, retries:
 
     raise Exception(f'Could not open socket: All retry attempts failed.', uid)
 
+def pusher_shard(uid: str, shards: int) -> int:
+    # stable across processes, unlike hash()
+    return zlib.crc32(uid.encode()) % shards
+
+
+def pusher_ws_host(uid: str) -> str:
+    return pusher_api_urls[pusher_shard(uid, len(pusher_api_urls))].replace("http", "ws")
+
+
 async def _connect_to_trigger_pusher(uid: str, sample_rate: int = 8000):
     try:
         print("Connecting to Pusher transcripts trigger WebSocket...", uid)
-        ws_host = PusherAPI.replace("http", "ws")
+        ws_host = pusher_ws_host(uid)
         socket = await websockets.connect(f"{ws_host}/v1/trigger/listen?uid={uid}&sample_rate={sample_rate}")
         print("Connected to Pusher transcripts trigger WebSocket.", uid)
         return socket
@@ -32,6 +66,108 @@ async def _connect_to_trigger_pusher(uid: str, sample_rate: int = 8000):
         raise
 
 
+def pusher_frame(header_type: int, payload: bytes) -> bytes:
+    return struct.pack('<I', header_type) + payload
+
+
+def pusher_mux_frame(header_type: int, session_id: int, payload: bytes = b'') -> bytes:
+    return struct.pack('<II', header_type, session_id) + payload
+
+
+def encode_mux_open(session_id: int, uid: str, sample_rate: int) -> bytes:
+    return pusher_mux_frame(
+        PUSHER_FRAME_MUX_OPEN, session_id, msgpack.packb({'uid': uid, 'sample_rate': sample_rate}, use_bin_type=True),
+    )
+
+
+def decode_mux_frame(data: bytes) -> Tuple[int, int, bytes]:
+    header_type, session_id = struct.unpack('<II', data[:8])
+    return header_type, session_id, data[8:]
+
+
+class TranscriptFrameEncoder:
+    """
+    Encodes transcript batches as compact frames.
+
+    Segments are positional arrays [seq, id, text, speaker, speaker_id, is_user, start, end, person_id], the
+    segment dict fields as they are plus `seq`, increasing for the whole session. The memory id is only sent
+    when it changes.
+    """
+
+    def __init__(self):
+        self.next_segment_id = 0
+        self._memory_id = None
+
+    def on_connect(self):
+        # a new pusher session doesn't know the memory id yet
+        self._memory_id = None
+
+    def encode(self, segments: List[dict], memory_id: Optional[str]) -> bytes:
+        rows = []
+        for segment in segments:
+            rows.append([
+                self.next_segment_id, segment.get('id'), segment['text'], segment.get('speaker'),
+                segment.get('speaker_id'), segment['is_user'], segment['start'], segment['end'],
+                segment.get('person_id'),
+            ])
+            self.next_segment_id += 1
+
+        payload = {'v': 3, 's': rows}
+        if memory_id != self._memory_id:
+            payload['m'] = memory_id
+            self._memory_id = memory_id
+        return pusher_frame(PUSHER_FRAME_TRANSCRIPT_V2, msgpack.packb(payload, use_bin_type=True))
+
+
+class TranscriptFrameDecoder:
+    """
+    Pusher side of `TranscriptFrameEncoder`, rebuilds the segment dicts of the legacy json frames, same
+    fields in the same order, and drops replayed ids.
+
+    Still reads the v2 rows [seq, text, speaker_id, is_user, start, end, person_id] of backends deployed
+    before v3, their speaker label and segment id weren't sent.
+    """
+
+    def __init__(self):
+        self.memory_id = None
+        self.last_segment_id = -1
+
+    def decode(self, payload: bytes) -> Tuple[List[dict], Optional[str]]:
+        data = msgpack.unpackb(payload, raw=False)
+        version = data.get('v')
+        if version not in (2, 3):
+            raise ValueError(f'Unsupported transcript frame version: {version}')
+        if 'm' in data:
+            self.memory_id = data['m']
+
+        segments = []
+        for row in data['s']:
+            if version == 2:
+                seq, text, speaker_id, is_user, start, end, person_id = row
+                segment_id, speaker = None, f'SPEAKER_{speaker_id:02d}'
+            else:
+                seq, segment_id, text, speaker, speaker_id, is_user, start, end, person_id = row
+            if seq <= self.last_segment_id:
+                continue
+            self.last_segment_id = seq
+            segments.append({
+                'id': segment_id, 'text': text, 'speaker': speaker, 'speaker_id': speaker_id, 'is_user': is_user,
+                'person_id': person_id, 'start': start, 'end': end,
+            })
+        return segments, self.memory_id
+
+
+def encode_opus_frame(packets: List[bytes], sample_rate: int) -> bytes:
+    return pusher_frame(PUSHER_FRAME_OPUS_V2, msgpack.packb({'v': 2, 'r': sample_rate, 'p': packets}, use_bin_type=True))
+
+
+def decode_opus_frame(payload: bytes) -> Tuple[List[bytes], int]:
+    data = msgpack.unpackb(payload, raw=False)
+    if data.get('v') != 2:
+        raise ValueError(f'Unsupported audio frame version: {data.get("v")}')
+    return data['p'], data['r']
+
+
 # Calculate backoff with jitter
 def calculate_backoff_with_jitter(attempt, base_delay=1000, max_delay=15000):
     jitter = random.random() * base_delay
@@ -0,0 +1,230 @@
+import asyncio
+import itertools
+import json
+import os
+from collections import deque
+from typing import Callable, Deque, Dict, List, Optional
+
+import websockets
+
+from utils.other.metrics import Counter, Gauge
+from utils.pusher import PUSHER_FRAME_MUX, PUSHER_FRAME_MUX_CLOSE, calculate_backoff_with_jitter, encode_mux_open, \
+    pusher_api_urls, pusher_mux_frame, pusher_shard
+
+# Listen sessions share a few pusher websockets per process instead of holding one each
+pusher_multiplex = os.getenv('PUSHER_MULTIPLEX', '').lower() == 'true'
+# Connections to every pusher instance, sessions are sharded over all of them by uid
+pusher_mux_connections_per_host = int(os.getenv('PUSHER_MUX_CONNECTIONS_PER_HOST', 2))
+# Frames a session keeps while the connection is down, the oldest are dropped above it
+pusher_mux_max_pending_frames = int(os.getenv('PUSHER_MUX_MAX_PENDING_FRAMES', 32))
+
+pusher_mux_sessions = Gauge('pusher_mux_sessions', 'Listen sessions on a multiplexed pusher connection')
+pusher_mux_connections = Gauge('pusher_mux_connections', 'Multiplexed pusher connections currently open')
+pusher_mux_connects_total = Counter(
+    'pusher_mux_connects_total', 'Multiplexed pusher connection attempts by outcome', ('result',),
+)
+pusher_mux_frames_dropped_total = Counter(
+    'pusher_mux_frames_dropped_total', 'Session frames dropped while the multiplexed connection was down',
+)
+
+_close = object()
+
+
+class PusherMuxSession:
+    """
+    A listen session on a `PusherMuxChannel`, it stands in for the session's own pusher websocket.
+
+    `send` queues the frame and returns, the channel writes it when it's the session's turn. While the
+    connection is down the session keeps its last `pusher_mux_max_pending_frames` frames, they're written
+    after the session is opened again on the new connection.
+    """
+
+    def __init__(self, channel: 'PusherMuxChannel', session_id: int, uid: str, sample_rate: int,
+                 on_open: Optional[Callable[[], None]] = None):
+        self.channel = channel
+        self.session_id = session_id
+        self.uid = uid
+        self.sample_rate = sample_rate
+        self.on_open = on_open
+        # opened on the current connection
+        self.opened = False
+        self.closed = False
+        self.pending: Deque = deque()
+
+    async def send(self, frame: bytes):
+        if self.closed:
+            return
+        if len(self.pending) >= pusher_mux_max_pending_frames:
+            self.pending.popleft()
+            pusher_mux_frames_dropped_total.inc()
+        self.pending.append(frame)
+        self.channel.ready(self)
+
+    async def close(self, code: int = 1000):
+        if self.closed:
+            return
+        self.closed = True
+        if not self.channel.connected:
+            # nothing to tell the pusher, the frames are dropped with the session
+            self.channel.remove(self)
+            return
+        self.pending.append(_close)
+        self.channel.ready(self)
+
+
+class PusherMuxChannel:
+    """
+    One websocket to a pusher instance carrying many listen sessions.
+
+    A single writer task serves the sessions with queued frames round robin, a frame each per turn,
+    so a session flushing a large audio backlog doesn't hold back the transcripts of the others.
+    A session is opened lazily, before its first frame on a connection; after a reconnect that's
+    every session again, as they send.
+    """
+
+    def __init__(self, url: str):
+        self.url = url
+        self.sessions: Dict[int, PusherMuxSession] = {}
+        self.connected = False
+        self._session_ids = itertools.count(1)
+        self._ready: Deque[int] = deque()
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    def open(self, uid: str, sample_rate: int, on_open: Optional[Callable[[], None]] = None) -> PusherMuxSession:
+        session = PusherMuxSession(self, next(self._session_ids), uid, sample_rate, on_open)
+        self.sessions[session.session_id] = session
+        pusher_mux_sessions.inc()
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+        return session
+
+    def ready(self, session: PusherMuxSession):
+        # at most one turn queued per session, it's queued again after its frame is written
+        if len(session.pending) == 1:
+            self._ready.append(session.session_id)
+            self._wakeup.set()
+
+    def remove(self, session: PusherMuxSession):
+        if self.sessions.pop(session.session_id, None) is not None:
+            pusher_mux_sessions.dec()
+
+    async def _run(self):
+        attempt = 0
+        while True:
+            try:
+                ws = await websockets.connect(f'{self.url}/v1/trigger/listen/mux')
+            except Exception as e:
+                pusher_mux_connects_total.labels(result='error').inc()
+                backoff_delay = calculate_backoff_with_jitter(attempt)
+                attempt += 1
+                print(f'Pusher mux connect to {self.url} failed, retrying in {backoff_delay:.0f}ms: {e}')
+                await asyncio.sleep(backoff_delay / 1000)
+                continue
+
+            print(f'Pusher mux connected to {self.url}, {len(self.sessions)} sessions')
+            pusher_mux_connects_total.labels(result='ok').inc()
+            pusher_mux_connections.inc()
+            attempt = 0
+            self.connected = True
+            for session in self.sessions.values():
+                session.opened = False
+            self._ready = deque(session_id for session_id, session in self.sessions.items() if session.pending)
+            reader = asyncio.create_task(self._read(ws))
+            try:
+                await self._write(ws, reader)
+                print(f'Pusher mux connection to {self.url} closed')
+            except websockets.exceptions.ConnectionClosed as e:
+                print(f'Pusher mux connection to {self.url} closed: {e}')
+            except Exception as e:
+                print(f'Pusher mux connection to {self.url} failed: {e}')
+            finally:
+                self.connected = False
+                pusher_mux_connections.dec()
+                reader.cancel()
+                await ws.close()
+
+            # sessions closed meanwhile don't come back
+            for session in [session for session in self.sessions.values() if session.closed]:
+                self.remove(session)
+            # every container reconnects at once after a pusher deploy, spread them
+            await asyncio.sleep(calculate_backoff_with_jitter(0) / 1000)
+
+    async def _write(self, ws, reader: asyncio.Task):
+        while not reader.done():
+            if not self._ready:
+                self._wakeup.clear()
+                wakeup = asyncio.create_task(self._wakeup.wait())
+                await asyncio.wait((wakeup, reader), return_when=asyncio.FIRST_COMPLETED)
+                wakeup.cancel()
+                continue
+
+            session = self.sessions.get(self._ready.popleft())
+            if session is None or not session.pending:
+                continue
+
+            if session.pending[0] is _close:
+                self.remove(session)
+                if session.opened:
+                    await ws.send(pusher_mux_frame(PUSHER_FRAME_MUX_CLOSE, session.session_id))
+                continue
+
+            if not session.opened:
+                # the open is the session's turn
+                frame = encode_mux_open(session.session_id, session.uid, session.sample_rate)
+                session.opened = True
+                if session.on_open is not None:
+                    session.on_open()
+            else:
+                frame = pusher_mux_frame(PUSHER_FRAME_MUX, session.session_id, session.pending.popleft())
+            # queued again before the write, a frame sent meanwhile would queue it a second time
+            if session.pending:
+                self._ready.append(session.session_id)
+            await ws.send(frame)
+
+    async def _read(self, ws):
+        # heartbeats, and the sessions the pusher dropped, they're opened again on their next frame
+        async for message in ws:
+            if isinstance(message, bytes):
+                continue
+            try:
+                data = json.loads(message)
+            except ValueError:
+                continue
+            if data.get('type') == 'session_closed' and (session := self.sessions.get(data.get('session'))):
+                session.opened = False
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+
+class PusherMux:
+    """The process channels, `pusher_mux_connections_per_host` per pusher instance, created on first use."""
+
+    def __init__(self, urls: List[str], connections_per_host: int = pusher_mux_connections_per_host):
+        self.urls = [url.replace('http', 'ws') for url in urls]
+        self.channels: List[Optional[PusherMuxChannel]] = [None] * (len(self.urls) * connections_per_host)
+
+    def open(self, uid: str, sample_rate: int, on_open: Optional[Callable[[], None]] = None) -> PusherMuxSession:
+        # the same instance as `pusher_ws_host`, the channel index modulo the hosts is the uid's host
+        shard = pusher_shard(uid, len(self.channels))
+        if self.channels[shard] is None:
+            self.channels[shard] = PusherMuxChannel(self.urls[shard % len(self.urls)])
+        return self.channels[shard].open(uid, sample_rate, on_open)
+
+    async def close(self):
+        for channel in self.channels:
+            if channel is not None:
+                await channel.close()
+
+
+_pusher_mux: Optional[PusherMux] = None
+
+
+def get_pusher_mux() -> PusherMux:
+    global _pusher_mux
+    if _pusher_mux is None:
+        _pusher_mux = PusherMux(pusher_api_urls)
+    return _pusher_mux
@@ -0,0 +1,66 @@
+import os
+import random
+from typing import Optional
+
+from utils.other.metrics import Counter, Gauge, get_event_loop_lag
+from utils.stt.metrics import listen_stt_sockets_active
+
+# Per process limits for new listen sessions, 0 disables a limit
+listen_admission_max_sessions = int(os.getenv('LISTEN_ADMISSION_MAX_SESSIONS', 0))
+listen_admission_max_stt_sockets = int(os.getenv('LISTEN_ADMISSION_MAX_STT_SOCKETS', 0))
+listen_admission_max_loop_lag_seconds = float(os.getenv('LISTEN_ADMISSION_MAX_LOOP_LAG_SECONDS', 0))
+listen_admission_retry_after_seconds = int(os.getenv('LISTEN_ADMISSION_RETRY_AFTER_SECONDS', 5))
+
+listen_sessions_admitted = Gauge('listen_sessions_admitted', 'Listen sessions admitted and not finished yet')
+listen_sessions_rejected_total = Counter(
+    'listen_sessions_rejected_total', 'Listen sessions rejected by the admission control', ('reason',),
+)
+
+
+class ListenAdmission:
+    """
+    Sheds new listen sessions while the process is saturated, so the ones already running keep their latency.
+
+    `admit` is checked before the session does any work and returns the reason it is rejected, or None
+    and counts the session until `release`. The event loop lag is the smoothed value of the process
+    monitor, see `start_event_loop_lag_monitor`.
+    """
+
+    def __init__(
+            self, max_sessions: int = listen_admission_max_sessions,
+            max_stt_sockets: int = listen_admission_max_stt_sockets,
+            max_loop_lag_seconds: float = listen_admission_max_loop_lag_seconds,
+            retry_after_seconds: int = listen_admission_retry_after_seconds,
+    ):
+        self.max_sessions = max_sessions
+        self.max_stt_sockets = max_stt_sockets
+        self.max_loop_lag_seconds = max_loop_lag_seconds
+        self.retry_after_seconds = retry_after_seconds
+        self.sessions = 0
+
+    def admit(self) -> Optional[str]:
+        reason = None
+        if self.max_sessions and self.sessions >= self.max_sessions:
+            reason = 'sessions'
+        elif self.max_stt_sockets and listen_stt_sockets_active.get() >= self.max_stt_sockets:
+            reason = 'stt_sockets'
+        elif self.max_loop_lag_seconds and get_event_loop_lag() >= self.max_loop_lag_seconds:
+            reason = 'event_loop_lag'
+
+        if reason:
+            listen_sessions_rejected_total.labels(reason=reason).inc()
+            return reason
+        self.sessions += 1
+        listen_sessions_admitted.inc()
+        return None
+
+    def release(self):
+        self.sessions -= 1
+        listen_sessions_admitted.dec()
+
+    def retry_after(self) -> int:
+        # jittered, rejected clients shouldn't all come back at once
+        return self.retry_after_seconds + random.randint(0, self.retry_after_seconds)
+
+
+listen_admission = ListenAdmission()
@@ -0,0 +1,91 @@
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List, Optional
+
+# Shared by every session of the process, 0 runs the audio work inline on the event loop
+audio_worker_threads = int(os.getenv('AUDIO_WORKER_THREADS', 4))
+audio_stage_queue_size = int(os.getenv('AUDIO_STAGE_QUEUE_SIZE', 200))
+audio_stage_max_batch = int(os.getenv('AUDIO_STAGE_MAX_BATCH', 10))
+
+_executor: Optional[ThreadPoolExecutor] = None
+
+
+def _get_audio_executor() -> Optional[ThreadPoolExecutor]:
+    global _executor
+    if audio_worker_threads <= 0:
+        return None
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=audio_worker_threads, thread_name_prefix='audio')
+    return _executor
+
+
+class AudioStage:
+    """
+    Moves the per frame audio work of a session (opus decoding, vad, ...) off the event loop.
+
+    Frames are queued with `put`, which waits when `queue_size` frames are pending so a stalled
+    session pushes back on its own socket instead of growing. `results` hands whatever is queued,
+    up to `max_batch` frames, to `process` on the shared worker pool and yields its result. Only one
+    batch per session is in flight, so `process` sees the frames in order and can keep state
+    (decoders, vad) without locking.
+    """
+
+    def __init__(
+            self, process: Callable[[List[bytes]], list], queue_size: int = audio_stage_queue_size,
+            max_batch: int = audio_stage_max_batch,
+    ):
+        self.process = process
+        self.max_batch = max(max_batch, 1)
+        self._queue = asyncio.Queue(maxsize=max(queue_size, 1))
+        self._closed = False
+        self._failed = False
+        self._pending_bytes = 0
+
+    def __len__(self):
+        return self._queue.qsize()
+
+    def memory_usage(self) -> int:
+        return self._pending_bytes
+
+    async def put(self, frame: bytes):
+        if self._failed:
+            raise RuntimeError('Audio stage failed')
+        await self._queue.put(frame)
+        self._pending_bytes += len(frame)
+
+    async def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        if not self._failed:
+            await self._queue.put(None)
+
+    def fail(self):
+        # unblock a producer waiting on a full queue, its next put raises
+        self._failed = True
+        while not self._queue.empty():
+            self._queue.get_nowait()
+        self._pending_bytes = 0
+
+    async def results(self):
+        loop = asyncio.get_running_loop()
+        executor = _get_audio_executor()
+        closed = False
+        while not closed:
+            frame = await self._queue.get()
+            if frame is None:
+                break
+            batch = [frame]
+            while len(batch) < self.max_batch and not self._queue.empty():
+                frame = self._queue.get_nowait()
+                if frame is None:
+                    closed = True
+                    break
+                batch.append(frame)
+            self._pending_bytes -= sum(len(frame) for frame in batch)
+
+            if executor is None:
+                yield self.process(batch)
+            else:
+                yield await loop.run_in_executor(executor, self.process, batch)
@@ -0,0 +1,97 @@
+import sys
+import time
+import uuid
+from typing import Dict, List
+
+from utils.other.metrics import Gauge, Histogram
+
+listen_session_memory_bytes = Histogram(
+    'listen_session_memory_bytes', 'Approximate memory held by a listen session when it closes',
+    buckets=(16_384, 65_536, 262_144, 1_048_576, 4_194_304, 16_777_216, 67_108_864),
+)
+listen_sessions_registered = Gauge('listen_sessions_registered', 'Listen sessions in the debug registry')
+
+# Owned per session state that grows with its traffic, each reports its own `memory_usage`
+_components = (
+    'outbound', 'in_progress_store', 'metrics', 'speech_gate', 'realtime_segments', 'pusher_segments',
+    'pusher_audio', 'audio_stage', 'ogg_writer',
+)
+
+
+class ListenSession:
+    """
+    The state a /v3/listen session owns, so its memory can be measured and bounded.
+
+    The handler keeps its control flow in closures, the buffers, writer and stores they work on are
+    attached here as they are created. `memory_usage` is an approximation: python object sizes of the
+    buffered data, not the provider sockets or the interpreter overhead of the closures.
+    """
+
+    __slots__ = (
+        'id', 'uid', 'language', 'sample_rate', 'codec', 'stt_service', 'started_at', 'peak_bytes',
+    ) + _components
+
+    def __init__(self, uid: str, language: str, sample_rate: int, codec: str, stt_service: str):
+        self.id = str(uuid.uuid4())
+        self.uid = uid
+        self.language = language
+        self.sample_rate = sample_rate
+        self.codec = codec
+        self.stt_service = stt_service
+        self.started_at = time.monotonic()
+        self.peak_bytes = 0
+        for name in _components:
+            setattr(self, name, None)
+
+    def memory_usage(self) -> dict:
+        """Approximate bytes per owned component, and their `total`."""
+        usage = {'session': sys.getsizeof(self)}
+        for name in _components:
+            component = getattr(self, name)
+            if component is None:
+                continue
+            try:
+                usage[name] = component.memory_usage()
+            except RuntimeError:
+                # mutated by the audio worker while measured, next time
+                usage[name] = 0
+        usage['total'] = sum(usage.values())
+        self.peak_bytes = max(self.peak_bytes, usage['total'])
+        return usage
+
+    def info(self) -> dict:
+        return {
+            'id': self.id,
+            'uid': self.uid,
+            'language': self.language,
+            'sample_rate': self.sample_rate,
+            'codec': self.codec,
+            'stt_service': self.stt_service,
+            'seconds': round(time.monotonic() - self.started_at, 1),
+            'memory': self.memory_usage(),
+            'peak_bytes': self.peak_bytes,
+        }
+
+
+_sessions: Dict[str, ListenSession] = {}
+
+
+def register_listen_session(session: ListenSession):
+    _sessions[session.id] = session
+    listen_sessions_registered.set(len(_sessions))
+
+
+def unregister_listen_session(session: ListenSession):
+    if _sessions.pop(session.id, None) is None:
+        return
+    listen_sessions_registered.set(len(_sessions))
+    try:
+        listen_session_memory_bytes.observe(max(session.memory_usage()['total'], session.peak_bytes))
+    except Exception as e:
+        print(f'listen session memory_usage failed: {e}', session.uid)
+
+
+def list_listen_sessions() -> List[dict]:
+    """Live sessions of this process, largest first."""
+    sessions = [session.info() for session in list(_sessions.values())]
+    return sorted(sessions, key=lambda session: session['memory']['total'], reverse=True)
@@ -0,0 +1,151 @@
+import bisect
+import sys
+import time
+
+from utils.other.metrics import Counter, Gauge, Histogram
+
+size_buckets = (1, 4, 16, 64, 256, 1024, 4096, 16384, 65536, 262144, 1048576)
+
+listen_sessions_active = Gauge('listen_sessions_active', 'Listen websockets currently open in this container')
+listen_sessions_total = Counter('listen_sessions_total', 'Listen websockets accepted', ('stt_service', 'codec'))
+listen_audio_bytes_total = Counter('listen_audio_bytes_total', 'Audio bytes received from clients')
+listen_stt_sockets_active = Gauge('listen_stt_sockets_active', 'STT provider sockets currently open in this container')
+listen_stt_frames_total = Counter('listen_stt_frames_total', 'Audio frames forwarded to the STT provider')
+listen_stt_bytes_total = Counter('listen_stt_bytes_total', 'Audio bytes forwarded to the STT provider')
+listen_session_audio_bytes = Histogram(
+    'listen_session_audio_bytes', 'Audio bytes received per listen session',
+    buckets=(16_000, 160_000, 960_000, 4_800_000, 9_600_000, 19_200_000, 57_600_000),
+)
+listen_session_seconds = Histogram(
+    'listen_session_seconds', 'Listen session duration',
+    buckets=(1, 10, 30, 60, 120, 300, 420, 600),
+)
+listen_stt_first_word_seconds = Histogram(
+    'listen_stt_first_word_seconds', 'First audio forwarded to the STT provider until its first segment',
+    buckets=(0.25, 0.5, 1, 2, 3, 5, 10, 30, 60),
+)
+listen_segment_latency_seconds = Histogram(
+    'listen_segment_latency_seconds', 'Audio received until the segment covering it is sent to the client',
+    buckets=(0.1, 0.25, 0.5, 1, 1.5, 2, 3, 5, 10, 30),
+)
+listen_pusher_queue_depth = Histogram(
+    'listen_pusher_queue_depth', 'Items waiting in the pusher queues on each flush (segments or audio bytes)',
+    ('queue',), buckets=size_buckets,
+)
+listen_websocket_send_seconds = Histogram(
+    'listen_websocket_send_seconds', 'Time to write a frame to the client websocket', ('kind',),
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1),
+)
+listen_audio_stage_depth = Histogram(
+    'listen_audio_stage_depth', 'Frames waiting for the audio worker pool when a batch is picked up',
+    buckets=(0, 1, 2, 5, 10, 20, 50, 100, 200),
+)
+listen_speech_profile_priming_seconds = Histogram(
+    'listen_speech_profile_priming_seconds', 'Time spent streaming the speech profile to the STT provider',
+    buckets=(0.1, 0.25, 0.5, 1, 2, 5, 10, 30),
+)
+
+
+class ListenSessionMetrics:
+    """
+    Per session instrumentation of the listen websocket, aggregated into the process histograms.
+
+    Keeps a coarse audio clock, the wall time at which every received chunk ended, so a segment
+    end timestamp can be mapped back to when its audio arrived.
+    """
+
+    def __init__(self, sample_rate: int, stt_service: str, codec: str, max_clock_seconds: int = 120):
+        self.bytes_per_second = sample_rate * 2
+        self.max_clock_seconds = max_clock_seconds
+        self.started_at = time.monotonic()
+        self.audio_bytes = 0
+        self.stt_frames = 0
+        self.stt_bytes = 0
+        self.first_stt_at = None
+        self.first_word_seconds = None
+        self.stt_sockets = 0
+        self.closed = False
+
+        # audio seconds received so far and the monotonic time they arrived at, ordered
+        self._clock_seconds = []
+        self._clock_times = []
+        self._audio_seconds = 0.0
+
+        listen_sessions_total.labels(stt_service=stt_service, codec=codec).inc()
+        listen_sessions_active.inc()
+
+    def on_audio_received(self, pcm_bytes: int):
+        self.audio_bytes += pcm_bytes
+        listen_audio_bytes_total.inc(pcm_bytes)
+
+        self._audio_seconds += pcm_bytes / self.bytes_per_second
+        self._clock_seconds.append(self._audio_seconds)
+        self._clock_times.append(time.monotonic())
+        if self._audio_seconds - self._clock_seconds[0] > self.max_clock_seconds * 2:
+            cut = bisect.bisect_left(self._clock_seconds, self._audio_seconds - self.max_clock_seconds)
+            del self._clock_seconds[:cut]
+            del self._clock_times[:cut]
+
+    def on_stt_socket_opened(self):
+        self.stt_sockets += 1
+        listen_stt_sockets_active.inc()
+
+    def on_stt_socket_closed(self):
+        if self.stt_sockets > 0:
+            self.stt_sockets -= 1
+            listen_stt_sockets_active.dec()
+
+    def on_stt_sent(self, data_bytes: int):
+        if self.first_stt_at is None:
+            self.first_stt_at = time.monotonic()
+        self.stt_frames += 1
+        self.stt_bytes += data_bytes
+        listen_stt_frames_total.inc()
+        listen_stt_bytes_total.inc(data_bytes)
+
+    def on_stt_segments(self):
+        # called from the provider callbacks, possibly off the event loop
+        if self.first_word_seconds is None and self.first_stt_at is not None:
+            self.first_word_seconds = time.monotonic() - self.first_stt_at
+            listen_stt_first_word_seconds.observe(self.first_word_seconds)
+
+    def on_segments_sent(self, audio_end_seconds: float):
+        """`audio_end_seconds` is the provider end timestamp of the latest segment, on the received audio timeline."""
+        i = bisect.bisect_left(self._clock_seconds, audio_end_seconds)
+        if i >= len(self._clock_times):
+            return
+        listen_segment_latency_seconds.observe(max(time.monotonic() - self._clock_times[i], 0))
+
+    def on_pusher_flush(self, queue: str, depth: int):
+        listen_pusher_queue_depth.labels(queue=queue).observe(depth)
+
+    def on_audio_stage_batch(self, depth: int):
+        listen_audio_stage_depth.observe(depth)
+
+    def on_speech_profile_primed(self, seconds: float):
+        listen_speech_profile_priming_seconds.observe(seconds)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        listen_sessions_active.dec()
+        if self.stt_sockets:
+            listen_stt_sockets_active.dec(self.stt_sockets)
+            self.stt_sockets = 0
+        listen_session_audio_bytes.observe(self.audio_bytes)
+        listen_session_seconds.observe(time.monotonic() - self.started_at)
+
+    def memory_usage(self) -> int:
+        # the audio clock, floats are boxed
+        return (sys.getsizeof(self._clock_seconds) + sys.getsizeof(self._clock_times)) \
+            + (len(self._clock_seconds) + len(self._clock_times)) * sys.getsizeof(0.0)
+
+    def summary(self) -> dict:
+        return {
+            'audio_bytes': self.audio_bytes,
+            'stt_frames': self.stt_frames,
+            'stt_bytes': self.stt_bytes,
+            'first_word_seconds': round(self.first_word_seconds, 3) if self.first_word_seconds is not None else None,
+            'seconds': round(time.monotonic() - self.started_at, 1),
+        }
@@ -0,0 +1,182 @@
+import bisect
+import os
+import sys
+import threading
+from collections import deque
+
+import numpy as np
+import webrtcvad
+
+from utils.other.memory import deep_getsizeof
+from utils.other.metrics import Counter, Histogram
+
+speech_gate_enabled = os.getenv('STT_SPEECH_GATE_ENABLED', '').lower() == 'true'
+speech_gate_hangover_ms = int(os.getenv('STT_SPEECH_GATE_HANGOVER_MS', 600))
+speech_gate_preroll_ms = int(os.getenv('STT_SPEECH_GATE_PREROLL_MS', 300))
+# Silences remembered to map provider timestamps back, the oldest half is forgotten above it
+speech_gate_max_gaps = int(os.getenv('STT_SPEECH_GATE_MAX_GAPS', 1024))
+
+speech_gate_bytes_in_total = Counter('speech_gate_bytes_in_total', 'Audio bytes given to the speech gate')
+speech_gate_bytes_forwarded_total = Counter(
+    'speech_gate_bytes_forwarded_total', 'Audio bytes the speech gate forwarded to the STT provider',
+)
+speech_gate_frames_escalated_total = Counter(
+    'speech_gate_frames_escalated_total', 'Frames the prefilter left ambiguous, escalated to webrtcvad',
+)
+speech_gate_forwarded_ratio = Histogram(
+    'speech_gate_forwarded_ratio', 'Share of the audio forwarded to the STT provider per session',
+    buckets=(0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1),
+)
+
+
+class SpeechGate:
+    """
+    Drops silent linear16 audio before it is streamed to the STT provider.
+
+    Frames are classified with a vectorized energy / zero-crossing prefilter, only the ambiguous ones
+    are escalated to webrtcvad. Once speech is found the gate stays open for `hangover_ms`, and the
+    last `preroll_ms` of dropped audio is sent ahead of it so word onsets are not clipped.
+
+    The provider only sees forwarded audio, so its timestamps are shifted back with `to_audio_seconds`,
+    which may be called from the provider callback thread while `process` runs on an audio worker.
+    """
+
+    def __init__(
+            self, sample_rate: int, frame_ms: int = 30, hangover_ms: int = speech_gate_hangover_ms,
+            preroll_ms: int = speech_gate_preroll_ms, max_gaps: int = speech_gate_max_gaps, vad_mode: int = 1,
+            silence_rms: float = 100, speech_rms: float = 1000, speech_zcr: tuple = (0.02, 0.35),
+    ):
+        if sample_rate not in (8000, 16000, 32000, 48000):
+            raise ValueError(f'Unsupported sample rate for speech gating: {sample_rate}')
+
+        self.sample_rate = sample_rate
+        self.frame_ms = frame_ms
+        self.frame_bytes = int(sample_rate * frame_ms / 1000) * 2
+        self.hangover_frames = hangover_ms // frame_ms
+        self.silence_rms = silence_rms
+        self.speech_rms = speech_rms
+        self.speech_zcr = speech_zcr
+        self.max_gaps = max_gaps
+
+        self._vad = webrtcvad.Vad(vad_mode)
+        self._pending = bytearray()
+        self._preroll = deque(maxlen=max(preroll_ms // frame_ms, 0))
+        self._hangover = 0
+
+        # [(provider seconds, audio seconds dropped before it)], ordered, the last `max_gaps`
+        self._gaps = []
+        # audio seconds dropped before the first gap kept
+        self._gaps_base = 0.0
+        # `_gaps` and `_gaps_base` change together when the oldest gaps are forgotten
+        self._gaps_lock = threading.Lock()
+        self._forwarded_seconds = 0.0
+        self._dropped_seconds = 0.0
+
+        # counters, also exported to the process metrics
+        self.bytes_in = 0
+        self.bytes_forwarded = 0
+        self.frames_escalated = 0
+        self.closed = False
+
+    @property
+    def forwarded_ratio(self) -> float:
+        return self.bytes_forwarded / self.bytes_in if self.bytes_in else 1.0
+
+    def stats(self) -> dict:
+        return {
+            'bytes_in': self.bytes_in,
+            'bytes_forwarded': self.bytes_forwarded,
+            'frames_escalated': self.frames_escalated,
+            'forwarded_ratio': round(self.forwarded_ratio, 3),
+        }
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        if self.bytes_in:
+            speech_gate_forwarded_ratio.observe(self.forwarded_ratio)
+
+    def memory_usage(self) -> int:
+        return sys.getsizeof(self._pending) + deep_getsizeof(self._preroll) + deep_getsizeof(self._gaps)
+
+    def _classify(self, frames: np.ndarray) -> list:
+        samples = frames.astype(np.float32)
+        rms = np.sqrt(np.mean(samples * samples, axis=1))
+        zcr = np.mean(np.signbit(frames[:, 1:]) != np.signbit(frames[:, :-1]), axis=1)
+
+        silence = rms < self.silence_rms
+        speech = (rms >= self.speech_rms) & (zcr >= self.speech_zcr[0]) & (zcr <= self.speech_zcr[1])
+
+        result = []
+        for i in range(len(frames)):
+            if silence[i]:
+                result.append(False)
+            elif speech[i]:
+                result.append(True)
+            else:
+                self.frames_escalated += 1
+                speech_gate_frames_escalated_total.inc()
+                result.append(self._vad.is_speech(frames[i].tobytes(), self.sample_rate))
+        return result
+
+    def _drop(self, frame: bytes):
+        seconds = len(frame) / 2 / self.sample_rate
+        self._dropped_seconds += seconds
+        with self._gaps_lock:
+            if self._gaps and self._gaps[-1][0] == self._forwarded_seconds:
+                self._gaps[-1] = (self._forwarded_seconds, self._dropped_seconds)
+            else:
+                self._gaps.append((self._forwarded_seconds, self._dropped_seconds))
+                if len(self._gaps) > self.max_gaps:
+                    # provider timestamps are recent, the oldest silences aren't looked up anymore
+                    cut = len(self._gaps) // 2
+                    self._gaps_base = self._gaps[cut - 1][1]
+                    del self._gaps[:cut]
+
+    def _forward(self, frame: bytes, out: bytearray):
+        out.extend(frame)
+        self._forwarded_seconds += len(frame) / 2 / self.sample_rate
+
+    def process(self, data: bytes) -> bytes:
+        """Returns the audio that should be sent to the provider, possibly empty."""
+        self.bytes_in += len(data)
+        speech_gate_bytes_in_total.inc(len(data))
+        self._pending.extend(data)
+        count = len(self._pending) // self.frame_bytes
+        if count == 0:
+            return b''
+
+        size = count * self.frame_bytes
+        frames = np.frombuffer(bytes(self._pending[:size]), dtype=np.int16).reshape(count, -1)
+        del self._pending[:size]
+
+        out = bytearray()
+        for frame, is_speech in zip(frames, self._classify(frames)):
+            frame = frame.tobytes()
+            if is_speech:
+                while self._preroll:
+                    self._forward(self._preroll.popleft(), out)
+                self._hangover = self.hangover_frames
+                self._forward(frame, out)
+            elif self._hangover > 0:
+                self._hangover -= 1
+                self._forward(frame, out)
+            else:
+                if self._preroll.maxlen and len(self._preroll) == self._preroll.maxlen:
+                    self._drop(self._preroll.popleft())
+                if self._preroll.maxlen:
+                    self._preroll.append(frame)
+                else:
+                    self._drop(frame)
+
+        self.bytes_forwarded += len(out)
+        speech_gate_bytes_forwarded_total.inc(len(out))
+        return bytes(out)
+
+    def to_audio_seconds(self, provider_seconds: float) -> float:
+        """Maps a provider timestamp (forwarded audio only) back to the session audio timeline."""
+        with self._gaps_lock:
+            gaps = self._gaps
+            i = bisect.bisect_right(gaps, provider_seconds, key=lambda gap: gap[0])
+            return provider_seconds + (gaps[i - 1][1] if i > 0 else self._gaps_base)
@@ -1,13 +1,16 @@
 import asyncio
+import functools
 import os
 import random
 import time
-from typing import List
+import wave
+from typing import List, Dict, Tuple
 
 import websockets
 from deepgram import DeepgramClient, DeepgramClientOptions, LiveTranscriptionEvents
 from deepgram.clients.live.v1 import LiveOptions
 
+from utils.other.timer_wheel import get_timer_wheel
 from utils.stt.soniox_util import *
 
 headers = {
@@ -16,20 +19,40 @@ headers = {
 }
 
 
-async def send_initial_file_path(file_path: str, transcript_socket_async_send):
+# Speech profile priming: frames of STT_PRIMING_CHUNK_SECONDS sent at most STT_PRIMING_REALTIME_FACTOR x realtime
+priming_chunk_seconds = float(os.getenv('STT_PRIMING_CHUNK_SECONDS', 0.25))
+priming_realtime_factor = float(os.getenv('STT_PRIMING_REALTIME_FACTOR', 50))
+
+
+@functools.lru_cache(maxsize=8)
+def _read_priming_audio(file_path: str):
+    # file paths are per profile generation, so cached buffers never go stale
+    try:
+        with wave.open(file_path, 'rb') as wav:
+            return wav.readframes(wav.getnframes()), wav.getframerate()
+    except wave.Error:
+        with open(file_path, 'rb') as file:
+            return file.read(), 16000
+
+
+async def send_initial_file_path(
+        file_path: str, transcript_socket_async_send,
+        chunk_seconds: float = priming_chunk_seconds, realtime_factor: float = priming_realtime_factor,
+):
     print('send_initial_file_path')
     start = time.time()
-    # Reading and sending in chunks
-    with open(file_path, "rb") as file:
-        while True:
-            chunk = file.read(320)
-            if not chunk:
-                break
-            # print('Uploading', len(chunk))
-            await transcript_socket_async_send(bytes(chunk))
-            await asyncio.sleep(0.0001)  # if it takes too long to transcribe
+    data, sample_rate = _read_priming_audio(file_path)
+    chunk_size = int(sample_rate * chunk_seconds) * 2
+    chunk_interval = chunk_seconds / realtime_factor if realtime_factor > 0 else 0
 
-    print('send_initial_file_path', time.time() - start)
+    for i, offset in enumerate(range(0, len(data), chunk_size)):
+        await transcript_socket_async_send(data[offset:offset + chunk_size])
+        # paced against the wall clock, so a slow send doesn't add up
+        await asyncio.sleep(max(start + (i + 1) * chunk_interval - time.time(), 0))
+
+    duration = time.time() - start
+    print('send_initial_file_path', duration)
+    return duration
 
 
 async def send_initial_file(data: List[List[int]], transcript_socket):
@@ -62,8 +85,9 @@ deepgram = DeepgramClient(os.getenv('DEEPGRAM_API_KEY'), deepgram_options)
 
 async def process_audio_dg(
         stream_transcript, language: str, sample_rate: int, channels: int, preseconds: int = 0,
+        encoding: str = 'linear16',
 ):
-    print('process_audio_dg', language, sample_rate, channels, preseconds)
+    print('process_audio_dg', language, sample_rate, channels, preseconds, encoding)
 
     def on_message(self, result, **kwargs):
         # print(f"Received message from Deepgram")  # Log when message is received
@@ -108,8 +132,14 @@ async def process_audio_dg(
     def on_error(self, error, **kwargs):
         print(f"Error: {error}")
 
+    # Warm socket from the pool if there is one, the pool only holds linear16 sockets
+    if encoding == 'linear16':
+        if dg_connection := await deepgram_pool.acquire(language, sample_rate, channels, on_message, on_error):
+            print("Deepgram connection from pool")
+            return dg_connection
+
     print("Connecting to Deepgram")  # Log before connection attempt
-    return connect_to_deepgram_with_backoff(on_message, on_error, language, sample_rate, channels)
+    return await connect_to_deepgram_with_backoff(on_message, on_error, language, sample_rate, channels, encoding=encoding)
 
 
 # Calculate backoff with jitter
@@ -119,23 +149,30 @@ def calculate_backoff_with_jitter(attempt, base_delay=1000, max_delay=32000):
     return backoff
 
 
-def connect_to_deepgram_with_backoff(on_message, on_error, language: str, sample_rate: int, channels: int, retries=3):
+async def connect_to_deepgram_with_backoff(
+        on_message, on_error, language: str, sample_rate: int, channels: int, retries=3, encoding: str = 'linear16',
+):
     print("connect_to_deepgram_with_backoff")
     for attempt in range(retries):
         try:
-            return connect_to_deepgram(on_message, on_error, language, sample_rate, channels)
+            # the sdk handshake is blocking, keep it off the event loop
+            return await asyncio.to_thread(
+                connect_to_deepgram, on_message, on_error, language, sample_rate, channels, encoding
+            )
         except Exception as error:
             print(f'An error occurred: {error}')
             if attempt == retries - 1:  # Last attempt
                 raise
         backoff_delay = calculate_backoff_with_jitter(attempt)
         print(f"Waiting {backoff_delay:.0f}ms before next retry...")
-        time.sleep(backoff_delay / 1000)  # Convert ms to seconds for sleep
+        await asyncio.sleep(backoff_delay / 1000)  # Convert ms to seconds for sleep
 
     raise Exception(f'Could not open socket: All retry attempts failed.')
 
 
-def connect_to_deepgram(on_message, on_error, language: str, sample_rate: int, channels: int):
+def connect_to_deepgram(
+        on_message, on_error, language: str, sample_rate: int, channels: int, encoding: str = 'linear16',
+):
     # 'wss://api.deepgram.com/v1/listen?encoding=linear16&sample_rate=8000&language=$recordingsLanguage&model=nova-2-general&no_delay=true&endpointing=100&interim_results=false&smart_format=true&diarize=true'
     try:
         dg_connection = deepgram.listen.websocket.v("1")
@@ -179,8 +216,9 @@ def connect_to_deepgram(on_message, on_error, language: str, sample_rate: int, c
             channels=channels,
             multichannel=channels > 1,
             model='nova-2-general',
-            sample_rate=sample_rate,
-            encoding='linear16'
+            # containerized audio (ogg-opus) is described by its own headers
+            sample_rate=sample_rate if encoding != 'ogg-opus' else None,
+            encoding=encoding if encoding != 'ogg-opus' else None,
         )
         result = dg_connection.start(options)
         print('Deepgram connection started:', result)
@@ -191,6 +229,147 @@ def connect_to_deepgram(on_message, on_error, language: str, sample_rate: int, c
         raise Exception(f'Could not open socket: {e}')
 
 
+class DeepgramConnectionPool:
+    """
+    Pre-opened deepgram sockets per (language, sample_rate, channels), so /v3/listen sessions start on a warm socket.
+
+    Pooled sockets are opened with dispatching handlers, the session callbacks are attached on `acquire`.
+    A key is refilled in the background every time a socket is taken from it. Every `keepalive_seconds`
+    the idle sockets are sent a KeepAlive, deepgram closes a socket without audio after about 10s, and
+    the ones closed or older than `max_idle_seconds` are retired and replaced.
+    """
+
+    def __init__(self, size: int, max_idle_seconds: int = 30, keepalive_seconds: float = 5):
+        self.size = size
+        self.max_idle_seconds = max_idle_seconds
+        self.keepalive_seconds = keepalive_seconds
+        self._idle: Dict[Tuple[str, int, int], List[tuple]] = {}
+        self._refilling = set()
+        self._maintenance = None
+
+    def _usable(self, opened_at: float, handlers: dict) -> bool:
+        return not handlers['closed'] and time.time() - opened_at <= self.max_idle_seconds
+
+    async def acquire(self, language: str, sample_rate: int, channels: int, on_message, on_error):
+        if self.size <= 0:
+            return None
+
+        key = (language, sample_rate, channels)
+        connection = None
+        idle = self._idle.setdefault(key, [])
+        while idle:
+            opened_at, candidate, handlers = idle.pop(0)
+            if not self._usable(opened_at, handlers):
+                asyncio.create_task(asyncio.to_thread(candidate.finish))
+                continue
+            handlers['on_message'] = on_message
+            handlers['on_error'] = on_error
+            connection = candidate
+            break
+
+        self._schedule_refill(key)
+        return connection
+
+    def prewarm(self, keys: List[Tuple[str, int, int]]):
+        for key in keys:
+            self._schedule_refill(key)
+
+    def _schedule_refill(self, key: Tuple[str, int, int]):
+        if self.size <= 0 or key in self._refilling:
+            return
+        if self._maintenance is None:
+            self._maintenance = get_timer_wheel().schedule(
+                self.keepalive_seconds, self._maintain, interval=self.keepalive_seconds,
+            )
+        self._refilling.add(key)
+        asyncio.create_task(self._refill(key))
+
+    @staticmethod
+    def _keep_alive(retired: list, kept: list):
+        for connection in retired:
+            connection.finish()
+        for connection, handlers in kept:
+            if not connection.keep_alive():
+                handlers['closed'] = True
+
+    async def _maintain(self):
+        retired, kept = [], []
+        for idle in self._idle.values():
+            for item in list(idle):
+                opened_at, connection, handlers = item
+                if self._usable(opened_at, handlers):
+                    kept.append((connection, handlers))
+                else:
+                    idle.remove(item)
+                    retired.append(connection)
+        try:
+            await asyncio.to_thread(self._keep_alive, retired, kept)
+        except Exception as e:
+            print(f'DeepgramConnectionPool keepalive failed: {e}')
+
+        for key, idle in self._idle.items():
+            if len(idle) < self.size:
+                self._schedule_refill(key)
+
+    async def _refill(self, key: Tuple[str, int, int]):
+        language, sample_rate, channels = key
+        idle = self._idle.setdefault(key, [])
+        try:
+            # drop the expired ones first
+            for item in [item for item in idle if not self._usable(item[0], item[2])]:
+                idle.remove(item)
+                await asyncio.to_thread(item[1].finish)
+
+            while len(idle) < self.size:
+                handlers = {'on_message': None, 'on_error': None, 'closed': False}
+
+                def on_message(self, result, _handlers=handlers, **kwargs):
+                    if _handlers['on_message']:
+                        _handlers['on_message'](self, result, **kwargs)
+
+                def on_error(self, error, _handlers=handlers, **kwargs):
+                    if _handlers['on_error']:
+                        _handlers['on_error'](self, error, **kwargs)
+                    else:
+                        # not handed out yet, it's replaced rather than given to a session
+                        _handlers['closed'] = True
+
+                def on_close(self, close, _handlers=handlers, **kwargs):
+                    _handlers['closed'] = True
+
+                connection = await asyncio.to_thread(
+                    connect_to_deepgram, on_message, on_error, language, sample_rate, channels
+                )
+                connection.on(LiveTranscriptionEvents.Close, on_close)
+                idle.append((time.time(), connection, handlers))
+        except Exception as e:
+            print(f'DeepgramConnectionPool refill failed {key}: {e}')
+        finally:
+            self._refilling.discard(key)
+
+
+# DEEPGRAM_POOL_SIZE=0 disables the pool, DEEPGRAM_POOL_PREWARM=en:16000,en:8000 opens sockets on startup
+deepgram_pool = DeepgramConnectionPool(
+    int(os.getenv('DEEPGRAM_POOL_SIZE', 0)), int(os.getenv('DEEPGRAM_POOL_MAX_IDLE_SECONDS', 30)),
+    float(os.getenv('DEEPGRAM_POOL_KEEPALIVE_SECONDS', 5)),
+)
+
+
+def prewarm_deepgram_pool():
+    keys = []
+    for item in os.getenv('DEEPGRAM_POOL_PREWARM', '').split(','):
+        if ':' not in item:
+            continue
+        language, sample_rate = item.strip().split(':')
+        keys.append((language, int(sample_rate), 1))
+    deepgram_pool.prewarm(keys)
+
+
+# Client opus packets go to deepgram in an ogg container instead of being decoded, see OggOpusWriter
+stt_opus_passthrough_enabled = os.getenv('STT_OPUS_PASSTHROUGH', '').lower() == 'true'
+stt_opus_packets_per_page = int(os.getenv('STT_OPUS_PACKETS_PER_PAGE', 5))
+
+
 soniox_valid_languages = ['en']
 
 
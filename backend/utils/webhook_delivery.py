@@ -0,0 +1,216 @@
+import asyncio
+import json
+import os
+import random
+import socket
+import time
+import uuid
+from typing import Callable, Dict, List, Optional, Set
+
+import httpx
+
+from database import redis_db
+from utils.other.circuit_breaker import get_circuit_breakers
+from utils.other.http_fanout import get_http_fanout
+from utils.other.metrics import Counter, Gauge
+
+# Conversation created apps and webhooks are queued in redis and posted by the backend workers,
+# the request path only enqueues. Realtime transcript webhooks are still posted inline, only their
+# retries are queued; audio bytes webhooks aren't retried.
+webhook_delivery_queue_enabled = os.getenv('WEBHOOK_DELIVERY_QUEUE', '').lower() == 'true'
+# Deliveries in flight per process
+webhook_delivery_concurrency = int(os.getenv('WEBHOOK_DELIVERY_CONCURRENCY', 32))
+webhook_delivery_timeout_seconds = float(os.getenv('WEBHOOK_DELIVERY_TIMEOUT_SECONDS', 30))
+webhook_delivery_max_attempts = int(os.getenv('WEBHOOK_DELIVERY_MAX_ATTEMPTS', 8))
+realtime_webhook_delivery_max_attempts = int(os.getenv('REALTIME_WEBHOOK_DELIVERY_MAX_ATTEMPTS', 3))
+webhook_delivery_retry_base_seconds = float(os.getenv('WEBHOOK_DELIVERY_RETRY_BASE_SECONDS', 2))
+webhook_delivery_retry_max_seconds = float(os.getenv('WEBHOOK_DELIVERY_RETRY_MAX_SECONDS', 60 * 10))
+# A delivery read by a worker that died is delivered again after this, longer than the timeout
+webhook_delivery_lease_seconds = int(os.getenv('WEBHOOK_DELIVERY_LEASE_SECONDS', 120))
+# The streams are capped, the oldest entries are trimmed above it
+webhook_delivery_max_queued = int(os.getenv('WEBHOOK_DELIVERY_MAX_QUEUED', 100000))
+webhook_delivery_max_dead = int(os.getenv('WEBHOOK_DELIVERY_MAX_DEAD', 10000))
+
+webhook_deliveries_total = Counter(
+    'webhook_deliveries_total',
+    'Queued deliveries by outcome: queued, duplicate, enqueue_error, delivered, retry or dead', ('event', 'result'),
+)
+webhook_deliveries_in_flight = Gauge('webhook_deliveries_in_flight', 'Queued deliveries being posted')
+
+# event -> called in a thread with (uid, meta, response) once a delivery got a 2xx
+_delivery_handlers: Dict[str, Callable[[str, dict, httpx.Response], None]] = {}
+
+_workers_task: Optional[asyncio.Task] = None
+
+
+def register_delivery_handler(event: str, handler: Callable[[str, dict, httpx.Response], None]):
+    _delivery_handlers[event] = handler
+
+
+def delivery_idempotency_key(uid: str, conversation_id: str, app_id: str, event: str) -> str:
+    return f'{uid}:{conversation_id}:{app_id}:{event}'
+
+
+def is_retryable_status(status_code: int) -> bool:
+    return status_code >= 500 or status_code in (408, 429)
+
+
+def enqueue_delivery(
+        event: str, uid: str, target: str, url: str, body: bytes, content_type: str = 'application/json',
+        meta: dict = None, idempotency_key: str = None, attempt: int = 0,
+        max_attempts: int = webhook_delivery_max_attempts,
+) -> bool:
+    """
+    Queues a POST of `body` to `url`, False if it wasn't queued: a duplicate of a delivery queued
+    with the same `idempotency_key` in the last day, or redis failed.
+
+    `target` is what the concurrency is limited by, e.g. the app id. `attempt` counts the attempts
+    already made inline.
+    """
+    fields = {
+        'event': event, 'key': idempotency_key or uuid.uuid4().hex, 'uid': uid, 'target': target, 'url': url,
+        'content_type': content_type, 'body': body, 'attempt': attempt, 'max_attempts': max_attempts,
+        'meta': json.dumps(meta or {}), 'enqueued_at': time.time(),
+    }
+    try:
+        queued = redis_db.add_delivery(fields, idempotency_key, maxlen=webhook_delivery_max_queued)
+    except Exception as e:
+        print(f'enqueue_delivery {event} failed: {e}', uid)
+        webhook_deliveries_total.labels(event=event, result='enqueue_error').inc()
+        return False
+    webhook_deliveries_total.labels(event=event, result='queued' if queued else 'duplicate').inc()
+    return queued
+
+
+def _retry_delay(attempt: int) -> float:
+    # exponential, jittered over its upper half so a burst of failures doesn't come back at once
+    delay = min(webhook_delivery_retry_base_seconds * 2 ** attempt, webhook_delivery_retry_max_seconds)
+    return delay / 2 + random.random() * delay / 2
+
+
+def _should_retry_delivery(response: Optional[httpx.Response], result: str) -> bool:
+    # only attempts known not to have been handled: not sent, or the endpoint said to retry.
+    # a request that failed after it was sent might have been handled, it's dead lettered
+    if result in ('connect_error', 'circuit_open', 'shed'):
+        return True
+    return response is not None and is_retryable_status(response.status_code)
+
+
+async def _deliver(entry_id: str, fields: dict):
+    event = fields['event'].decode()
+    key = fields['key'].decode()
+
+    response, result = await get_http_fanout().post_result(
+        'webhook_delivery', fields['target'].decode(), fields['url'].decode(), webhook_delivery_timeout_seconds,
+        on_late_result=lambda late, late_result: _settle_delivery(entry_id, fields, late, late_result),
+        content=fields['body'],
+        headers={'Content-Type': fields['content_type'].decode(), 'Idempotency-Key': key},
+    )
+    if result == 'late':
+        # still being posted, acked or retried once it's over
+        print(f'Delivery {event} {key} still running after {webhook_delivery_timeout_seconds}s')
+        return
+    await _settle_delivery(entry_id, fields, response, result)
+
+
+async def _settle_delivery(entry_id: str, fields: dict, response: Optional[httpx.Response], result: str):
+    event = fields['event'].decode()
+    key = fields['key'].decode()
+    uid = fields['uid'].decode()
+    attempt = int(fields['attempt'])
+
+    if response is not None and 200 <= response.status_code < 300:
+        if handler := _delivery_handlers.get(event):
+            try:
+                await asyncio.to_thread(handler, uid, json.loads(fields['meta']), response)
+            except Exception as e:
+                print(f'Delivery handler {event} error: {e}', uid)
+        await asyncio.to_thread(redis_db.complete_delivery, entry_id)
+        webhook_deliveries_total.labels(event=event, result='delivered').inc()
+        return
+
+    attempt += 1
+    error = f'status {response.status_code}' if response is not None else result
+    if _should_retry_delivery(response, result) and attempt < int(fields['max_attempts']):
+        delay = _retry_delay(attempt - 1)
+        if open_until := get_circuit_breakers().is_open(fields['url'].decode(), fields['target'].decode()):
+            delay = max(delay, open_until - time.time())
+        print(f'Delivery {event} {key} failed ({error}), attempt {attempt}, retrying in {delay:.1f}s')
+        fields['attempt'] = attempt
+        await asyncio.to_thread(redis_db.retry_delivery, entry_id, f'{key}:{attempt}', fields, time.time() + delay)
+        webhook_deliveries_total.labels(event=event, result='retry').inc()
+        return
+
+    print(f'Delivery {event} {key} failed ({error}) after {attempt} attempts, dead lettered')
+    fields.update(attempt=attempt, error=error, failed_at=time.time())
+    await asyncio.to_thread(redis_db.dead_letter_delivery, entry_id, fields, webhook_delivery_max_dead)
+    webhook_deliveries_total.labels(event=event, result='dead').inc()
+
+
+async def _deliver_entry(entry_id: str, fields: dict):
+    webhook_deliveries_in_flight.inc()
+    try:
+        await _deliver(entry_id, fields)
+    except Exception as e:
+        # stays pending, another worker claims it after the lease
+        print(f'Delivery {entry_id} error: {e}')
+    finally:
+        webhook_deliveries_in_flight.dec()
+
+
+async def _run_delivery_workers(consumer: str):
+    in_flight: Set[asyncio.Task] = set()
+    group_created = False
+    last_claim = 0.0
+
+    def start(entry_id: str, fields: dict):
+        task = asyncio.create_task(_deliver_entry(entry_id, fields))
+        in_flight.add(task)
+        task.add_done_callback(in_flight.discard)
+
+    while True:
+        try:
+            if not group_created:
+                await asyncio.to_thread(redis_db.create_deliveries_group)
+                group_created = True
+
+            now = time.time()
+            await asyncio.to_thread(redis_db.requeue_due_deliveries, now, 100, webhook_delivery_max_queued)
+            if now - last_claim >= webhook_delivery_lease_seconds / 4:
+                last_claim = now
+                for entry_id, fields in await asyncio.to_thread(
+                        redis_db.claim_stale_deliveries, consumer, webhook_delivery_lease_seconds * 1000):
+                    start(entry_id, fields)
+                await asyncio.to_thread(redis_db.delete_idle_delivery_consumers, 60 * 60 * 24 * 1000)
+
+            if len(in_flight) >= webhook_delivery_concurrency:
+                await asyncio.wait(in_flight, timeout=1, return_when=asyncio.FIRST_COMPLETED)
+                continue
+
+            # blocks for up to a second, the retries are requeued at about that pace
+            for entry_id, fields in await asyncio.to_thread(
+                    redis_db.read_deliveries, consumer, webhook_delivery_concurrency - len(in_flight), 1000):
+                start(entry_id, fields)
+        except Exception as e:
+            print(f'Delivery workers error: {e}')
+            await asyncio.sleep(5)
+
+
+def start_webhook_delivery_workers():
+    """Runs for the life of the process, call it from the app startup hook."""
+    global _workers_task
+    if webhook_delivery_queue_enabled and _workers_task is None:
+        _workers_task = asyncio.create_task(_run_delivery_workers(f'{socket.gethostname()}-{os.getpid()}'))
+
+
+def list_dead_deliveries(count: int = 100, before: str = None) -> List[dict]:
+    deliveries = []
+    for entry_id, fields in redis_db.get_dead_deliveries(count, before):
+        delivery = {name: value.decode() for name, value in fields.items() if name != 'body'}
+        delivery['id'] = entry_id
+        delivery['meta'] = json.loads(delivery.get('meta') or '{}')
+        delivery['body_bytes'] = len(fields.get('body', b''))
+        if delivery.get('content_type') == 'application/json':
+            delivery['body_preview'] = fields.get('body', b'')[:512].decode(errors='replace')
+        deliveries.append(delivery)
+    return deliveries
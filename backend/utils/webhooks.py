@@ -1,5 +1,8 @@
 import asyncio
 import json
+import os
+import time
+import uuid
 from datetime import datetime
 from typing import List
 
@@ -12,6 +15,14 @@ from models.conversation import Conversation
 from models.users import WebhookType
 import database.notifications as notification_db
 from utils.notifications import send_notification
+from utils.other.circuit_breaker import circuit_error_result, circuit_result, get_circuit_breakers
+from utils.other.http_fanout import get_http_fanout
+from utils.webhook_delivery import delivery_idempotency_key, enqueue_delivery, is_retryable_status, \
+    realtime_webhook_delivery_max_attempts, register_delivery_handler, webhook_delivery_queue_enabled
+
+# Per request, shorter than the pusher batches they are sent from, see utils/plugins.py
+realtime_transcript_webhook_deadline_seconds = float(os.getenv('REALTIME_TRANSCRIPT_WEBHOOK_DEADLINE_SECONDS', 0.9))
+audio_bytes_webhook_deadline_seconds = float(os.getenv('AUDIO_BYTES_WEBHOOK_DEADLINE_SECONDS', 4))
 
 
 def conversation_created_webhook(uid, memory: Conversation):
@@ -21,6 +32,19 @@ def conversation_created_webhook(uid, memory: Conversation):
         if not webhook_url:
             return
         webhook_url += f'?uid={uid}'
+        if webhook_delivery_queue_enabled:
+            enqueue_delivery(
+                'webhook_conversation_created', uid, f'{uid}:memory_created', webhook_url,
+                json.dumps(memory.as_dict_cleaned_dates()).encode(), meta={'conversation_id': memory.id},
+                idempotency_key=delivery_idempotency_key(uid, memory.id, 'webhook', 'memory_created'),
+            )
+            return
+        target = f'{uid}:memory_created'
+        breakers = get_circuit_breakers()
+        if not breakers.allow(webhook_url, target):
+            # without the delivery queue nothing would send it later, it's attempted anyway
+            print('memory_created_webhook: circuit open, sending anyway', webhook_url)
+        start = time.monotonic()
         try:
             response = requests.post(
                 webhook_url,
@@ -28,8 +52,11 @@ def conversation_created_webhook(uid, memory: Conversation):
                 headers={'Content-Type': 'application/json'},
                 timeout=30,
             )
+            # within the 30s timeout isn't slow
+            breakers.record(webhook_url, target, circuit_result(response.status_code, time.monotonic() - start, 30))
             print('memory_created_webhook:', webhook_url, response.status_code)
         except Exception as e:
+            breakers.record(webhook_url, target, circuit_error_result(e))
             print(f"Error sending memory created to developer webhook: {e}")
     else:
         return
@@ -60,6 +87,48 @@ def day_summary_webhook(uid, summary: str):
         return
 
 
+def _on_realtime_transcript_webhook_response(uid: str, response):
+    response_data = response.json()
+    if not response_data:
+        return
+    message = response_data.get('message', '')
+    if len(message) > 5:
+        token = notification_db.get_token_only(uid)
+        send_webhook_notification(token, message)
+
+
+def _on_late_realtime_transcript_webhook_response(uid: str, response, retry):
+    print('realtime_transcript_webhook late:', response.status_code, uid)
+    if is_retryable_status(response.status_code):
+        return retry()
+    if response.status_code == 200:
+        return asyncio.to_thread(_on_realtime_transcript_webhook_response, uid, response)
+
+
+register_delivery_handler(
+    'webhook_realtime_transcript', lambda uid, meta, response: _on_realtime_transcript_webhook_response(uid, response),
+)
+
+
+def _should_retry(response, result: str) -> bool:
+    # only failures known not to have been handled: nothing was sent, or the endpoint said to retry.
+    # a late request is still running, a shed or circuit refused one is over the endpoint's limits
+    return result == 'connect_error' or (response is not None and is_retryable_status(response.status_code))
+
+
+async def _enqueue_realtime_retry(
+        event: str, uid: str, target: str, url: str, body: bytes, content_type: str, idempotency_key: str,
+):
+    """The inline attempt failed, the next ones go through the delivery queue when it's enabled."""
+    # a webhook known to be down isn't retried either
+    if not webhook_delivery_queue_enabled or get_circuit_breakers().is_open(url, target):
+        return
+    await asyncio.to_thread(
+        enqueue_delivery, event, uid, target, url, body, content_type, idempotency_key=idempotency_key, attempt=1,
+        max_attempts=realtime_webhook_delivery_max_attempts,
+    )
+
+
 async def realtime_transcript_webhook(uid, segments: List[dict]):
     print("realtime_transcript_webhook", uid)
     toggled = user_webhook_status_db(uid, WebhookType.realtime_transcript)
@@ -68,22 +137,31 @@ async def realtime_transcript_webhook(uid, segments: List[dict]):
         if not webhook_url:
             return
         webhook_url += f'?uid={uid}'
+        target = f'{uid}:realtime_transcript'
+        # the same key on the retries, the endpoint can tell a batch it already got
+        idempotency_key = uuid.uuid4().hex
+        body = json.dumps({'segments': segments, 'session_id': uid}).encode()
+
+        def retry():
+            return _enqueue_realtime_retry(
+                'webhook_realtime_transcript', uid, target, webhook_url, body, 'application/json', idempotency_key,
+            )
+
         try:
-            response = requests.post(
-                webhook_url,
-                json={'segments': segments, 'session_id': uid},
-                headers={'Content-Type': 'application/json'},
-                timeout=15,
+            response, result = await get_http_fanout().post_result(
+                'realtime_transcript_webhook', target, webhook_url, realtime_transcript_webhook_deadline_seconds,
+                on_late_response=lambda late: _on_late_realtime_transcript_webhook_response(uid, late, retry),
+                content=body,
+                headers={'Content-Type': 'application/json', 'Idempotency-Key': idempotency_key},
             )
+            if _should_retry(response, result):
+                # retried from the delivery queue
+                await retry()
+            if response is None:
+                return
             print('realtime_transcript_webhook:', webhook_url, response.status_code)
             if response.status_code == 200:
-                response_data = response.json()
-                if not response_data:
-                    return
-                message = response_data.get('message', '')
-                if len(message) > 5:
-                    token = notification_db.get_token_only(uid)
-                    send_webhook_notification(token, message)
+                await asyncio.to_thread(_on_realtime_transcript_webhook_response, uid, response)
         except Exception as e:
             print(f"Error sending realtime transcript to developer webhook: {e}")
     else:
@@ -118,7 +196,14 @@ async def send_audio_bytes_developer_webhook(uid: str, sample_rate: int, data: b
             return
         webhook_url += f'?sample_rate={sample_rate}&uid={uid}'
         try:
-            response = requests.post(webhook_url, data=data, headers={'Content-Type': 'application/octet-stream'}, timeout=15)
+            # not retried, raw pcm is too large to queue in redis and the next chunk follows in seconds
+            response = await get_http_fanout().post(
+                'audio_bytes_webhook', f'{uid}:audio_bytes', webhook_url,
+                audio_bytes_webhook_deadline_seconds,
+                content=bytes(data), headers={'Content-Type': 'application/octet-stream'},
+            )
+            if response is None:
+                return
             print('send_audio_bytes_developer_webhook:', webhook_url, response.status_code)
         except Exception as e:
             print(f"Error sending audio bytes to developer webhook: {e}")